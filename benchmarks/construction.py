@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Benchmark for rebuilding operations whose operands are already in canonical form.
+
+Run it from the root of the repository with::
+
+    python -m benchmarks.construction
+
+Every benchmark is run with the trusted construction and again with the normal construction, which flattens, sorts
+and checks all the operands again. The time is printed per operation that is created.
+"""
+import timeit
+from contextlib import contextmanager
+
+from matchpy import Arity, Operation, Symbol, Wildcard, replace, substitute
+from matchpy import functions
+from matchpy.expressions.functions import create_operation_expression, replace_operand
+
+f = Operation.new('f', Arity.variadic)
+Plus = Operation.new('+', Arity.variadic, 'Plus', associative=True, commutative=True, one_identity=True)
+
+
+def normal_replace_operand(old_operation, index, new_operand):
+    operands = list(old_operation.operands)
+    operands[index] = new_operand
+    return create_operation_expression(old_operation, operands)
+
+
+@contextmanager
+def normal_construction():
+    """Temporarily use the normal construction in :func:`.replace` and :func:`.substitute`."""
+    functions.replace_operand = normal_replace_operand
+    try:
+        yield
+    finally:
+        functions.replace_operand = replace_operand
+
+
+def measure(function, repeat=5, number=200):
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number * 1e6
+
+
+def main():
+    x_ = Wildcard.dot('x')
+    print('{:<40}{:>12}{:>12}{:>10}'.format('us per operation', 'trusted', 'normal', 'speedup'))
+    for size in (4, 32, 256):
+        symbols = [Symbol('s{:03d}'.format(i)) for i in range(size)]
+        plus = Plus(*symbols)
+        template = Plus(x_, *symbols[1:])
+        nested = f(f(f(plus)))
+        benchmarks = [
+            (
+                'construct', lambda: Plus.from_canonical(list(plus.operands)),
+                lambda: Plus(*plus.operands)
+            ),
+            (
+                'replace_operand', lambda: replace_operand(plus, 0, symbols[-1]),
+                lambda: normal_replace_operand(plus, 0, symbols[-1])
+            ),
+            ('replace', lambda: replace(nested, (0, 0, 0, 0), symbols[-1]), None),
+            ('substitute', lambda: substitute(template, {'x': symbols[size // 2]}), None),
+        ]
+        for name, trusted, normal in benchmarks:
+            trusted_time = measure(trusted)
+            if normal is None:
+                with normal_construction():
+                    normal_time = measure(trusted)
+            else:
+                normal_time = measure(normal)
+            print(
+                '{:<40}{:>12.2f}{:>12.2f}{:>9.2f}x'.format(
+                    '{} ({} operands)'.format(name, size), trusted_time, normal_time, normal_time / trusted_time
+                )
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark for the per-type dispatch of op_iter, op_len, create_operation_expression and the heads.
+
+Run it from the root of the repository with::
+
+    python -m benchmarks.dispatch
+
+Every benchmark is run with the cached dispatch and again with the previous implementation, which searches the MRO of
+the type on every call. The time is printed per node of the expressions involved.
+"""
+import sys
+import timeit
+from contextlib import contextmanager
+
+from matchpy import Arity, Operation, Pattern, Symbol, Wildcard, substitute
+from matchpy.expressions import functions as expression_functions
+from matchpy.expressions.functions import create_operation_expression, op_iter, op_len, preorder_iter
+from matchpy.matching.many_to_one import ManyToOneMatcher, _MatchIter
+from matchpy.matching.syntactic import FlatTerm
+
+f = Operation.new('f', Arity.variadic)
+g = Operation.new('g', Arity.binary)
+h = Operation.new('h', Arity.variadic, commutative=True)
+a, b, c = Symbol('a'), Symbol('b'), Symbol('c')
+x_, y_, z___ = Wildcard.dot('x'), Wildcard.dot('y'), Wildcard.star('z')
+
+
+def mro_op_iter(operation):
+    for parent in type(operation).__mro__:
+        if parent in expression_functions._operation_iterators:
+            return expression_functions._operation_iterators[parent][0](operation)
+    return iter(operation)
+
+
+def mro_op_len(operation):
+    for parent in type(operation).__mro__:
+        if parent in expression_functions._operation_iterators:
+            return expression_functions._operation_iterators[parent][1](operation)
+    return len(operation)
+
+
+def mro_create_operation_expression(old_operation, new_operands, variable_name=True):
+    operation = type(old_operation)
+    for parent in operation.__mro__:
+        if parent in expression_functions._operation_factories:
+            return expression_functions._operation_factories[parent](old_operation, new_operands, variable_name)
+    if variable_name is True:
+        variable_name = getattr(old_operation, 'variable_name', None)
+    if variable_name is False:
+        return operation(*new_operands)
+    return operation(*new_operands, variable_name=variable_name)
+
+
+def mro_get_heads(expression):
+    heads = [base for base in type(expression).__mro__ if base is not object]
+    if not isinstance(expression, Operation):
+        heads.append(expression)
+    heads.append(None)
+    return heads
+
+
+@contextmanager
+def uncached_dispatch():
+    """Temporarily use the MRO search instead of the cached dispatch in all matchpy modules."""
+    replacements = {
+        'op_iter': (op_iter, mro_op_iter),
+        'op_len': (op_len, mro_op_len),
+        'create_operation_expression': (create_operation_expression, mro_create_operation_expression),
+    }
+    patched = []
+    for name, module in list(sys.modules.items()):
+        if not name.startswith('matchpy') or module is None:
+            continue
+        for attribute, (cached, uncached) in replacements.items():
+            if getattr(module, attribute, None) is cached:
+                patched.append((module, attribute, cached))
+                setattr(module, attribute, uncached)
+    get_heads = _MatchIter.__dict__['_get_heads']
+    _MatchIter._get_heads = staticmethod(mro_get_heads)
+    try:
+        yield
+    finally:
+        _MatchIter._get_heads = get_heads
+        for module, attribute, cached in patched:
+            setattr(module, attribute, cached)
+
+
+def nested_expression(depth, leaves):
+    if depth == 0:
+        return leaves[0]
+    return f(g(nested_expression(depth - 1, leaves), leaves[1]), h(leaves[2], nested_expression(depth - 1, leaves)))
+
+
+def count_nodes(expression):
+    return sum(1 for _ in preorder_iter(expression))
+
+
+def measure(function, nodes, repeat=15, number=20):
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number / nodes * 1e9
+
+
+def main():
+    subject = nested_expression(6, [a, b, c])
+    template = nested_expression(6, [x_, y_, c])
+    substitution = {'x': f(a, b), 'y': b}
+    matcher = ManyToOneMatcher(
+        Pattern(f(g(x_, y_), h(c, x_))),
+        Pattern(f(g(x_, b), z___)),
+        Pattern(g(f(z___), a)),
+        Pattern(h(a, x_)),
+    )
+    subexpressions = list(preorder_iter(subject))
+    operations = [e for e in subexpressions if isinstance(e, Operation)]
+
+    benchmarks = [
+        # The functions are looked up in their module, so that uncached_dispatch() can replace them
+        ('op_iter', lambda: [list(expression_functions.op_iter(o)) for o in operations], len(operations)),
+        ('op_len', lambda: [expression_functions.op_len(o) for o in operations], len(operations)),
+        (
+            'create_operation_expression',
+            lambda: [expression_functions.create_operation_expression(o, list(o.operands)) for o in operations],
+            len(operations)
+        ),
+        ('_get_heads', lambda: [_MatchIter._get_heads(e) for e in subexpressions], len(subexpressions)),
+        ('_substitute', lambda: substitute(template, substitution), count_nodes(template)),
+        ('FlatTerm._flatterm_iter', lambda: FlatTerm(subject), count_nodes(subject)),
+        ('_match', lambda: [list(matcher.match(e)) for e in subexpressions], len(subexpressions)),
+    ]
+
+    print('{:<30}{:>16}{:>16}{:>10}'.format('ns per node', 'cached', 'MRO search', 'speedup'))
+    for name, function, nodes in benchmarks:
+        cached = measure(function, nodes)
+        with uncached_dispatch():
+            uncached = measure(function, nodes)
+        print('{:<30}{:>16.0f}{:>16.0f}{:>9.2f}x'.format(name, cached, uncached, uncached / cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Benchmark for the time it takes to import matchpy in a fresh interpreter.
+
+Run it from the root of the repository with::
+
+    python -m benchmarks.import_time
+
+Every statement is run in a new interpreter and the best time of several runs is printed after subtracting the start
+up time of the interpreter itself.
+"""
+import subprocess
+import sys
+import time
+
+STATEMENTS = [
+    'from matchpy import Symbol, Operation',
+    'from matchpy import match',
+    'from matchpy import ManyToOneReplacer',
+    'from matchpy import *',
+]
+
+
+def measure(statement, repeat=10):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', statement])
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    baseline = measure('pass')
+    print('{:<45}{:>10}'.format('statement', 'ms'))
+    for statement in STATEMENTS:
+        print('{:<45}{:>10.1f}'.format(statement, (measure(statement) - baseline) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
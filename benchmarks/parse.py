@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Benchmark for parsing a corpus of expressions in their textual form.
+
+Run it from the root of the repository with::
+
+    python -m benchmarks.parse
+
+A corpus of random expressions is written to a temporary file, one per line. Then the time to only read the lines
+is compared to the time to parse them with :class:`~matchpy.parse.Parser` and with a straightforward recursive
+parser.
+"""
+import os
+import random
+import tempfile
+import time
+
+from matchpy import Arity, Operation, Symbol, Wildcard
+from matchpy.expressions.functions import preorder_iter
+from matchpy.parse import Parser
+
+f = Operation.new('f', Arity.variadic)
+g = Operation.new('g', Arity.binary)
+Plus = Operation.new('+', Arity.variadic, 'Plus', associative=True, commutative=True, infix=True)
+OPERATIONS = [f, g, Plus]
+
+
+def random_expression(rng, depth, symbols):
+    if depth == 0 or rng.random() < 0.2:
+        if rng.random() < 0.05:
+            return Wildcard.dot(rng.choice('xyz'))
+        return rng.choice(symbols)
+    operation = rng.choice(OPERATIONS)
+    count = 2 if operation is g else rng.randint(2, 4)
+    return operation(*(random_expression(rng, depth - 1, symbols) for _ in range(count)))
+
+
+def recursive_parse(text, operations):
+    """A simple recursive descent parser for comparison, which only supports prefix and infix operations."""
+    text = text.strip()
+    position = 0
+
+    def expression():
+        nonlocal position
+        if text[position] == '(':
+            position += 1
+            operands = [expression()]
+            operator = None
+            while text[position] != ')':
+                end = text.index(' ', position + 1)
+                operator = text[position + 1:end]
+                position = end + 1
+                operands.append(expression())
+            position += 1
+            return operations[operator](*operands)
+        start = position
+        while position < len(text) and text[position] not in '(), ':
+            position += 1
+        name = text[start:position]
+        if position < len(text) and text[position] == '(':
+            position += 1
+            operands = []
+            while text[position] != ')':
+                operands.append(expression())
+                if text[position] == ',':
+                    position += 2
+            position += 1
+            return operations[name](*operands)
+        if name.endswith('_'):
+            return Wildcard.dot(name[:-1])
+        return Symbol(name)
+
+    return expression()
+
+
+def measure(function, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    rng = random.Random(0)
+    symbols = [Symbol('s{}'.format(i)) for i in range(100)]
+    expressions = [random_expression(rng, 6, symbols) for _ in range(5000)]
+    nodes = sum(1 for e in expressions for _ in preorder_iter(e))
+    parser = Parser(OPERATIONS)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file:
+        for expression in expressions:
+            file.write('{!s}\n'.format(expression))
+    try:
+        size = os.path.getsize(file.name) / 1e6
+        with open(file.name) as corpus:
+            assert list(parser.parse_file(corpus)) == expressions
+        with open(file.name) as corpus:
+            operations = {o.name: o for o in OPERATIONS}
+            assert [recursive_parse(line, operations) for line in corpus] == expressions
+
+        def read():
+            with open(file.name) as corpus:
+                for _ in corpus:
+                    pass
+
+        def parse():
+            with open(file.name) as corpus:
+                for _ in parser.parse_file(corpus):
+                    pass
+
+        def parse_recursive():
+            operations = {o.name: o for o in OPERATIONS}
+            with open(file.name) as corpus:
+                for line in corpus:
+                    recursive_parse(line, operations)
+
+        print('{} expressions with {} nodes, {:.1f} MB'.format(len(expressions), nodes, size))
+        print('{:<20}{:>12}{:>14}'.format('', 'MB/s', 'ns per node'))
+        for name, function in [('read lines', read), ('Parser', parse), ('recursive parser', parse_recursive)]:
+            duration = measure(function)
+            print('{:<20}{:>12.1f}{:>14.0f}'.format(name, size / duration, duration / nodes * 1e9))
+    finally:
+        os.remove(file.name)
+
+
+if __name__ == '__main__':
+    main()
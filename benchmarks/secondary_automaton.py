@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Benchmark for using the :class:`.SecondaryAutomaton` as a pre-check in the commutative matcher.
+
+Run it from the root of the repository with::
+
+    python -m benchmarks.secondary_automaton
+
+For every number *k* of subpatterns, a :class:`.ManyToOneMatcher` with random commutative patterns is matched against
+random subjects. This is done once as it is, and once with a pre-check that uses the automaton to reject the subjects
+whose operands cannot cover all the subpatterns before their distributions are enumerated. The automaton is built
+before the time is measured, the build time is printed separately. The last columns show how many bipartite problems
+there were and how many of them the pre-check rejected.
+
+The pre-check does not make the matching faster for any *k*, because the rejected problems are rare and the search
+fails early for them, so the matcher does not use the automaton.
+"""
+import itertools
+import random
+import timeit
+from contextlib import contextmanager
+
+from matchpy import Arity, Operation, Pattern, Symbol, Wildcard
+from matchpy.matching.many_to_one import CommutativeMatcher, ManyToOneMatcher, SecondaryAutomaton
+
+g = Operation.new('g', Arity.binary)
+h = Operation.new('h', Arity.variadic, commutative=True, associative=True)
+SYMBOLS = [Symbol(name) for name in 'abcd']
+
+PATTERN_COUNT = 4
+SUBJECT_COUNT = 300
+
+
+def random_patterns(k, generator):
+    patterns = []
+    for i in range(PATTERN_COUNT):
+        operands = []
+        for j in range(k):
+            arguments = [
+                generator.choice(SYMBOLS) if generator.random() < 0.6 else Wildcard.dot('x{}_{}_{}'.format(i, j, n))
+                for n in range(2)
+            ]
+            operands.append(g(*arguments))
+        patterns.append(Pattern(h(*operands, Wildcard.star('rest'))))
+    return patterns
+
+
+def random_subjects(k, generator):
+    return [
+        h(*(g(generator.choice(SYMBOLS), generator.choice(SYMBOLS)) for _ in range(k + 3)))
+        for _ in range(SUBJECT_COUNT)
+    ]
+
+
+def is_feasible(subject_counts, patterns, adjacency):
+    """Check with the automaton whether all the subpatterns can be matched at once."""
+    k = len(patterns)
+    bits = {}
+    offset = 0
+    for pattern, count in patterns.items():
+        bits[pattern] = ((1 << count) - 1) << offset
+        offset += count
+    masks = {}
+    for pattern, pattern_subjects in adjacency.items():
+        for subject in pattern_subjects:
+            masks[subject] = masks.get(subject, 0) | bits[pattern]
+    edges = itertools.chain.from_iterable(itertools.repeat(m, min(subject_counts[s], k)) for s, m in masks.items())
+    return SecondaryAutomaton.get(k).match(edges)
+
+
+@contextmanager
+def pre_check(statistics):
+    """Temporarily check every bipartite problem with the automaton before it is solved."""
+    build_bipartite = CommutativeMatcher._build_bipartite
+    match_with_bipartite = CommutativeMatcher._match_with_bipartite
+
+    def checked_match_with_bipartite(self, subject_ids, subject_counts, pattern_set, substitution):
+        statistics[0] += 1
+        # The adjacency is built again by the matcher, but that is cheap compared to the search
+        if not is_feasible(subject_counts, pattern_set, build_bipartite(self, subject_ids, pattern_set)):
+            statistics[1] += 1
+            return iter(())
+        return match_with_bipartite(self, subject_ids, subject_counts, pattern_set, substitution)
+
+    CommutativeMatcher._match_with_bipartite = checked_match_with_bipartite
+    try:
+        yield
+    finally:
+        CommutativeMatcher._match_with_bipartite = match_with_bipartite
+
+
+def measure(function, repeat=15, number=1):
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number
+
+
+def main(max_k=6):
+    print(
+        '{:>3}{:>10}{:>14}{:>16}{:>14}{:>8}{:>10}{:>10}'.format(
+            'k', 'matches', 'build (ms)', 'no check (ms)', 'check (ms)', 'ratio', 'problems', 'rejected'
+        )
+    )
+    for k in range(1, max_k + 1):
+        generator = random.Random(k)
+        matcher = ManyToOneMatcher(*random_patterns(k, generator))
+        subjects = random_subjects(k, generator)
+        match_all = lambda: sum(1 for subject in subjects for _ in matcher.match(subject))
+        build_time = measure(lambda: SecondaryAutomaton(k), repeat=1 if k > 4 else 3)
+        SecondaryAutomaton.get(k)
+        matches = match_all()
+        time = measure(match_all)
+        statistics = [0, 0]
+        with pre_check(statistics):
+            assert match_all() == matches
+            problems, rejected = statistics
+            check_time = measure(match_all)
+        print(
+            '{:>3}{:>10}{:>14.2f}{:>16.2f}{:>14.2f}{:>8.2f}{:>10}{:>10}'.format(
+                k, matches, build_time * 1e3, time * 1e3, check_time * 1e3, check_time / time, problems, rejected
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Benchmark for the binary serialization of expressions compared to :mod:`pickle`.
+
+Run it from the root of the repository with::
+
+    python -m benchmarks.serialization
+
+The expressions are written to and read from a file in memory, either all with a single writer or pickler, or one by
+one. The time is printed per node of the expressions and the size in bytes per node.
+"""
+import io
+import pickle
+import random
+import timeit
+
+from matchpy import Arity, Operation, Symbol, Wildcard
+from matchpy.expressions.functions import preorder_iter
+from matchpy.serialization import ExpressionReader, ExpressionWriter
+
+f = Operation.new('f', Arity.variadic)
+g = Operation.new('g', Arity.binary)
+h = Operation.new('h', Arity.variadic, associative=True, commutative=True)
+TYPES = [f, g, h]
+
+# Operation.new creates the classes in matchpy.expressions.expressions, so pickle needs to find them there
+for operation in TYPES:
+    operation.__qualname__ = operation.__name__ = 'Benchmark' + operation.__name__
+    operation.__module__ = __name__
+    globals()[operation.__name__] = operation
+
+
+def random_expression(rng, depth, symbols):
+    if depth == 0 or rng.random() < 0.2:
+        if rng.random() < 0.05:
+            return Wildcard.dot(rng.choice('xyz'))
+        return rng.choice(symbols)
+    operation = rng.choice(TYPES)
+    count = 2 if operation is g else rng.randint(1, 4)
+    return operation(*(random_expression(rng, depth - 1, symbols) for _ in range(count)))
+
+
+def write(expressions):
+    file = io.BytesIO()
+    ExpressionWriter(file).write_all(expressions)
+    return file.getvalue()
+
+
+def read(data):
+    return list(ExpressionReader(io.BytesIO(data), types=TYPES))
+
+
+def write_pickle(expressions):
+    file = io.BytesIO()
+    pickler = pickle.Pickler(file, pickle.HIGHEST_PROTOCOL)
+    for expression in expressions:
+        pickler.dump(expression)
+    return file.getvalue()
+
+
+def read_pickle(data):
+    file = io.BytesIO(data)
+    unpickler = pickle.Unpickler(file)
+    result = []
+    while file.tell() < len(data):
+        result.append(unpickler.load())
+    return result
+
+
+def measure(function, argument, nodes, repeat=5, number=3):
+    return min(timeit.repeat(lambda: function(argument), repeat=repeat, number=number)) / number / nodes * 1e9
+
+
+def main():
+    rng = random.Random(0)
+    symbols = [Symbol('s{}'.format(i)) for i in range(100)]
+    expressions = [random_expression(rng, 6, symbols) for _ in range(1000)]
+    nodes = sum(1 for e in expressions for _ in preorder_iter(e))
+    # Compute the cached properties like after matching, which are then pickled as well
+    for expression in expressions:
+        for subexpression in preorder_iter(expression):
+            subexpression.is_constant, subexpression.variables
+    assert read(write(expressions)) == expressions
+    assert read_pickle(write_pickle(expressions)) == expressions
+
+    print('{} expressions with {} nodes'.format(len(expressions), nodes))
+    print('{:<30}{:>12}{:>12}{:>12}'.format('per node', 'bytes', 'write ns', 'read ns'))
+    for name, dump, load in [('matchpy.serialization', write, read), ('pickle', write_pickle, read_pickle)]:
+        data = dump(expressions)
+        print(
+            '{:<30}{:>12.2f}{:>12.0f}{:>12.0f}'.format(
+                name, len(data) / nodes, measure(dump, expressions, nodes), measure(load, data, nodes)
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
-"""Contains all the necessary classes and functions for pattern matching."""
+"""Contains all the necessary classes and functions for pattern matching.
+
+Only the expressions are imported eagerly, the functions and matching algorithms are loaded once they are first used.
+"""
 
 # pylint: disable=wildcard-import
 from . import expressions
-from . import functions
 from . import utils
 from . import matching
+from ._lazy import attach as _attach
 
 from .expressions import *
-from .functions import *
 from .utils import *
-from .matching import *
 
-__all__ = expressions.__all__ + functions.__all__ + utils.__all__ + matching.__all__
+__getattr__, __dir__, _lazy_names = _attach(
+    __name__, {
+        'functions': [
+            'substitute', 'compile_template', 'SubstitutionTemplate', 'replace', 'replace_all', 'replace_many',
+            'is_match', 'ReplacementRule'
+        ],
+        'matching': matching.__all__,
+        'parse': ['Parser', 'parse_expression'],
+        'serialization': ['ExpressionWriter', 'ExpressionReader', 'dumps', 'loads'],
+    }
+)
+
+__all__ = expressions.__all__ + utils.__all__ + _lazy_names
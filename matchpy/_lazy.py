@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Lazy loading of the submodules of a package.
+
+The public names of a package are listed together with the submodule that defines them, so that the submodule is
+only imported when one of its names is accessed for the first time. This uses a module level ``__getattr__`` as
+defined by :pep:`562`. For Python versions before 3.7 the class of the package module is replaced with a subclass that
+delegates to it.
+"""
+import importlib
+import sys
+import types
+from typing import Callable, Dict, Iterable, List, Tuple
+
+__all__ = []
+
+
+def attach(package_name: str, submodules: Dict[str, Iterable[str]]) -> Tuple[Callable, Callable, List[str]]:
+    """Lazily load the given submodules of a package when their names are accessed.
+
+    Args:
+        package_name:
+            The ``__name__`` of the package.
+        submodules:
+            A mapping from the name of a submodule relative to the package to the names that it exports.
+
+    Returns:
+        The ``__getattr__`` and ``__dir__`` functions for the package and the names exported by the submodules, in
+        order, for its ``__all__``.
+    """
+    attributes = {}
+    for submodule, names in submodules.items():
+        for name in names:
+            attributes[name] = submodule
+    exported = list(attributes)
+    package = sys.modules[package_name]
+
+    def __getattr__(name):
+        if name in submodules:
+            return importlib.import_module('.' + name, package_name)
+        try:
+            submodule = attributes[name]
+        except KeyError:
+            raise AttributeError('module {!r} has no attribute {!r}'.format(package_name, name)) from None
+        value = getattr(importlib.import_module('.' + submodule, package_name), name)
+        setattr(package, name, value)
+        return value
+
+    def __dir__():
+        return sorted(set(package.__dict__) | set(submodules) | set(attributes))
+
+    if sys.version_info < (3, 7):
+        package.__class__ = _LazyModule
+
+    return __getattr__, __dir__, exported
+
+
+class _LazyModule(types.ModuleType):
+    """A module that supports a module level ``__getattr__`` and ``__dir__`` before Python 3.7."""
+
+    def __getattr__(self, name):
+        try:
+            getattr_function = self.__dict__['__getattr__']
+        except KeyError:
+            raise AttributeError('module {!r} has no attribute {!r}'.format(self.__name__, name)) from None
+        return getattr_function(name)
+
+    def __dir__(self):
+        return self.__dict__['__dir__']()
@@ -23,15 +23,99 @@ True
 False
 
 You can also create a subclass of the :class:`Constraint` class to create your own custom constraint type.
+
+The code generated for the matchers inlines the constraints, see :meth:`Constraint.generate_code`. For a
+:class:`CustomConstraint`, this works for lambdas and for functions registered with :func:`register_importable`.
 """
 import inspect
+import io
+import tokenize
 from collections import OrderedDict
-from typing import Callable, Optional, FrozenSet, Dict
+from typing import Callable, Optional, FrozenSet, Dict, Set, Tuple, TypeVar
 
 from . import substitution
 from ..utils import get_short_lambda_source, cached_property
 
-__all__ = ['Constraint', 'EqualVariablesConstraint', 'CustomConstraint']
+__all__ = ['Constraint', 'EqualVariablesConstraint', 'CustomConstraint', 'register_importable']
+
+F = TypeVar('F', bound=Callable)
+
+# The functions that can be imported by generated code together with their module and name
+_importable_functions = {}  # type: Dict[Callable, Tuple[str, str]]
+
+
+def register_importable(function: F, path: Optional[str]=None) -> F:
+    """Register a function that can be imported by generated code.
+
+    When code is generated for a matcher, a :class:`CustomConstraint` with a registered function is inlined as a direct
+    call of the imported function. The same goes for the replacements in the code generated for a
+    :class:`.ManyToOneReplacer`:
+
+    >>> def is_symbol(x):
+    ...     return isinstance(x, Symbol)
+    >>> is_symbol = register_importable(is_symbol, 'mypackage.predicates.is_symbol')
+    >>> CustomConstraint(is_symbol).generate_code('subst')
+    ("is_symbol(x=subst['x'])", {'from mypackage.predicates import is_symbol'})
+
+    Functions defined at the top level of a module can also be registered with a decorator without a path.
+
+    Args:
+        function:
+            The function to register.
+        path:
+            The full path to import the function from, e.g. ``'package.module.function'``. Defaults to the module and
+            name of the function, which only works for functions defined at the top level of a module.
+
+    Returns:
+        The function itself.
+
+    Raises:
+        ValueError:
+            If the path is invalid or the function is not defined at the top level of a module and no path is given.
+    """
+    if path is None:
+        name = getattr(function, '__name__', None)
+        if name is None or getattr(function, '__qualname__', None) != name:
+            raise ValueError("The function {!r} is not defined at the top level of a module.".format(function))
+        path = '{}.{}'.format(function.__module__, name)
+    module, _, name = path.rpartition('.')
+    if not module or not name.isidentifier():
+        raise ValueError("Invalid import path {!r}.".format(path))
+    _importable_functions[function] = (module, name)
+    return function
+
+
+def _import_code(function: Callable) -> Optional[Tuple[str, str]]:
+    """Return the name and import statement for a function registered with :func:`register_importable`."""
+    try:
+        module, name = _importable_functions[function]
+    except (KeyError, TypeError):
+        return None
+    if sum(1 for _, other_name in _importable_functions.values() if other_name == name) == 1:
+        return name, 'from {} import {}'.format(module, name)
+    alias = '{}_{}'.format(module.replace('.', '_'), name)
+    return alias, 'from {} import {} as {}'.format(module, name, alias)
+
+
+def _replace_names(source: str, replacements: Dict[str, str]) -> str:
+    """Replace the names in the Python source, except for attributes and keyword arguments with the same name."""
+    line_offsets = [0]
+    for line in source.splitlines(True):
+        line_offsets.append(line_offsets[-1] + len(line))
+    tokens = [t for t in tokenize.generate_tokens(io.StringIO(source).readline) if t.type != tokenize.COMMENT]
+    parts = []
+    last_end = 0
+    for i, token in enumerate(tokens):
+        if token.type != tokenize.NAME or token.string not in replacements:
+            continue
+        if i > 0 and tokens[i - 1].string == '.' or i + 1 < len(tokens) and tokens[i + 1].string == '=':
+            continue
+        start = line_offsets[token.start[0] - 1] + token.start[1]
+        parts.append(source[last_end:start])
+        parts.append(replacements[token.string])
+        last_end = start + len(token.string)
+    parts.append(source[last_end:])
+    return ''.join(parts)
 
 
 class Constraint(object):  # pylint: disable=too-few-public-methods
@@ -77,6 +161,23 @@ class Constraint(object):  # pylint: disable=too-few-public-methods
         """
         return frozenset()
 
+    def generate_code(self, subst_name: str) -> Optional[Tuple[str, Set[str]]]:
+        """Generate Python code which checks the constraint.
+
+        This is used by the :class:`.CodeGenerator` to inline the constraint in the generated code. Override this in
+        your subclass to make your constraint faster in generated code.
+
+        Args:
+            subst_name:
+                The name of the variable which holds the match substitution in the generated code.
+
+        Returns:
+            A tuple of a Python expression which is true iff the constraint is fulfilled and the import statements
+            needed by the expression. Or `None`, if the constraint cannot be inlined. Then its :func:`repr` is called
+            with the substitution instead.
+        """
+        return None
+
     def with_renamed_vars(self, renaming: Dict[str, str]) -> 'Constraint':  # pylint: disable=missing-raises-doc
         """Return a *copy* of the constraint with renamed variables.
         This is called when the variables in the expression are renamed and hence the ones in the constraint have to be
@@ -119,6 +220,19 @@ class EqualVariablesConstraint(Constraint):  # pylint: disable=too-few-public-me
                 return False
         return True
 
+    def generate_code(self, subst_name):
+        values = ['{}[{!r}]'.format(subst_name, name) for name in sorted(self._variables)]
+        if len(values) < 2:
+            return 'True', set()
+        # Only the unordered values of commutative sequence variables need the full unification
+        code = '{} or ({}) and EqualVariablesConstraint({})({})'.format(
+            ' == '.join(values), ' or '.join('isinstance({}, Multiset)'.format(v) for v in values),
+            ', '.join(map(repr, sorted(self._variables))), subst_name
+        )
+        return code, {
+            'from multiset import Multiset', 'from matchpy.expressions.constraints import EqualVariablesConstraint'
+        }
+
     def __str__(self):
         return '({!s})'.format(' == '.join(sorted(self._variables)))
 
@@ -189,6 +303,24 @@ class CustomConstraint(Constraint):  # pylint: disable=too-few-public-methods
 
         return self.constraint(**args)
 
+    def generate_code(self, subst_name):
+        import_code = _import_code(self.constraint)
+        if import_code is not None:
+            name, import_statement = import_code
+            arguments = ', '.join('{}={}[{!r}]'.format(p, subst_name, v) for p, v in self._variables.items())
+            return '{}({})'.format(name, arguments), {import_statement}
+        if getattr(self.constraint, '__name__', None) != '<lambda>':
+            return None
+        source = get_short_lambda_source(self.constraint)
+        if source is None:
+            return None
+        replacements = dict((p, '{}[{!r}]'.format(subst_name, v)) for p, v in self._variables.items())
+        try:
+            code = _replace_names(source, replacements)
+        except (tokenize.TokenError, IndentationError):
+            return None
+        return '({})'.format(code), set()
+
     def _get_name(self):
         try:
             return get_short_lambda_source(self.constraint) or self.constraint.__name__
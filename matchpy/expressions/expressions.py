@@ -415,6 +415,42 @@ class Operation(Expression, metaclass=_OperationMeta):
                 operand_count += 1
         return operand_count, variable
 
+    @classmethod
+    def from_canonical(cls, operands: List[Expression], variable_name=None) -> 'Operation':
+        """Create an operation expression from operands that are already in canonical form.
+
+        This is a faster alternative to calling the operation type for operands that are known to be valid, e.g. when
+        rebuilding an existing operation with a modified operand. The operands are neither flattened, sorted nor
+        checked against the arity:
+
+        >>> Times = Operation.new('*', Arity.polyadic, 'Times', commutative=True)
+        >>> Times.from_canonical([a, b]) == Times(b, a)
+        True
+
+        Hence, the caller has to make sure that the operands are in the same form as if they were passed to the
+        operation type: The operands of an associative operation must not contain nested operations of the same type,
+        the operands of a commutative operation must be sorted, a one_identity operation must not have a single operand
+        that would replace it and the number of operands must match the arity. Otherwise, the resulting expression will
+        not compare equal to the same expression created normally.
+
+        Args:
+            operands:
+                The operands for the operation expression. The list is used directly and must not be modified
+                afterwards.
+            variable_name:
+                The optional variable name of the operation expression.
+
+        Returns:
+            The operation expression.
+        """
+        operation = Expression.__new__(cls)
+        if cls.__init__ is Operation.__init__:
+            operation.variable_name = variable_name
+            operation.operands = operands
+        else:
+            operation.__init__(operands, variable_name=variable_name)
+        return operation
+
     def __str__(self):
         if self.infix:
             separator = ' {!s} '.format(self.name) if self.name else ''
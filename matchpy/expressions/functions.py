@@ -1,4 +1,5 @@
-from typing import Dict
+from bisect import bisect_left, bisect_right
+from typing import Callable, Dict, Optional, Tuple
 
 from .expressions import (
     Expression, Operation, Wildcard, AssociativeOperation, CommutativeOperation, SymbolWildcard, Pattern, OneIdentityOperation
@@ -7,7 +8,8 @@ from .expressions import (
 __all__ = [
     'is_constant', 'is_syntactic', 'get_head', 'match_head', 'preorder_iter', 'preorder_iter_with_position',
     'is_anonymous', 'contains_variables_from_set', 'register_operation_factory', 'create_operation_expression',
-    'rename_variables', 'op_iter', 'op_len', 'register_operation_iterator', 'get_variables'
+    'operation_factory', 'replace_operand', 'rename_variables', 'op_iter', 'op_len', 'register_operation_iterator',
+    'get_variables'
 ]
 
 
@@ -154,40 +156,155 @@ _operation_iterators = {
     dict: (lambda d: d.items(), len),
 }
 
+# The factory and iterators for every type that was used, so that the MRO does not need to be searched every time.
+# They are cleared whenever a new factory or iterator is registered, because it can apply to subclasses.
+_resolved_factories = {}  # type: Dict[type, Optional[Callable]]
+_resolved_iterators = {}  # type: Dict[type, Tuple[Callable, Callable]]
+# Whether a type is a subclass of Operation and whether its operands are simplified, see _operation_kind().
+_operation_kinds = {}  # type: Dict[type, int]
+_NO_OPERATION = 0
+_PLAIN_OPERATION = 1
+_SIMPLIFIED_OPERATION = 2
+
 
 def register_operation_factory(operation, factory):
     _operation_factories[operation] = factory
+    _resolved_factories.clear()
 
 
 def register_operation_iterator(operation, iterator=iter, length=len):
     _operation_iterators[operation] = (iterator, length)
+    _resolved_iterators.clear()
+
+
+def _resolve_factory(operation: type) -> Optional[Callable]:
+    try:
+        return _resolved_factories[operation]
+    except KeyError:
+        factory = next((_operation_factories[p] for p in operation.__mro__ if p in _operation_factories), None)
+        _resolved_factories[operation] = factory
+        return factory
+
+
+def _resolve_iterators(operation: type) -> Tuple[Callable, Callable]:
+    try:
+        return _resolved_iterators[operation]
+    except KeyError:
+        iterators = next(
+            (_operation_iterators[p] for p in operation.__mro__ if p in _operation_iterators), (iter, len)
+        )
+        _resolved_iterators[operation] = iterators
+        return iterators
+
+
+def _operation_kind(operation: type) -> int:
+    """Return whether the type is a subclass of Operation whose operands are simplified when it is created."""
+    try:
+        return _operation_kinds[operation]
+    except KeyError:
+        if not issubclass(operation, Operation):
+            kind = _NO_OPERATION
+        elif operation.associative or operation.commutative or operation.one_identity:
+            kind = _SIMPLIFIED_OPERATION
+        else:
+            kind = _PLAIN_OPERATION
+        _operation_kinds[operation] = kind
+        return kind
+
+
+def _create_plain_operation(operation, operands, variable_name):
+    # Simplifying the operands would not change them, so only the arity is checked
+    new_operation = Expression.__new__(operation)
+    new_operation.__init__(operands, variable_name=variable_name)
+    return new_operation
 
 
 def create_operation_expression(old_operation, new_operands, variable_name=True):
     operation = type(old_operation)
-    for parent in operation.__mro__:
-        if parent in _operation_factories:
-            return _operation_factories[parent](old_operation, new_operands, variable_name)
+    factory = _resolve_factory(operation)
+    if factory is not None:
+        return factory(old_operation, new_operands, variable_name)
     if variable_name is True:
         variable_name = getattr(old_operation, 'variable_name', None)
     if variable_name is False:
         return operation(*new_operands)
+    if _operation_kind(operation) == _PLAIN_OPERATION:
+        return _create_plain_operation(operation, list(new_operands), variable_name)
     return operation(*new_operands, variable_name=variable_name)
 
 
+def operation_factory(old_operation, variable_name=True):
+    """Return a function that creates an operation like *old_operation* from a list of new operands.
+
+    Calling the result is equivalent to :func:`create_operation_expression`, but the factory is only looked up once.
+    For operations that are neither associative, commutative nor have one_identity, the operands are already in
+    canonical form, so they are not simplified again.
+    """
+    operation = type(old_operation)
+    factory = _resolve_factory(operation)
+    if factory is not None:
+        return lambda new_operands: factory(old_operation, new_operands, variable_name)
+    if variable_name is True:
+        variable_name = getattr(old_operation, 'variable_name', None)
+    if variable_name is False:
+        return lambda new_operands: operation(*new_operands)
+    if _operation_kind(operation) == _PLAIN_OPERATION:
+        return lambda new_operands: _create_plain_operation(operation, list(new_operands), variable_name)
+    return lambda new_operands: operation(*new_operands, variable_name=variable_name)
+
+
+def _is_single_operand(operand):
+    """Whether the operand counts as exactly one operand for the arity of an operation."""
+    return not isinstance(operand, Wildcard) or (operand.fixed_size and operand.min_count == 1)
+
+
+def replace_operand(old_operation, index, new_operand):
+    """Return a copy of *old_operation* where the operand at *index* is replaced by *new_operand*.
+
+    This is equivalent to :func:`create_operation_expression` with the modified list of operands, but the other
+    operands are known to be in canonical form already. Hence, the new operand is inserted into the sorted operands of
+    a commutative operation with a binary search instead of sorting all of them again:
+
+    >>> f_c = Operation.new('f_c', Arity.variadic, commutative=True)
+    >>> print(replace_operand(f_c(a, b, c), 0, x_))
+    f_c(b, c, x_)
+
+    If the operation needs to be simplified otherwise, e.g. because the new operand has to be flattened into an
+    associative operation, or if it has a registered factory or iterator, it is created normally.
+    """
+    operation = type(old_operation)
+    if (
+        _operation_kind(operation) == _NO_OPERATION or _resolve_factory(operation) is not None or
+        _resolve_iterators(operation) != (iter, len) or
+        not _is_single_operand(new_operand) or not _is_single_operand(old_operation.operands[index]) or
+        (operation.associative and isinstance(new_operand, operation))
+    ):
+        operands = list(op_iter(old_operation))
+        operands[index] = new_operand
+        return create_operation_expression(old_operation, operands)
+    operands = list(old_operation.operands)
+    if operation.commutative:
+        del operands[index]
+        # Among equal operands, the new one stays in its position, just like when sorting all operands
+        low = bisect_left(operands, new_operand)
+        high = bisect_right(operands, new_operand, low)
+        operands.insert(min(max(index, low), high), new_operand)
+    else:
+        operands[index] = new_operand
+    return operation.from_canonical(operands, old_operation.variable_name)
+
+
 def op_iter(operation):
-    op_type = type(operation)
-    for parent in op_type.__mro__:
-        if parent in _operation_iterators:
-            iterator, _ = _operation_iterators[parent]
-            return iterator(operation)
-    return iter(operation)
+    try:
+        iterator = _resolved_iterators[type(operation)][0]
+    except KeyError:
+        iterator = _resolve_iterators(type(operation))[0]
+    return iterator(operation)
 
 
 def op_len(operation):
-    op_type = type(operation)
-    for parent in op_type.__mro__:
-        if parent in _operation_iterators:
-            _, length = _operation_iterators[parent]
-            return length(operation)
-    return len(operation)
+    try:
+        length = _resolved_iterators[type(operation)][1]
+    except KeyError:
+        length = _resolve_iterators(type(operation))[1]
+    return length(operation)
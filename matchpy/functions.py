@@ -2,6 +2,7 @@
 """This module contains various functions for working with expressions.
 
 - With `substitute()` you can replace occurrences of variables with an expression or sequence of expressions.
+  Use `compile_template()` to speed this up if the same expression is substituted many times.
 - With `replace()` you can replace a subexpression at a specific position with a different expression or
   sequence of expressions.
 - With `replace_many()` works the same as `replace()`, but you can replace multiple positions at once.
@@ -11,7 +12,7 @@
 
 import itertools
 import math
-from typing import Callable, List, NamedTuple, Sequence, Tuple, Union, Iterable
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple, Union, Iterable
 
 from multiset import Multiset
 
@@ -19,10 +20,16 @@ from .expressions.expressions import (
     Expression, Operation, Pattern, Wildcard, SymbolWildcard, AssociativeOperation, CommutativeOperation
 )
 from .expressions.substitution import Substitution
-from .expressions.functions import preorder_iter_with_position, create_operation_expression, op_iter, op_len
+from .expressions.functions import (
+    preorder_iter_with_position, create_operation_expression, op_iter, op_len, operation_factory, get_variables,
+    replace_operand
+)
 from .matching.one_to_one import match
 
-__all__ = ['substitute', 'replace', 'replace_all', 'replace_many', 'is_match', 'ReplacementRule']
+__all__ = [
+    'substitute', 'compile_template', 'SubstitutionTemplate', 'replace', 'replace_all', 'replace_many', 'is_match',
+    'ReplacementRule'
+]
 
 Replacement = Union[Expression, List[Expression]]
 
@@ -75,24 +82,161 @@ def _substitute(expression: Expression, substitution: Substitution) -> Tuple[Rep
     if getattr(expression, 'variable_name', False) and expression.variable_name in substitution:
         return substitution[expression.variable_name], True
     elif isinstance(expression, Operation):
-        any_replaced = False
+        replaced_count = 0
+        single_replacement = True
         new_operands = []
-        for operand in op_iter(expression):
+        for index, operand in enumerate(op_iter(expression)):
             result, replaced = _substitute(operand, substitution)
             if replaced:
-                any_replaced = True
+                replaced_count += 1
+                replaced_index = index
             if isinstance(result, Expression):
                 new_operands.append(result)
-            elif isinstance(result, Multiset):
-                new_operands.extend(sorted(result))
             else:
-                new_operands.extend(result)
-        if any_replaced:
+                single_replacement = False
+                if isinstance(result, Multiset):
+                    new_operands.extend(sorted(result))
+                else:
+                    new_operands.extend(result)
+        if replaced_count == 1 and single_replacement:
+            # The other operands are still in canonical form
+            return replace_operand(expression, replaced_index, new_operands[replaced_index]), True
+        if replaced_count:
             return create_operation_expression(expression, new_operands), True
 
     return expression, False
 
 
+_CompiledTemplate = Callable[[Substitution], Tuple[Replacement, bool]]
+
+
+class SubstitutionTemplate:
+    """An expression that is prepared for substituting its variables many times, see :func:`compile_template`.
+
+    Attributes:
+        expression:
+            The original expression.
+        variables:
+            The names of the variables in the expression.
+    """
+
+    __slots__ = ('expression', 'variables', '_compiled')
+
+    def __init__(self, expression: Expression) -> None:
+        self.expression = expression
+        self.variables = frozenset(get_variables(expression))
+        self._compiled = self._compile(expression)
+
+    def substitute(self, substitution: Substitution) -> Replacement:
+        """Replace the variables in the template using the given *substitution*, just like :func:`substitute`."""
+        if self._compiled is None:
+            return self.expression
+        return self._compiled(substitution)[0]
+
+    def __call__(self, **substitution) -> Replacement:
+        return self.substitute(substitution)
+
+    def __repr__(self):
+        return 'compile_template({!r})'.format(self.expression)
+
+    @classmethod
+    def _compile(cls, expression: Expression) -> Optional[_CompiledTemplate]:
+        """Return a function that does the substitution for the expression or None if it contains no variables."""
+        compiled = None
+        if isinstance(expression, Operation):
+            operands = list(op_iter(expression))
+            compiled_operands = [cls._compile(operand) for operand in operands]
+            if any(c is not None for c in compiled_operands):
+                compiled = cls._compile_operation(expression, operands, compiled_operands)
+        variable_name = getattr(expression, 'variable_name', None)
+        if variable_name:
+            compiled = cls._compile_variable(expression, variable_name, compiled)
+        return compiled
+
+    @staticmethod
+    def _compile_variable(expression: Expression, variable_name: str,
+                          compiled: Optional[_CompiledTemplate]) -> _CompiledTemplate:
+        def substitute_variable(substitution):
+            if variable_name in substitution:
+                return substitution[variable_name], True
+            if compiled is not None:
+                return compiled(substitution)
+            return expression, False
+
+        return substitute_variable
+
+    @staticmethod
+    def _compile_operation(expression: Expression, operands: List[Expression],
+                           compiled_operands: List[Optional[_CompiledTemplate]]) -> _CompiledTemplate:
+        # Consecutive constant operands are added to the new operands at once
+        parts = []  # type: List[Union[Tuple[Expression, ...], _CompiledTemplate]]
+        for operand, compiled in zip(operands, compiled_operands):
+            if compiled is not None:
+                parts.append(compiled)
+            elif parts and isinstance(parts[-1], tuple):
+                parts[-1] += (operand, )
+            else:
+                parts.append((operand, ))
+        create = operation_factory(expression)
+
+        def substitute_operation(substitution):
+            any_replaced = False
+            new_operands = []
+            for part in parts:
+                if isinstance(part, tuple):
+                    new_operands.extend(part)
+                    continue
+                result, replaced = part(substitution)
+                if replaced:
+                    any_replaced = True
+                if isinstance(result, Expression):
+                    new_operands.append(result)
+                elif isinstance(result, Multiset):
+                    new_operands.extend(sorted(result))
+                else:
+                    new_operands.extend(result)
+            if any_replaced:
+                return create(new_operands), True
+            return expression, False
+
+        return substitute_operation
+
+
+def compile_template(expression: Union[Expression, Pattern]) -> SubstitutionTemplate:
+    """Prepare the given *expression* for substituting its variables many times.
+
+    The result can be used instead of :func:`substitute`, but it does not need to traverse the whole expression
+    every time. Only the operations that contain variables are created again, subexpressions without variables are
+    shared between the results:
+
+    >>> template = compile_template(f(x_, f(a, b)))
+    >>> print(template.substitute({'x': c}))
+    f(c, f(a, b))
+    >>> template.substitute({'x': c})[1] is template.expression[1]
+    True
+
+    Operations that are not associative, commutative or one_identity are also not simplified again, because their
+    operands are already in canonical form. The template can be used directly as the replacement of a
+    :class:`ReplacementRule`, because calling it with the substitution as keyword arguments substitutes them:
+
+    >>> print(template(x=[a, b]))
+    f(a, b, f(a, b))
+
+    Note that the factories registered with :func:`.register_operation_factory` are looked up when the template is
+    compiled and not every time it is substituted.
+
+    Parameters:
+        expression:
+            An expression in which variables are substituted.
+
+    Returns:
+        The compiled template.
+    """
+    if isinstance(expression, Pattern):
+        expression = expression.expression
+    return SubstitutionTemplate(expression)
+
+
 def replace(expression: Expression, position: Sequence[int], replacement: Replacement) -> Replacement:
     r"""Replaces the subexpression of `expression` at the given `position` with the given `replacement`.
 
@@ -131,8 +275,7 @@ def replace(expression: Expression, position: Sequence[int], replacement: Replac
     if isinstance(subexpr, Sequence):
         new_operands = tuple(operands[:pos]) + tuple(subexpr) + tuple(operands[pos + 1:])
         return create_operation_expression(expression, new_operands)
-    operands[pos] = subexpr
-    return create_operation_expression(expression, operands)
+    return replace_operand(expression, pos, subexpr)
 
 
 def replace_many(expression: Expression, replacements: Sequence[Tuple[Sequence[int], Replacement]]) -> Replacement:
@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
-"""Contains various patter matching algorithms in the submodules."""
+"""Contains various patter matching algorithms in the submodules.
 
-from . import many_to_one
-from . import bipartite
-from . import one_to_one
-from . import syntactic
+The submodules are only imported once one of their names is accessed, so that importing e.g. only the
+:mod:`~matchpy.matching.one_to_one` matching does not load the :mod:`~matchpy.matching.many_to_one` automata and its
+dependencies.
+"""
+from .._lazy import attach as _attach
 
-# pylint: disable=wildcard-import
-from .many_to_one import *
-from .bipartite import *
-from .one_to_one import *
-from .syntactic import *
-
-__all__ = many_to_one.__all__ + bipartite.__all__ + one_to_one.__all__ + syntactic.__all__
+__getattr__, __dir__, __all__ = _attach(
+    __name__, {
+        'many_to_one': ['ManyToOneMatcher', 'ManyToOneReplacer', 'TransitionProfile'],
+        'bipartite': ['BipartiteGraph', 'enum_maximum_matchings_iter'],
+        'budget': ['MatchBudget', 'MatchBudgetExceeded'],
+        'one_to_one': ['match', 'match_anywhere'],
+        'syntactic': ['FlatTerm', 'is_operation', 'is_symbol_wildcard', 'DiscriminationNet', 'SequenceMatcher'],
+    }
+)
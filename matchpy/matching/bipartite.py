@@ -5,9 +5,11 @@ The `BipartiteGraph` class is used to represent a bipartite graph as a dictionar
 `BipartiteGraph.find_matching()` can be used to find a maximum matching in such a graph.
 
 The function `enum_maximum_matchings_iter` can be used to enumerate all maximum matchings of a `BipartiteGraph`.
+If some of the nodes are interchangeable, it can also enumerate only one canonical matching for every set of
+matchings that are equal up to a permutation of those nodes.
 """
 
-from typing import (Dict, Generic, Hashable, Iterator, List, Set, Tuple, TypeVar, Union, cast, MutableMapping)
+from typing import (Dict, Generic, Hashable, Iterable, Iterator, List, Set, Tuple, TypeVar, Union, cast, MutableMapping)
 
 try:
     from graphviz import Digraph, Graph
@@ -15,6 +17,8 @@ except ImportError:
     Digraph = Graph = None
 from hopcroftkarp import HopcroftKarp
 
+from ..utils import fixed_integer_vector_iter
+
 __all__ = ['BipartiteGraph', 'enum_maximum_matchings_iter']
 
 T = TypeVar('T')
@@ -76,12 +80,28 @@ class BipartiteGraph(Generic[TLeft, TRight, TEdgeValue], MutableMapping[Tuple[TL
         if not isinstance(key, tuple) or len(key) != 2:
             raise TypeError("The edge must be a 2-tuple")
         self._edges.__delitem__(key)
-        if all(l != key[0] for (l, _) in self._edges):
+        left_neighbours = self._graph[(LEFT, key[0])]
+        right_neighbours = self._graph[(RIGHT, key[1])]
+        left_neighbours.remove((RIGHT, key[1]))
+        right_neighbours.remove((LEFT, key[0]))
+        if not left_neighbours:
             self._left.remove(key[0])
-        if all(r != key[1] for (_, r) in self._edges):
+        if not right_neighbours:
             self._right.remove(key[1])
-        self._graph[(LEFT, key[0])].remove((RIGHT, key[1]))
-        self._graph[(RIGHT, key[1])].remove((LEFT, key[0]))
+
+    def right_neighbours(self, left: TLeft) -> List[TRight]:
+        """Returns the right nodes that the given left node has an edge to."""
+        return [right for _, right in self._graph.get((LEFT, left), ())]
+
+    def remove_left_node(self, left: TLeft) -> None:
+        """Removes the given left node together with all its edges. Nothing happens if the node has no edges."""
+        for _, right in self._graph.pop((LEFT, left), ()):
+            del self._edges[left, right]
+            right_neighbours = self._graph[(RIGHT, right)]
+            right_neighbours.remove((LEFT, left))
+            if not right_neighbours:
+                self._right.remove(right)
+        self._left.discard(left)
 
     def edges_with_labels(self):
         """Returns a view on the edges with labels."""
@@ -258,7 +278,45 @@ class _DirectedMatchGraph(Dict[Node, NodeSet], Generic[TLeft, TRight]):
         return cast(NodeList, [])
 
 
-def enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue]) -> Iterator[Dict[TLeft, TRight]]:
+def enum_maximum_matchings_iter(
+        graph: BipartiteGraph[TLeft, TRight, TEdgeValue],
+        left_classes: Dict[TLeft, Hashable]=None,
+        right_classes: Dict[TRight, Hashable]=None
+) -> Iterator[Dict[TLeft, TRight]]:
+    """Enumerate the maximum matchings of the bipartite graph.
+
+    Nodes can optionally be grouped into equivalence classes. All nodes of a class must be interchangeable, i.e. be
+    connected to exactly the same nodes of the other part. In that case, matchings that only differ by permuting nodes
+    within their class are considered equal and only one canonical representative is yielded for them:
+
+    >>> graph = BipartiteGraph(((l, r), True) for l in range(3) for r in 'ab')
+    >>> len(list(enum_maximum_matchings_iter(graph)))
+    6
+    >>> list(enum_maximum_matchings_iter(graph, right_classes={'a': 0, 'b': 0}))
+    [{1: 'a', 2: 'b'}, {0: 'a', 2: 'b'}, {0: 'a', 1: 'b'}]
+
+    Within a class, the canonical matching uses the nodes in the order in which they first appear in the graph.
+
+    Args:
+        graph:
+            The bipartite graph.
+        left_classes:
+            An optional mapping from left nodes to their equivalence class. Nodes without a class are only
+            equivalent to themselves.
+        right_classes:
+            An optional mapping from right nodes to their equivalence class. Nodes without a class are only
+            equivalent to themselves.
+
+    Yields:
+        The maximum matchings as dictionaries mapping left nodes to right nodes.
+
+    Raises:
+        ValueError:
+            If nodes of the same class are not interchangeable.
+    """
+    if left_classes or right_classes:
+        yield from _enum_canonical_matchings_iter(graph, left_classes or {}, right_classes or {})
+        return
     matching = graph.find_matching()
     if matching:
         yield matching
@@ -266,6 +324,78 @@ def enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue]
         yield from _enum_maximum_matchings_iter(graph, matching, _DirectedMatchGraph(graph, matching))
 
 
+def _group_nodes(nodes: Iterable[T], classes: Dict[T, Hashable]) -> List[List[T]]:
+    groups = {}  # type: Dict[Tuple[bool, Hashable], List[T]]
+    for node in nodes:
+        key = (True, classes[node]) if node in classes else (False, node)
+        groups.setdefault(key, []).append(node)
+    return list(groups.values())
+
+
+def _enum_canonical_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue],
+                                   left_classes: Dict[TLeft, Hashable],
+                                   right_classes: Dict[TRight, Hashable]) -> Iterator[Dict[TLeft, TRight]]:
+    # The equivalent nodes are merged into a single node with a capacity. Then all ways to distribute the matching
+    # edges among the merged nodes are enumerated as integer vectors. As the nodes within a class are interchangeable,
+    # every such distribution corresponds to exactly one class of equivalent matchings. The canonical representative
+    # is constructed by using the nodes of each class in order.
+    left_groups = _group_nodes(dict.fromkeys(l for l, _ in graph.edges()), left_classes)
+    right_groups = _group_nodes(dict.fromkeys(r for _, r in graph.edges()), right_classes)
+    left_index = dict((node, i) for i, group in enumerate(left_groups) for node in group)
+    right_index = dict((node, j) for j, group in enumerate(right_groups) for node in group)
+
+    group_edge_counts = {}  # type: Dict[Tuple[int, int], int]
+    for left, right in graph.edges():
+        group_edge = (left_index[left], right_index[right])
+        group_edge_counts[group_edge] = group_edge_counts.get(group_edge, 0) + 1
+    adjacency = [[] for _ in right_groups]  # type: List[List[int]]
+    for (i, j), count in sorted(group_edge_counts.items()):
+        if count != len(left_groups[i]) * len(right_groups[j]):
+            raise ValueError("Nodes in the same equivalence class must be connected to the same nodes.")
+        adjacency[j].append(i)
+
+    size = len(graph.find_matching())
+    if size == 0:
+        return
+
+    right_sizes = [len(group) for group in right_groups]
+    left_capacities = [len(group) for group in left_groups]
+    for distribution in _group_distributions_iter(adjacency, right_sizes, left_capacities, 0, size, []):
+        left_used = [0] * len(left_groups)
+        right_used = [0] * len(right_groups)
+        matching = {}
+        for j, i, count in distribution:
+            lefts = left_groups[i][left_used[i]:left_used[i] + count]
+            rights = right_groups[j][right_used[j]:right_used[j] + count]
+            matching.update(zip(lefts, rights))
+            left_used[i] += count
+            right_used[j] += count
+        yield matching
+
+
+def _group_distributions_iter(adjacency, right_sizes, left_capacities, index, missing, distribution):
+    if missing == 0:
+        yield list(distribution)
+        return
+    if index == len(adjacency) or sum(right_sizes[index:]) < missing:
+        return
+    groups = adjacency[index]
+    capacities = [left_capacities[i] for i in groups]
+    for total in range(min(right_sizes[index], sum(capacities), missing), -1, -1):
+        for counts in fixed_integer_vector_iter(capacities, total):
+            for i, count in zip(groups, counts):
+                if count:
+                    left_capacities[i] -= count
+                    distribution.append((index, i, count))
+            yield from _group_distributions_iter(
+                adjacency, right_sizes, left_capacities, index + 1, missing - total, distribution
+            )
+            for i, count in zip(groups, counts):
+                if count:
+                    left_capacities[i] += count
+                    distribution.pop()
+
+
 def _enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue], matching: Dict[TLeft, TRight],
                                  directed_match_graph: _DirectedMatchGraph[TLeft, TRight]) \
         -> Iterator[Dict[TLeft, TRight]]:
@@ -343,6 +473,7 @@ def _enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue
         # left1 must be in the left part of the graph and in matching
         # right must be in the right part of the graph
         # left2 is also in the left part of the graph and but must not be in matching
+        # If there is no such path, look for a path right2 -> left -> right1 instead, where right2 is not in matching
         left1 = None  # type: TLeft
         left2 = None  # type: TLeft
         right = None  # type: TRight
@@ -359,20 +490,39 @@ def _enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue
                     if left2 is not None:
                         break
 
-        if left2 is None:
-            return
+        if left2 is not None:
+            # Construct M'
+            # Exchange the direction of the path left1 -> right -> left2
+            # to left1 <- right <- left2 in the new matching
+            new_match = matching.copy()
+            del new_match[left1]
+            new_match[left2] = right
+            edge = (left2, right)
+        else:
+            matched_rights = set(matching.values())
+            right = None
+            for part2, node2 in directed_match_graph:
+                if part2 == RIGHT and node2 not in matched_rights:
+                    for _, node1 in directed_match_graph[(RIGHT, node2)]:
+                        if node1 in matching:
+                            left1 = cast(TLeft, node1)
+                            right = cast(TRight, node2)
+                            break
+                    if right is not None:
+                        break
+
+            if right is None:
+                return
 
-        # Construct M'
-        # Exchange the direction of the path left1 -> right -> left2
-        # to left1 <- right <- left2 in the new matching
-        new_match = matching.copy()
-        del new_match[left1]
-        new_match[left2] = right
+            # Construct M'
+            # Exchange the direction of the path right -> left1 -> right1
+            # to right <- left1 <- right1 in the new matching
+            new_match = matching.copy()
+            new_match[left1] = right
+            edge = (left1, right)
 
         yield new_match
 
-        edge = (left2, right)
-
         # Construct G+(e) and G-(e)
         graph_plus = graph.without_nodes(edge)
         graph_minus = graph.without_edge(edge)
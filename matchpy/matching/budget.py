@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Contains the :class:`MatchBudget` which can be used to limit the work done during matching.
+
+Matching with commutative operations and sequence variables can take exponential time for some subjects. To bound
+the time spent, all matching functions accept the *max_steps*, *max_results* and *deadline* arguments:
+
+>>> pattern = Pattern(f(Wildcard.star('x'), Wildcard.star('y')))
+>>> subject = f(*map(Symbol, 'abcdefghij'))
+>>> len(list(match(subject, pattern)))
+11
+>>> len(list(match(subject, pattern, max_results=3)))
+3
+>>> list(match(subject, pattern, max_steps=5))
+Traceback (most recent call last):
+...
+matchpy.matching.budget.MatchBudgetExceeded: The matching exceeded its maximum number of steps.
+
+Once the maximum number of results is reached, the matching just stops. Exceeding the maximum number of steps or the
+deadline raises a :class:`MatchBudgetExceeded` instead, after all the results found so far have been yielded.
+
+The budget is also used to run the matching in the background for :mod:`asyncio`, see :meth:`MatchBudget.alimit`.
+Then the matching is stopped at its next step once it gets cancelled.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable, Iterable, Iterator, Optional, TypeVar
+
+__all__ = ['MatchBudget', 'MatchBudgetExceeded']
+
+T = TypeVar('T')
+
+_active = threading.local()
+# The number of budgets active in any thread, so that counting steps is cheap when there are none.
+_active_count = 0
+_active_count_lock = threading.Lock()
+
+
+class MatchBudgetExceeded(Exception):
+    """Raised when the matching exceeds the maximum number of steps or its deadline.
+
+    Attributes:
+        budget:
+            The budget that was exceeded.
+        result:
+            A partial result, if the operation that was interrupted can provide one. For example, this is the expression
+            with the replacements done so far for :meth:`.ManyToOneReplacer.replace`.
+    """
+
+    def __init__(self, message: str, budget: 'MatchBudget', result=None) -> None:
+        super(MatchBudgetExceeded, self).__init__(message)
+        self.budget = budget
+        self.result = result
+
+
+class MatchBudget(object):
+    """The limits for a matching operation and the work already done towards them.
+
+    A step is a unit of work during matching, e.g. trying to match a subject against a pattern or trying a way of
+    distributing the operands of a commutative subject among the variables of a pattern.
+
+    Attributes:
+        max_steps:
+            The maximum number of steps or `None` if unlimited.
+        max_results:
+            The maximum number of results or `None` if unlimited.
+        deadline:
+            The point in time as returned by :func:`time.monotonic` at which to stop matching or `None` if unlimited.
+        steps:
+            The number of steps done so far.
+        results:
+            The number of results yielded so far.
+        cancelled:
+            Whether the matching has been cancelled.
+    """
+    __slots__ = ('max_steps', 'max_results', 'deadline', 'steps', 'results', 'cancelled')
+
+    def __init__(self, max_steps: Optional[int]=None, max_results: Optional[int]=None,
+                 deadline: Optional[float]=None) -> None:
+        self.max_steps = max_steps
+        self.max_results = max_results
+        self.deadline = deadline
+        self.steps = 0
+        self.results = 0
+        self.cancelled = False
+
+    @classmethod
+    def create(cls, max_steps: Optional[int]=None, max_results: Optional[int]=None,
+               deadline: Optional[float]=None) -> Optional['MatchBudget']:
+        """Create a budget for the given limits or return `None` if there are no limits."""
+        if max_steps is None and max_results is None and deadline is None:
+            return None
+        return cls(max_steps, max_results, deadline)
+
+    def step(self) -> None:
+        """Count a step and check the limits.
+
+        Raises:
+            MatchBudgetExceeded:
+                If the maximum number of steps or the deadline has been exceeded or the matching was cancelled.
+        """
+        if self.cancelled:
+            raise MatchBudgetExceeded("The matching was cancelled.", self)
+        self.steps += 1
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise MatchBudgetExceeded("The matching exceeded its maximum number of steps.", self)
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise MatchBudgetExceeded("The matching exceeded its deadline.", self)
+
+    def limit(self, iterable: Iterable[T]) -> Iterator[T]:
+        """Iterate over the results of a matching within the limits of this budget.
+
+        While the next result is computed, this budget is active for the current thread, so that the steps of the
+        matching are counted towards it.
+
+        Args:
+            iterable:
+                The results of the matching.
+
+        Yields:
+            The results until the maximum number of results is reached.
+
+        Raises:
+            MatchBudgetExceeded:
+                If the maximum number of steps or the deadline has been exceeded.
+        """
+        iterator = iter(iterable)
+        while self.max_results is None or self.results < self.max_results:
+            with self.activate():
+                try:
+                    result = next(iterator)
+                except StopIteration:
+                    return
+            self.results += 1
+            yield result
+
+    async def alimit(self, iterable_factory: Callable[[], Iterable[T]], executor=None,
+                     buffer_size: int=16) -> AsyncIterator[T]:
+        """Asynchronously iterate over the results of a matching within the limits of this budget.
+
+        The matching is done in a thread of the executor, so that it does not block the event loop. Hence, the
+        matcher must not be modified while the matching is running. At most *buffer_size* results are computed
+        ahead of the consumer. When the returned iterator is closed, e.g. because the task of the consumer is
+        cancelled, the matching is stopped at its next step and the results of the *iterable_factory* are closed in
+        the executor thread. If the consumer just stops iterating, the iterator is only closed once it is garbage
+        collected. Until then, the executor thread stays busy, so call ``aclose()`` on the iterator when it is not
+        exhausted and a reference to it is kept.
+
+        Args:
+            iterable_factory:
+                A function that returns the results of the matching. It is called in the executor thread.
+            executor:
+                The executor for the matching. Defaults to the default executor of the event loop.
+            buffer_size:
+                The maximum number of results that are computed ahead.
+
+        Yields:
+            The results until the maximum number of results is reached.
+
+        Raises:
+            MatchBudgetExceeded:
+                If the maximum number of steps or the deadline has been exceeded.
+        """
+        import asyncio
+        loop = asyncio.get_event_loop()
+        results = asyncio.Queue()
+        free_slots = threading.Semaphore(buffer_size)
+        done = object()
+
+        def produce():
+            iterators = []
+            try:
+                iterators.append(iter(iterable_factory()))
+                iterators.append(self.limit(iterators[0]))
+                for result in iterators[1]:
+                    free_slots.acquire()
+                    if self.cancelled:
+                        return
+                    loop.call_soon_threadsafe(results.put_nowait, (result, None))
+            except Exception as e:
+                if not self.cancelled:
+                    loop.call_soon_threadsafe(results.put_nowait, (done, e))
+            else:
+                loop.call_soon_threadsafe(results.put_nowait, (done, None))
+            finally:
+                # Close the generators here instead of leaving it to the garbage collector in some other thread
+                for iterator in reversed(iterators):
+                    close = getattr(iterator, 'close', None)
+                    if close is not None:
+                        close()
+
+        loop.run_in_executor(executor, produce)
+        try:
+            while True:
+                result, error = await results.get()
+                if result is done:
+                    if error is not None:
+                        raise error
+                    return
+                free_slots.release()
+                yield result
+        finally:
+            self.cancelled = True
+            free_slots.release()
+
+    @contextmanager
+    def activate(self) -> Iterator['MatchBudget']:
+        """Make this budget the active one for the current thread within the context."""
+        global _active_count
+        previous = getattr(_active, 'budget', None)
+        _active.budget = self
+        with _active_count_lock:
+            _active_count += 1
+        try:
+            yield self
+        finally:
+            _active.budget = previous
+            with _active_count_lock:
+                _active_count -= 1
+
+
+def step() -> None:
+    """Count a step towards the budget that is active for the current thread, if any.
+
+    Raises:
+        MatchBudgetExceeded:
+            If the active budget has been exceeded.
+    """
+    if _active_count:
+        budget = getattr(_active, 'budget', None)
+        if budget is not None:
+            budget.step()
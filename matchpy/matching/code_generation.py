@@ -1,29 +1,60 @@
-import re
+import inspect
+import time
+from types import FunctionType
+from typing import Any, Dict, FrozenSet, List, NamedTuple, Optional, Set
 
-from ..expressions.expressions import Wildcard, AssociativeOperation, SymbolWildcard
-from ..expressions.constraints import CustomConstraint
+from ..expressions.expressions import Wildcard, AssociativeOperation, SymbolWildcard, Operation, Symbol
+from ..expressions.constraints import _import_code
 from ..expressions.functions import op_iter, get_variables
-from .syntactic import OPERATION_END, is_operation
+from .syntactic import OPERATION_END, is_operation, is_symbol_wildcard
 from .many_to_one import _EPS
 from ..utils import get_short_lambda_source
 
-COLLAPSE_IF_RE = re.compile(r'\n(?P<indent1>\s*)if (?P<cond1>[^\n]+):\n+\1(?P<indent2>\s+)'
-                           r'(?P<comment>(?:\#[^\n]*\n+\1\3)*)'
-                           r'if (?P<cond2>[^\n]+):\n+'
-                           r'(?P<block>\1\3(?P<indent3>\s+)[^\n]*\n+(?:\1\3\7[^\n]*\n+)*)'
-                           r'(?!\1(?:\3|elif|else))')
+CodeGenerationInfo = NamedTuple('CodeGenerationInfo', [
+    ('lines', int),
+    ('characters', int),
+    ('functions', int),
+    ('seconds', float),
+])  # yapf: disable
 
 
 class CodeGenerator:
-    def __init__(self, matcher):
+    """Generates Python code for matching with a :class:`.ManyToOneMatcher`.
+
+    The code for a state is generated inline in the code of its predecessor, so that the generated code is a tree of
+    nested blocks. To keep the generated code compilable for large automata, the code for a state is put into a
+    separate function instead, once the nesting depth or the number of lines of the current function exceeds a limit.
+    Such a function is only generated once for every state and set of patterns that can still match.
+
+    Attributes:
+        max_depth:
+            The maximum indentation depth of the code for a state before it is put into a separate function.
+        max_lines:
+            The maximum number of lines of a function before the code for further states is put into separate
+            functions.
+        info:
+            The size of the generated code and the time it took to generate it, once :meth:`generate_code` is done.
+    """
+
+    def __init__(self, matcher, max_depth: int=16, max_lines: int=2000):
         self._matcher = matcher
+        self.max_depth = max_depth
+        self.max_lines = max_lines
+        self.info = None
         self._var_number = 0
         self._indentation = '\t'
         self._level = 0
-        self._code = ''
+        self._lines = []  # type: List[str]
+        self._function_level = 0
+        self._state_functions = {}
+        self._matcher_classes = {}
+        self._function_count = 1
         self._subjects = ['subjects']
         self._substs = 0
         self._patterns = set(range(len(matcher.patterns)))
+        # The variables bound and the constraints checked on the path to the currently generated code
+        self._bound_variables = frozenset()  # type: FrozenSet[str]
+        self._checked_constraints = frozenset()  # type: FrozenSet[int]
         self._associative = 0
         self._associative_stack = [None]
         self._global_code = []
@@ -37,16 +68,18 @@ class CodeGenerator:
             self._level -= 1
 
     def add_line(self, line):
-        self._code += (self._indentation * self._level) + str(line) + '\n'
+        self._lines.append((self._indentation * self._level) + str(line))
 
     def get_var_name(self, prefix):
         self._var_number += 1
         return prefix + str(self._var_number)
 
     def generate_code(self, func_name='match_root', add_imports=True):
+        start = time.perf_counter()
         self._imports.add('from collections import deque')
         self.add_line('def {}(subject):'.format(func_name))
         self.indent()
+        self._function_level = self._level
         self.add_line('{} = deque([subject]) if subject is not None else deque()'.format(self._subjects[-1]))
         self.add_line('subst{} = Substitution()'.format(self._substs))
         self.generate_state_code(self._matcher.root)
@@ -55,51 +88,60 @@ class CodeGenerator:
         self.dedent()
 
         if add_imports:
-            self._global_code.insert(0, '\n'.join(self._imports))
+            self._global_code.insert(0, '\n'.join(sorted(self._imports)))
 
-        return self.clean_code('\n\n'.join(p for p in self._global_code if p)), self.clean_code(self._code)
+        global_code = '\n\n'.join(p for p in self._global_code if p)
+        code = '\n'.join(self._remove_redundant_passes(self._lines)) + '\n'
+        self.info = CodeGenerationInfo(
+            global_code.count('\n') + code.count('\n') + 1,
+            len(global_code) + len(code), self._function_count, time.perf_counter() - start
+        )
+        return global_code, code
 
     def final_label(self, index, subst_name):
         return str(index)
 
     def generate_state_code(self, state):
-        if state.matcher is not None:
-            self._imports.add('from matchpy.matching.many_to_one import CommutativeMatcher')
-            self._imports.add('from multiset import Multiset')
-            self._imports.add('from matchpy.utils import VariableWithCount')
-            generator = type(self)(state.matcher.automaton)
-            generator.indent()
-            global_code, code = generator.generate_code(func_name='get_match_iter', add_imports=False)
-            self._global_code.append(global_code)
-            patterns = self.commutative_patterns(state.matcher.patterns)
-            subjects = repr(state.matcher.subjects)
-            subjects_by_id = repr(state.matcher.subjects_by_id)
-            associative = self.operation_symbol(state.matcher.associative)
-            max_optional_count = repr(state.matcher.max_optional_count)
-            anonymous_patterns = repr(state.matcher.anonymous_patterns)
-            self._global_code.append('''
-class CommutativeMatcher{0}(CommutativeMatcher):
-\t_instance = None
-\tpatterns = {1}
-\tsubjects = {2}
-\tsubjects_by_id = {7}
-\tbipartite = BipartiteGraph()
-\tassociative = {3}
-\tmax_optional_count = {4}
-\tanonymous_patterns = {5}
-
-\tdef __init__(self):
-\t\tself.add_subject(None)
+        if self._level - self._function_level >= self.max_depth or len(self._lines) >= self.max_lines:
+            self.generate_state_function(state)
+        else:
+            self.generate_state_body(state)
 
-\t@staticmethod
-\tdef get():
-\t\tif CommutativeMatcher{0}._instance is None:
-\t\t\tCommutativeMatcher{0}._instance = CommutativeMatcher{0}()
-\t\treturn CommutativeMatcher{0}._instance
+    def generate_state_function(self, state):
+        """Generate a separate function for the code of the state and a call to it."""
+        associatives = []
+        for i in range(1, self._associative + 1):
+            associatives.extend(('associative{}'.format(i), 'associative_type{}'.format(i)))
+        key = (
+            state.number, frozenset(self._patterns), len(self._subjects), self._associative,
+            tuple(self._associative_stack), self._bound_variables, self._checked_constraints
+        )
+        name = self._state_functions.get(key, None)
+        if name is None:
+            name = self._state_functions[key] = 'match_state{}_{}'.format(state.number, len(self._state_functions))
+            self._function_count += 1
+            outer = self._lines, self._level, self._function_level, self._subjects, self._substs
+            self._lines = []
+            self._level = 0
+            self._subjects = ['subjects_{}'.format(i) for i in range(len(self._subjects))]
+            self._substs = 0
+            self.add_line('def {}({}):'.format(name, ', '.join(self._subjects + ['subst0'] + associatives)))
+            self.indent()
+            self._function_level = self._level
+            self.generate_state_body(state)
+            self.add_line('return')
+            self.add_line('yield')
+            self._global_code.append('\n'.join(self._remove_redundant_passes(self._lines)))
+            self._lines, self._level, self._function_level, self._subjects, self._substs = outer
+        arguments = self._subjects + ['subst{}'.format(self._substs)] + associatives
+        self.add_line('yield from {}({})'.format(name, ', '.join(arguments)))
 
-\t@staticmethod
-{6}'''.strip().format(state.number, patterns, subjects, associative, max_optional_count, anonymous_patterns, code, subjects_by_id))
-            self.add_line('matcher = CommutativeMatcher{}.get()'.format(state.number))
+    def generate_state_body(self, state):
+        if state.matcher is not None:
+            class_name = self._matcher_classes.get(id(state.matcher), None)
+            if class_name is None:
+                class_name = self.generate_commutative_matcher_class(state)
+            self.add_line('matcher = {}.get()'.format(class_name))
             tmp = self.get_var_name('tmp')
             self.add_line('{} = {}'.format(tmp, self._subjects[-1]))
             self.add_line('{} = []'.format(self._subjects[-1]))
@@ -113,6 +155,8 @@ class CommutativeMatcher{0}(CommutativeMatcher):
             self.indent()
             self.add_line('pass')
             for pattern_index, transitions in state.transitions.items():
+                if all(self._patterns.isdisjoint(t.patterns) for t in transitions):
+                    continue
                 self.add_line('if pattern_index == {}:'.format(pattern_index))
                 self.indent()
                 self.add_line('pass')
@@ -123,7 +167,10 @@ class CommutativeMatcher{0}(CommutativeMatcher):
                 constraints = []
                 if variables:
                     constraints = sorted(set.union(*iter(self._matcher.constraint_vars.get(v, set()) for v in variables)))
+                bound_variables = self._bound_variables
+                self._bound_variables = bound_variables.union(variables)
                 self.generate_constraints(constraints, transitions)
+                self._bound_variables = bound_variables
                 self.dedent()
             self.dedent()
             self._substs -= 1
@@ -145,7 +192,54 @@ class CommutativeMatcher{0}(CommutativeMatcher):
             else:
                 for transitions in state.transitions.values():
                     for transition in transitions:
-                        self.generate_transition_code(transition)
+                        # Transitions that cannot lead to the remaining patterns would only duplicate code
+                        if not self._patterns.isdisjoint(transition.patterns):
+                            self.generate_transition_code(transition)
+
+    def generate_commutative_matcher_class(self, state):
+        """Generate the class for the commutative matcher of the state and return its name.
+
+        The class is only generated once for every matcher, even if the state is reached along multiple paths.
+        """
+        self._imports.add('from matchpy.matching.many_to_one import CommutativeMatcher')
+        self._imports.add('from multiset import Multiset')
+        self._imports.add('from matchpy.utils import VariableWithCount')
+        generator = self.create_nested_generator(state.matcher.automaton)
+        generator.indent()
+        global_code, code = generator.generate_code(func_name='get_match_iter', add_imports=False)
+        self._imports.update(generator._imports)
+        self._function_count += generator._function_count
+        self._global_code.append(global_code)
+        patterns = self.commutative_patterns(state.matcher.patterns)
+        associative = self.operation_symbol(state.matcher.associative)
+        max_optional_count = repr(state.matcher.max_optional_count)
+        anonymous_patterns = repr(state.matcher.anonymous_patterns)
+        self._global_code.append('''
+class CommutativeMatcher{0}(CommutativeMatcher):
+\t_instance = None
+\tpatterns = {1}
+\tassociative = {2}
+\tmax_optional_count = {3}
+\tanonymous_patterns = {4}
+
+\tdef __init__(self):
+\t\tself._init_cache()
+\t\tself.add_subject(None)
+
+\t@staticmethod
+\tdef get():
+\t\tif CommutativeMatcher{0}._instance is None:
+\t\t\tCommutativeMatcher{0}._instance = CommutativeMatcher{0}()
+\t\treturn CommutativeMatcher{0}._instance
+
+\t@staticmethod
+{5}'''.strip().format(state.number, patterns, associative, max_optional_count, anonymous_patterns, code))
+        class_name = self._matcher_classes[id(state.matcher)] = 'CommutativeMatcher{}'.format(state.number)
+        return class_name
+
+    def create_nested_generator(self, automaton):
+        """Create the generator for the automaton of a commutative matcher."""
+        return type(self)(automaton, max_depth=self.max_depth, max_lines=self.max_lines)
 
     def commutative_var_entry(self, entry):
         return '(VariableWithCount({!r}, {}, {}, {}), {})'.format(
@@ -174,7 +268,10 @@ class CommutativeMatcher{0}(CommutativeMatcher):
             if wc.optional is not None:
                 self.enter_variable_assignment(transition.variable_name, self.optional_expr(wc.optional))
                 constraints = sorted(transition.check_constraints) if transition.check_constraints is not None else []
+                bound_variables = self._bound_variables
+                self._bound_variables = bound_variables.union([transition.variable_name])
                 self.generate_constraints(constraints, [transition])
+                self._bound_variables = bound_variables
                 self.exit_variable_assignment()
             if isinstance(wc, SymbolWildcard):
                 enter_func = self.enter_symbol_wildcard
@@ -199,7 +296,13 @@ class CommutativeMatcher{0}(CommutativeMatcher):
         if transition.subst is not None:
             self.enter_subst(transition.subst)
         constraints = sorted(transition.check_constraints) if transition.check_constraints is not None else []
+        bound_variables = self._bound_variables
+        if transition.variable_name is not None:
+            self._bound_variables = self._bound_variables.union([transition.variable_name])
+        if transition.subst is not None:
+            self._bound_variables = self._bound_variables.union(transition.subst.keys())
         self.generate_constraints(constraints, [transition])
+        self._bound_variables = bound_variables
 
         if transition.subst is not None:
             self.exit_subst(transition.subst)
@@ -435,6 +538,10 @@ class CommutativeMatcher{0}(CommutativeMatcher):
         else:
             constraint_index, *remaining = constraints
             constraint, patterns = self._matcher.constraints[constraint_index]
+            # Like the matcher, check each constraint once and only when all its variables have a value
+            if constraint_index in self._checked_constraints or not constraint.variables <= self._bound_variables:
+                self.generate_constraints(remaining, transitions)
+                return
             remaining_patterns = self._patterns - patterns
             remaining_transitions = [t for t in transitions if t.patterns & remaining_patterns]
             checked_patterns = self._patterns & patterns
@@ -448,7 +555,10 @@ class CommutativeMatcher{0}(CommutativeMatcher):
                 self.indent()
                 self.add_line('pass')
                 self._patterns = checked_patterns
+                checked_constraints = self._checked_constraints
+                self._checked_constraints = checked_constraints.union([constraint_index])
                 self.generate_constraints(remaining, checked_transitions)
+                self._checked_constraints = checked_constraints
                 self.dedent()
             if remaining_patterns and remaining_transitions:
                 self._patterns = remaining_patterns
@@ -465,34 +575,576 @@ class CommutativeMatcher{0}(CommutativeMatcher):
         self.add_line('pass')
 
     def constraint_repr(self, constraint):
-        if isinstance(constraint, CustomConstraint) and isinstance(constraint.constraint, type(lambda: 0)):
-            src = get_short_lambda_source(constraint.constraint)
-            mapping = {k: v for v, k in constraint._variables.items() }
-            params = constraint._variables.keys()
-            pstr = r'\b({})\b'.format('|'.join(map(re.escape, params)))
-            new_src = re.sub(pstr, lambda m: 'subst{}[{!r}]'.format(self._substs, constraint._variables[m[0]]), src)
-            return new_src, False
+        code = constraint.generate_code('subst{}'.format(self._substs))
+        if code is not None:
+            expression, imports = code
+            self._imports.update(imports)
+            return expression, False
         return repr(constraint), True
 
     def exit_global_constraint(self, constraint_index):
         self.dedent()
 
-    def clean_code(self, code):
-        return re.sub(r'\n(\s+)pass((?:\n\1#[^\n]*)*\n\1+\w)', r'\2', code)
-
     @staticmethod
-    def _collapse_ifs(code):
-        def sub_cb(m):
-            indent = m['indent1']
-            indent2 = indent + m['indent2']
-            indent3 = indent2 + m['indent3']
-            offset = len(indent3)
-            inner = ('\n' + indent2).join(line[offset:] for line in m['block'].rstrip().split('\n'))
-            result = '\n{}if {} and {}:\n{}{}\n'.format(indent, m['cond1'], m['cond2'], indent2, inner)
-            if m['comment']:
-                result = '\n{}{}{}'.format(indent, m['comment'].strip(), result)
-            return result
-        count = 1
-        while count > 0:
-            code, count = COLLAPSE_IF_RE.subn(sub_cb, code)
-        return code
+    def _remove_redundant_passes(lines: List[str]) -> List[str]:
+        """Remove the ``pass`` statements which are followed by another statement in the same block."""
+        result = []
+        pass_index = None
+        pass_indentation = None
+        for line in lines:
+            code = line.lstrip()
+            indentation = line[:len(line) - len(code)]
+            if pass_index is not None:
+                if code.startswith('#') and indentation == pass_indentation:
+                    result.append(line)
+                    continue
+                if indentation.startswith(pass_indentation) and code[:1].isidentifier():
+                    del result[pass_index]
+                pass_index = None
+            if code == 'pass' and indentation:
+                pass_index = len(result)
+                pass_indentation = indentation
+            result.append(line)
+        return result
+
+
+REWRITE_CODE = '''
+NO_MATCH = object()
+
+
+def apply_rules(expression):
+\tbest_rank = None
+\tbest_subst = None
+\tfor rank, subst in match_root(expression):
+\t\tif best_rank is None or rank < best_rank:
+\t\t\tbest_rank, best_subst = rank, subst
+\t\t\tif rank == 0:
+\t\t\t\tbreak
+\tif best_rank is None:
+\t\treturn NO_MATCH
+\treturn RULES[best_rank](best_subst)
+
+
+def rewrite(expression, max_count=math.inf):
+\treturn _rewrite(expression, [max_count])
+
+
+def _rewrite(expression, count):
+\tif isinstance(expression, Operation):
+\t\toperands = []
+\t\tchanged = False
+\t\tfor operand in op_iter(expression):
+\t\t\tresult = _rewrite(operand, count)
+\t\t\tif result is not operand:
+\t\t\t\tchanged = True
+\t\t\tif isinstance(result, Expression):
+\t\t\t\toperands.append(result)
+\t\t\telse:
+\t\t\t\toperands.extend(result)
+\t\tif changed:
+\t\t\texpression = create_operation_expression(expression, operands)
+\tif count[0] <= 0:
+\t\treturn expression
+\tresult = apply_rules(expression)
+\tif result is NO_MATCH:
+\t\treturn expression
+\tcount[0] -= 1
+\tif isinstance(result, Expression):
+\t\treturn _rewrite(result, count)
+\toperands = []
+\tfor operand in result:
+\t\toperand = _rewrite(operand, count)
+\t\tif isinstance(operand, Expression):
+\t\t\toperands.append(operand)
+\t\telse:
+\t\t\toperands.extend(operand)
+\treturn operands
+'''.strip()
+
+
+class ReplacerCodeGenerator(CodeGenerator):
+    """Generates a module for rewriting expressions with the rules of a :class:`.ManyToOneReplacer`.
+
+    Besides the matching function ``match_root``, the generated code contains the function ``rewrite(expression,
+    max_count=math.inf)``. It rewrites an expression bottom-up: The operands of an expression are rewritten first, then
+    the rule with the highest priority that matches the expression is applied and its result is rewritten again. Rules
+    with the same priority are preferred in the order in which they were added, just like for the replacer. For a
+    confluent and terminating set of rules, the result is the same as the one of :meth:`.ManyToOneReplacer.replace`.
+
+    The replacements are called directly with positional arguments. Lambda functions are included in the generated code
+    with their source, so the names they use must be available in the generated module, just like for the constraints.
+    Functions registered with :func:`.register_importable` are imported from their registered path. Other functions are
+    imported from their module, so they must be defined at the top level of a module.
+    """
+
+    def __init__(self, replacer, max_depth: int=16, max_lines: int=2000):
+        super(ReplacerCodeGenerator, self).__init__(replacer.matcher, max_depth=max_depth, max_lines=max_lines)
+        self._ranks = replacer.matcher._pattern_ranks()
+
+    def create_nested_generator(self, automaton):
+        return CodeGenerator(automaton, max_depth=self.max_depth, max_lines=self.max_lines)
+
+    def generate_code(self, func_name='match_root', add_imports=True):
+        self._imports.add('import math')
+        self._imports.add('from matchpy.expressions.expressions import Expression, Operation')
+        self._imports.add('from matchpy.expressions.functions import create_operation_expression, op_iter')
+        global_code, code = super(ReplacerCodeGenerator, self).generate_code(func_name, add_imports)
+        rules = [None] * len(self._ranks)
+        for pattern_index, rank in enumerate(self._ranks):
+            rules[rank] = self.generate_rule_code(pattern_index, rank)
+        rules.append('RULES = ({})'.format(''.join('rule{}, '.format(rank) for rank in range(len(rules)))))
+        code = '\n\n\n'.join([code.rstrip('\n')] + rules + [REWRITE_CODE]) + '\n'
+        self.info = self.info._replace(
+            lines=global_code.count('\n') + code.count('\n') + 1,
+            characters=len(global_code) + len(code),
+            functions=self.info.functions + len(self._ranks) + 3
+        )
+        return global_code, code
+
+    def yield_final_substitution(self, pattern_index):
+        self.add_line('# {}: {}'.format(pattern_index, self._matcher.patterns[pattern_index][0]))
+        self.add_line('yield {}, subst{}'.format(self._ranks[pattern_index], self._substs))
+
+    def generate_rule_code(self, pattern_index, rank):
+        """Generate the replacement of the pattern and the function that calls it with the match substitution."""
+        pattern, replacement, _ = self._matcher.patterns[pattern_index]
+        renaming = self._matcher.pattern_vars[pattern_index]
+        variables = set(get_variables(pattern.expression))
+        name = 'replacement{}'.format(rank)
+        signature = inspect.signature(replacement)
+        import_code = _import_code(replacement)
+        if import_code is not None:
+            imported_name, import_statement = import_code
+            definition = '{}\n{} = {}'.format(import_statement, name, imported_name)
+        elif isinstance(replacement, FunctionType) and replacement.__name__ == '<lambda>':
+            source = get_short_lambda_source(replacement)
+            if source is None:
+                raise ValueError("Cannot get the source of the replacement {!r}.".format(replacement))
+            parameters = str(signature)[1:-1]
+            definition = '{} = lambda{}: {}'.format(name, ' ' + parameters if parameters else '', source)
+        elif isinstance(replacement, FunctionType) and replacement.__qualname__ == replacement.__name__:
+            definition = 'from {} import {} as {}'.format(replacement.__module__, replacement.__name__, name)
+        else:
+            raise ValueError("The replacement {!r} is neither a lambda nor a top level function.".format(replacement))
+        arguments = []
+        for parameter in signature.parameters.values():
+            if parameter.kind not in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD):
+                break
+            if parameter.name not in variables:
+                break
+            variables.remove(parameter.name)
+            arguments.append('subst[{!r}]'.format(renaming.get(parameter.name, parameter.name)))
+        for variable in sorted(variables):
+            arguments.append('{}=subst[{!r}]'.format(variable, renaming.get(variable, variable)))
+        return '{}\n\n\ndef rule{}(subst):\n\t# {}\n\treturn {}({})'.format(
+            definition, rank, pattern, name, ', '.join(arguments)
+        )
+
+
+class DiscriminationNetCodeGenerator:
+    """Generates Python code for matching with a :class:`.DiscriminationNet`.
+
+    The generated function yields a tuple ``(index, substitution)`` for every pattern that matches the subject, where
+    the index is the position of the pattern in the order in which it was added to the net.
+
+    The subject is converted to a :class:`.FlatTerm` and every state of the net becomes a branch on the head of the
+    current term. Subterms that are matched by a wildcard are skipped in constant time with the help of
+    :attr:`.FlatTerm.subterm_ends`. As the net is deterministic, the code for a state is generated inline in the code of
+    its predecessor, unless it has multiple predecessors or the code gets too large. Then it is put into a separate
+    function instead. Nets with cycles, i.e. those for patterns with sequence wildcards, are compiled to a loop over the
+    states.
+
+    Attributes:
+        max_depth:
+            The maximum indentation depth of the code for a state before it is put into a separate function.
+        max_lines:
+            The maximum number of lines of a function before the code for further states is put into separate
+            functions.
+        info:
+            The size of the generated code and the time it took to generate it, once :meth:`generate_code` is done.
+    """
+
+    def __init__(self, net, max_depth: int=16, max_lines: int=2000):
+        self._net = net
+        self.max_depth = max_depth
+        self.max_lines = max_lines
+        self.info = None
+        self._indentation = '\t'
+        self._level = 0
+        self._function_level = 0
+        self._function_count = 1
+        self._lines = []  # type: List[str]
+        self._global_code = []  # type: List[str]
+        self._imports = set()  # type: Set[str]
+        self._symbols = {}  # type: Dict[Symbol, str]
+        self._pattern_names = set()  # type: Set[str]
+        self._state_functions = {}  # type: Dict[int, str]
+        self._components = {}  # type: Dict[int, int]
+        self._predecessors = {}  # type: Dict[int, int]
+        self._loops = {}  # type: Dict[int, List[Any]]
+        self._loop = None  # type: Optional[int]
+        self._collect = False
+        self._arguments = ['subject', 'terms', 'ends', 'n', 'i']
+
+    def indent(self):
+        self._level += 1
+
+    def dedent(self):
+        if self._level > 0:
+            self._level -= 1
+
+    def add_line(self, line):
+        self._lines.append((self._indentation * self._level) + str(line))
+
+    def generate_code(self, func_name='match_root', add_imports=True):
+        start = time.perf_counter()
+        self._imports.add('from matchpy.expressions.substitution import Substitution')
+        self._imports.add('from matchpy.matching.syntactic import FlatTerm, OPERATION_END')
+        self.add_line('def {}(subject):'.format(func_name))
+        self.indent()
+        self._function_level = self._level
+        self.generate_match_code(func_name)
+        self.end_generator()
+        self.dedent()
+
+        if add_imports:
+            self._global_code.insert(0, '\n'.join(sorted(self._imports)))
+
+        global_code = '\n\n'.join(p for p in self._global_code if p)
+        code = '\n'.join(self._lines) + '\n'
+        self.info = CodeGenerationInfo(
+            global_code.count('\n') + code.count('\n') + 1,
+            len(global_code) + len(code), self._function_count, time.perf_counter() - start
+        )
+        return global_code, code
+
+    def generate_match_code(self, func_name):
+        self.add_line('flatterm = FlatTerm(subject)')
+        self.add_line('terms = tuple(flatterm)')
+        self.add_line('ends = flatterm.subterm_ends')
+        self.add_line('n = len(terms)')
+        self.add_line('i = 0')
+        self.generate_net_code()
+
+    def generate_net_code(self):
+        """Generate the code that runs the net on the flatterm, starting with the term at index ``i``."""
+        self._analyze_states()
+        self.generate_state_code(self._net._root)
+
+    def _analyze_states(self):
+        """Find the cycles of the net and count the predecessors of its states.
+
+        The states of every strongly connected component with a cycle are matched in a loop. Other states and those
+        loops are nested in the code of their predecessor, so they are counted as a whole.
+        """
+        states = {}
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        self._components = {}
+        self._loops = {}
+        self._predecessors = {}
+        # Tarjan's algorithm, but with an explicit stack because the nets can be very deep
+        work = [(self._net._root, iter(self._net._root.values()))]
+        index[self._net._root.id] = lowlink[self._net._root.id] = 0
+        stack.append(self._net._root)
+        on_stack.add(self._net._root.id)
+        while work:
+            state, targets = work[-1]
+            states[state.id] = state
+            for target in targets:
+                if target.id not in index:
+                    index[target.id] = lowlink[target.id] = len(index)
+                    stack.append(target)
+                    on_stack.add(target.id)
+                    work.append((target, iter(target.values())))
+                    break
+                elif target.id in on_stack:
+                    lowlink[state.id] = min(lowlink[state.id], index[target.id])
+            else:
+                work.pop()
+                if work:
+                    lowlink[work[-1][0].id] = min(lowlink[work[-1][0].id], lowlink[state.id])
+                if lowlink[state.id] == index[state.id]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member.id)
+                        self._components[member.id] = state.id
+                        component.append(member)
+                        if member is state:
+                            break
+                    if len(component) > 1 or any(t is state for t in state.values()):
+                        self._loops[state.id] = sorted(component, key=lambda s: index[s.id])
+        for state in states.values():
+            for target in state.values():
+                component = self._components[target.id]
+                if component != self._components[state.id]:
+                    self._predecessors[component] = self._predecessors.get(component, 0) + 1
+
+    def generate_state_code(self, state):
+        component = self._components[state.id]
+        if component == self._loop:
+            self.add_line('state = {}'.format(state.id))
+            self.add_line('continue')
+        elif (self._predecessors.get(component, 0) > 1 or self._level - self._function_level >= self.max_depth or
+              len(self._lines) >= self.max_lines):
+            self.generate_state_function(state)
+        elif component in self._loops:
+            self.add_line('state = {}'.format(state.id))
+            self.generate_loop_code(component)
+        else:
+            self.generate_state_body(state)
+
+    def generate_loop_code(self, component):
+        """Generate a loop over the states of a strongly connected component, starting with the one in ``state``."""
+        outer_loop = self._loop
+        self._loop = component
+        self.add_line('while True:')
+        self.indent()
+        for number, state in enumerate(self._loops[component]):
+            self.add_line('{} state == {}:'.format('if' if number == 0 else 'elif', state.id))
+            self.indent()
+            self.generate_state_body(state)
+            self.dedent()
+        self.add_line('return')
+        self.dedent()
+        self._loop = outer_loop
+
+    def generate_state_function(self, state):
+        """Generate a separate function for the code of the state or its loop and a call to it."""
+        component = self._components[state.id]
+        arguments = list(self._arguments)
+        if component in self._loops:
+            arguments.append('state')
+        name = self._state_functions.get(component, None)
+        if name is None:
+            if component in self._loops:
+                name = 'match_loop{}'.format(component)
+                self.generate_function(name, arguments, lambda: self.generate_loop_code(component))
+            else:
+                name = 'match_state{}'.format(component)
+                self.generate_function(name, arguments, lambda: self.generate_state_body(state))
+            self._state_functions[component] = name
+        if component in self._loops:
+            arguments[-1] = str(state.id)
+        self.add_line('yield from {}({})'.format(name, ', '.join(arguments)))
+        self.add_line('return')
+
+    def generate_function(self, name, parameters, generate_body):
+        """Generate a function with the given parameters and add it to the global code."""
+        self._function_count += 1
+        outer = self._lines, self._level, self._function_level, self._loop
+        self._lines = []
+        self._level = 0
+        self._loop = None
+        self.add_line('def {}({}):'.format(name, ', '.join(parameters)))
+        self.indent()
+        self._function_level = self._level
+        generate_body()
+        self.end_generator()
+        self._global_code.append('\n'.join(self._lines))
+        self._lines, self._level, self._function_level, self._loop = outer
+
+    def end_generator(self):
+        """Make sure that the current function is a generator even if it cannot yield anything."""
+        if self._lines[-1].strip() != 'return':
+            self.add_line('return')
+        self.add_line('yield')
+
+    def generate_state_body(self, state):
+        self.add_line('# State {}'.format(state.id))
+        if self._collect:
+            for index in state.payload:
+                self.generate_final_code(index)
+            self.add_line('if i == n:')
+            self.indent()
+        else:
+            self.add_line('if i == n:')
+            self.indent()
+            for index in state.payload:
+                self.generate_final_code(index)
+        self.add_line('return')
+        self.dedent()
+        if not state:
+            self.add_line('return')
+            return
+        self.add_line('term = terms[i]')
+        branches = []
+        symbol_types = []
+        for label, target in state.items():
+            if label is Wildcard:
+                continue
+            if is_operation(label):
+                branches.append(('term is {}'.format(self.operation_symbol(label)), target))
+            elif label == OPERATION_END:
+                branches.append(('term == OPERATION_END', target))
+            elif is_symbol_wildcard(label):
+                symbol_types.append(('isinstance(term, {})'.format(self.symbol_type(label)), target))
+            else:
+                branches.append(('term == {}'.format(self.symbol_repr(label)), target))
+        # Like for the dictionary lookup in the net, a symbol is only matched by its type if there is no exact match
+        for number, (condition, target) in enumerate(branches + symbol_types):
+            self.add_line('{} {}:'.format('if' if number == 0 else 'elif', condition))
+            self.indent()
+            self.add_line('i += 1')
+            self.generate_state_code(target)
+            self.dedent()
+        if Wildcard in state:
+            if OPERATION_END not in state:
+                self.add_line('if term == OPERATION_END:')
+                self.indent()
+                self.add_line('return')
+                self.dedent()
+            self.add_line('i = ends[i]')
+            self.generate_state_code(state[Wildcard])
+        else:
+            self.add_line('return')
+
+    def generate_final_code(self, index):
+        pattern, _ = self._net._patterns[index]
+        self.add_line('# {}: {}'.format(index, pattern))
+        self.add_line('subst = Substitution()')
+        pattern_repr = self.pattern_repr(index, pattern.expression)
+        self.add_line('if subst.extract_substitution(subject, {}):'.format(pattern_repr))
+        self.indent()
+        self.generate_constraints_and_yield(index, pattern)
+        self.dedent()
+
+    def generate_constraints_and_yield(self, index, pattern):
+        for constraint in pattern.constraints:
+            code = constraint.generate_code('subst')
+            if code is not None:
+                expression, imports = code
+                self._imports.update(imports)
+                self.add_line('if {}:'.format(expression))
+            else:
+                self.add_line('if {!r}(subst):'.format(constraint))
+            self.indent()
+        self.add_line('yield {}, subst'.format(index))
+        for _ in pattern.constraints:
+            self.dedent()
+
+    def pattern_repr(self, index, expression):
+        """Return the name of a global variable for the pattern expression with the given index."""
+        name = 'pattern{}'.format(index)
+        if name not in self._pattern_names:
+            self._pattern_names.add(name)
+            self._global_code.append('{} = {}'.format(name, self.expr(expression)))
+        return name
+
+    def expr(self, expression):
+        """Return the code that creates the given pattern expression."""
+        if isinstance(expression, Operation):
+            arguments = [self.expr(o) for o in op_iter(expression)]
+            if expression.variable_name is not None:
+                arguments.append('variable_name={!r}'.format(expression.variable_name))
+            return '{}({})'.format(self.operation_symbol(type(expression)), ', '.join(arguments))
+        if isinstance(expression, SymbolWildcard):
+            self._imports.add('from matchpy.expressions.expressions import SymbolWildcard')
+            return 'SymbolWildcard({}, {!r})'.format(self.symbol_type(expression.symbol_type), expression.variable_name)
+        if isinstance(expression, Wildcard):
+            self._imports.add('from matchpy.expressions.expressions import Wildcard')
+            optional = ', {!r}'.format(expression.optional) if expression.optional is not None else ''
+            return 'Wildcard({}, {}, {!r}{})'.format(
+                expression.min_count, expression.fixed_size, expression.variable_name, optional
+            )
+        if expression.variable_name is not None:
+            return '{}({!r}, variable_name={!r})'.format(
+                type(expression).__name__, expression.name, expression.variable_name
+            )
+        return repr(expression)
+
+    def operation_symbol(self, operation):
+        return operation.__name__
+
+    def symbol_type(self, symbol):
+        return symbol.__name__
+
+    def symbol_repr(self, symbol):
+        """Return the name of a global variable for the symbol, so that it is only created once."""
+        name = self._symbols.get(symbol, None)
+        if name is None:
+            name = self._symbols[symbol] = 'symbol{}'.format(len(self._symbols))
+            self._global_code.append('{} = {!r}'.format(name, symbol))
+        return name
+
+
+class SequenceMatcherCodeGenerator(DiscriminationNetCodeGenerator):
+    """Generates Python code for matching with a :class:`.SequenceMatcher`.
+
+    The generated function yields a tuple ``(index, substitution)`` for every match, where the index is the position of
+    the pattern in the order in which it was added to the matcher.
+
+    The flatterm of the subject is only created once. For every operand of the subject, the net is run on the remaining
+    part of it starting with that operand, which is done by a separate function.
+    """
+
+    def __init__(self, matcher, max_depth: int=16, max_lines: int=2000):
+        super(SequenceMatcherCodeGenerator, self).__init__(matcher._net, max_depth=max_depth, max_lines=max_lines)
+        self._matcher = matcher
+        self._collect = True
+        self._arguments = ['subject', 'subjects', 'k', 'terms', 'ends', 'n', 'i']
+
+    def generate_match_code(self, func_name):
+        if self._matcher.operation is None:
+            return
+        self._imports.add('from matchpy.expressions.functions import op_iter')
+        net_name = '{}_net'.format(func_name)
+        self.generate_function(net_name, self._arguments, self.generate_net_code)
+        self.add_line('if not isinstance(subject, {}):'.format(self.operation_symbol(self._matcher.operation)))
+        self.indent()
+        self.add_line('return')
+        self.dedent()
+        self.add_line('subjects = tuple(op_iter(subject))')
+        self.add_line('flatterm = FlatTerm(subject)')
+        self.add_line('terms = tuple(flatterm)')
+        self.add_line('ends = flatterm.subterm_ends')
+        self.add_line('n = len(terms) - 1')
+        self.add_line('i = 1')
+        self.add_line('for k in range(len(subjects)):')
+        self.indent()
+        self.add_line('yield from {}({})'.format(net_name, ', '.join(self._arguments)))
+        self.add_line('i = ends[i]')
+        self.dedent()
+
+    def generate_final_code(self, index):
+        match_index = self._net._patterns[index][1]
+        pattern, first_name, last_name = self._matcher._patterns[match_index]
+        operands = list(op_iter(pattern.expression))[1:-1]
+        end = 'k + {}'.format(len(operands))
+        self.add_line('# {}: {}'.format(match_index, pattern))
+        self.add_line('subst = Substitution()')
+        self.add_line(
+            'if all(map(subst.extract_substitution, subjects[k:{}], {})):'.format(
+                end, self.pattern_repr(match_index, operands)
+            )
+        )
+        self.indent()
+        if first_name is not None or last_name is not None:
+            self.add_line('try:')
+            self.indent()
+            if first_name is not None:
+                self.add_line('subst.try_add_variable({!r}, subjects[:k])'.format(first_name))
+            if last_name is not None:
+                self.add_line('subst.try_add_variable({!r}, subjects[{}:])'.format(last_name, end))
+            self.dedent()
+            self.add_line('except ValueError:')
+            self.indent()
+            self.add_line('pass')
+            self.dedent()
+            self.add_line('else:')
+            self.indent()
+            self.generate_constraints_and_yield(match_index, pattern)
+            self.dedent()
+        else:
+            self.generate_constraints_and_yield(match_index, pattern)
+        self.dedent()
+
+    def pattern_repr(self, index, operands):
+        name = 'pattern{}'.format(index)
+        if name not in self._pattern_names:
+            self._pattern_names.add(name)
+            self._global_code.append('{} = ({},)'.format(name, ', '.join(map(self.expr, operands))))
+        return name
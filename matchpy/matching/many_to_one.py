@@ -28,15 +28,23 @@ f(a, x_) matched with {x ↦ b}
 f(y_, b) matched with {y ↦ a}
 some label matched with {x ↦ a, y ↦ b}
 
+Once all patterns have been added, the same matcher can be used to match from multiple threads at once. All the state
+that changes during matching is kept per match or per thread. However, adding patterns while matching is not safe.
+
 Also contains the :class:`ManyToOneReplacer` which can replace a set :class:`ReplacementRule` at one using a
 :class:`ManyToOneMatcher` for finding the matches.
 """
 import math
 import html
 import itertools
-from collections import deque
+import json
+import threading
+from collections import OrderedDict, deque
 from operator import itemgetter
-from typing import Container, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple, Type, Union
+from typing import (
+    Any, AsyncIterator, Callable, Container, Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional, Sequence,
+    Set, Tuple, Type, Union
+)
 
 try:
     from graphviz import Digraph, Graph
@@ -53,13 +61,16 @@ from ..expressions.functions import (
     is_anonymous, contains_variables_from_set, create_operation_expression, preorder_iter_with_position,
     rename_variables, op_iter, preorder_iter, op_len
 )
-from ..utils import (VariableWithCount, commutative_sequence_variable_partition_iter)
+from ..utils import (
+    VariableWithCount, commutative_sequence_variable_partition_count_iter, fixed_integer_vector_iter, generator_chain
+)
 from .. import functions
-from .bipartite import BipartiteGraph, enum_maximum_matchings_iter, LEFT
+from .bipartite import BipartiteGraph
 from .syntactic import OPERATION_END, is_operation
 from ._common import check_one_identity
+from .budget import MatchBudget, MatchBudgetExceeded, step
 
-__all__ = ['ManyToOneMatcher', 'ManyToOneReplacer']
+__all__ = ['ManyToOneMatcher', 'ManyToOneReplacer', 'TransitionProfile']
 
 LabelType = Union[Expression, Type[Operation]]
 HeadType = Optional[Union[Expression, Type[Operation], Type[Symbol]]]
@@ -68,6 +79,9 @@ MultisetOfExpression = Multiset
 
 _EPS = object()
 
+# The heads for the type of every subject that was matched, together with whether they are complete
+_type_heads = {}  # type: Dict[type, Tuple[Tuple[HeadType, ...], bool]]
+
 _State = NamedTuple('_State', [
     ('number', int),
     ('transitions', Dict[LabelType, '_Transition']),
@@ -83,19 +97,108 @@ _Transition = NamedTuple('_Transition', [
     ('subst', Substitution),
 ])  # yapf: disable
 
+SubjectCacheInfo = NamedTuple('SubjectCacheInfo', [
+    ('hits', int),
+    ('misses', int),
+    ('evictions', int),
+    ('subjects', int),
+    ('edges', int),
+])  # yapf: disable
+
+MinimizationInfo = NamedTuple('MinimizationInfo', [
+    ('states_before', int),
+    ('states_after', int),
+    ('transitions_before', int),
+    ('transitions_after', int),
+])  # yapf: disable
+
+# The state numbers are unique across all automata, so that nested automata can be drawn and compiled together.
+# Getting the next number from the counter is atomic, so automata can be built concurrently.
+_state_numbers = itertools.count()
+
+# The statistics of the transitions that are recorded during a profiling run in the current thread
+_profiling = threading.local()
+
+# Identifies a transition by the path of commutative states to its automaton and the indices of its source and target
+# states, so that it is stable when the same patterns are added to a new matcher in the same order
+TransitionKey = Tuple[Tuple[int, ...], int, int]
+
+
+class TransitionProfile(object):
+    """Statistics about how often the transitions of a :class:`ManyToOneMatcher` lead to a match.
+
+    A profile is recorded with :meth:`ManyToOneMatcher.profile` on a sample of subjects and can then be used to
+    reorder the transitions of the matcher with :meth:`ManyToOneMatcher.reorder`:
+
+    >>> matcher = ManyToOneMatcher(Pattern(f(__, a)), Pattern(f(x_, b)))
+    >>> profile = matcher.profile([f(a, b), f(c, b), f(a, a)])
+    >>> matcher.reorder(profile)
+    >>> [str(pattern) for pattern, _ in matcher.match(f(c, b))]
+    ['f(x_, b)']
+
+    The transitions are identified by the indices of their states in the matcher, so the profile can be saved and
+    loaded again for a matcher that has the same patterns added in the same order.
+
+    Attributes:
+        counts:
+            For every transition, how many times it was tried and how many times it led to a match.
+    """
+
+    def __init__(self, counts: Optional[Dict[TransitionKey, List[int]]]=None) -> None:
+        self.counts = dict(counts or {})
+
+    def success_rate(self, key: TransitionKey) -> float:
+        """Return the estimated probability that trying the transition leads to a match.
+
+        Transitions that have not been tried get a rate of one half.
+        """
+        tried, matched = self.counts.get(key, (0, 0))
+        return (matched + 1) / (tried + 2)
+
+    def save(self, file) -> None:
+        """Save the profile as JSON to the given text file."""
+        entries = [[list(path), source, target, tried, matched]
+                   for (path, source, target), (tried, matched) in sorted(self.counts.items())]
+        json.dump(entries, file)
+
+    @classmethod
+    def load(cls, file) -> 'TransitionProfile':
+        """Load a profile that was saved with :meth:`save` from the given text file."""
+        return cls(((tuple(path), source, target), [tried, matched])
+                   for path, source, target, tried, matched in json.load(file))
+
+
+def _freeze_substitution(substitution: Optional[Substitution]):
+    """Return a hashable version of the substitution of a transition to compare transitions."""
+    if substitution is None:
+        return None
+    try:
+        return frozenset(substitution.items())
+    except TypeError:
+        return id(substitution)
 
-_VISITED = set()
 
 class _MatchIter:
-    def __init__(self, matcher, subject, intial_associative=None):
+    def __init__(self, matcher, subject, intial_associative=None, budget=None):
         self.matcher = matcher
         self.subjects = deque([subject]) if subject is not None else deque()
         self.patterns = set(range(len(matcher.patterns)))
         self.substitution = Substitution()
         self.constraints = set(range(len(matcher.constraints)))
         self.associative = [intial_associative]
+        self.budget = budget
+        # When searching for the best match by priority, the ranks of the patterns and the rank of the best match so far
+        self.ranks = None  # type: Optional[List[int]]
+        self.cutoff = math.inf
+        # During a profiling run, the statistics and keys for the transitions
+        self.profile = getattr(_profiling, 'active', None)
 
     def __iter__(self):
+        if self.budget is not None:
+            return self.budget.limit(self._iter())
+        return self._iter()
+
+    def _iter(self):
         for _ in self._match(self.matcher.root):
             yield from self._internal_iter()
 
@@ -108,6 +211,12 @@ class _MatchIter:
         Yields:
             The grouped matches.
         """
+        if self.budget is not None:
+            yield from self.budget.limit(self._grouped())
+        else:
+            yield from self._grouped()
+
+    def _grouped(self):
         for _ in self._match(self.matcher.root):
             yield list(self._internal_iter())
 
@@ -122,34 +231,75 @@ class _MatchIter:
             return False
         return True
 
+    def first(self) -> Optional[Tuple[Expression, Substitution]]:
+        """
+        Returns:
+            The match for the pattern with the highest priority or `None` if there is no match.
+            See :meth:`ManyToOneMatcher.match_first`.
+        """
+        self.ranks = ranks = self.matcher._pattern_ranks()
+        self.cutoff = math.inf
+        result = None
+        for _ in self._match(self.matcher.root):
+            for pattern_index in sorted(self.patterns, key=ranks.__getitem__):
+                if ranks[pattern_index] >= self.cutoff:
+                    break
+                new_substitution = self._check_pattern(pattern_index)
+                if new_substitution is not None:
+                    result = self.matcher.patterns[pattern_index][1], new_substitution
+                    self.cutoff = ranks[pattern_index]
+                    break
+            if self.cutoff == 0:
+                break
+        return result
+
     def _internal_iter(self):
         for pattern_index in self.patterns:
-            renaming = self.matcher.pattern_vars[pattern_index]
-            new_substitution = self.substitution.rename({renamed: original for original, renamed in renaming.items()})
-            pattern, label, _ = self.matcher.patterns[pattern_index]
-            valid = True
-            for constraint in pattern.global_constraints:
-                if not constraint(new_substitution):
-                    valid = False
-                    break
-            if valid:
-                yield label, new_substitution
+            new_substitution = self._check_pattern(pattern_index)
+            if new_substitution is not None:
+                yield self.matcher.patterns[pattern_index][1], new_substitution
+
+    def _check_pattern(self, pattern_index: int) -> Optional[Substitution]:
+        renaming = self.matcher.pattern_vars[pattern_index]
+        new_substitution = self.substitution.rename({renamed: original for original, renamed in renaming.items()})
+        pattern = self.matcher.patterns[pattern_index][0]
+        for constraint in pattern.global_constraints:
+            if not constraint(new_substitution):
+                return None
+        return new_substitution
 
     def _match(self, state: _State) -> Iterator[_State]:
-        _VISITED.add(state.number)
+        step()
         if len(self.subjects) == 0:
             if state.number in self.matcher.finals or OPERATION_END in state.transitions:
                 yield state
             heads = [None]
         else:
-            heads = list(self._get_heads(self.subjects[0]))
-        for head in heads:
-            for transition in state.transitions.get(head, []):
-                yield from self._match_transition(transition)
+            heads = self._get_heads(self.subjects[0])
+        transitions = itertools.chain.from_iterable(state.transitions.get(head, []) for head in heads)
+        if self.ranks is not None:
+            # Try the transitions that can lead to the patterns with the highest priority first
+            transitions = sorted(transitions, key=self.matcher._transition_rank)
+        match_transition = self._match_transition if self.profile is None else self._match_profiled_transition
+        for transition in transitions:
+            yield from match_transition(transition)
+
+    def _match_profiled_transition(self, transition: _Transition) -> Iterator[_State]:
+        counts, keys = self.profile
+        statistics = counts.setdefault(keys[id(transition)], [0, 0])
+        statistics[0] += 1
+        matched = False
+        for state in self._match_transition(transition):
+            if not matched:
+                statistics[1] += 1
+                matched = True
+            yield state
 
     def _match_transition(self, transition: _Transition) -> Iterator[_State]:
         if self.patterns.isdisjoint(transition.patterns):
             return
+        if self.ranks is not None and self.matcher._transition_rank(transition) >= self.cutoff:
+            return
         label = transition.label
         if label is _EPS:
             subject = self.subjects[0] if self.subjects else None
@@ -178,6 +328,8 @@ class _MatchIter:
     def _check_transition(self, transition, subject, restore_subject=True):
         if self.patterns.isdisjoint(transition.patterns):
             return
+        if self.ranks is not None and self.matcher._transition_rank(transition) >= self.cutoff:
+            return
         restore_constraints = set()
         restore_patterns = self.patterns - transition.patterns
         self.patterns &= transition.patterns
@@ -239,24 +391,48 @@ class _MatchIter:
                         break
 
     @staticmethod
-    def _get_heads(expression: Expression) -> Iterator[HeadType]:
-        for base in type(expression).__mro__:
-            if base is not object:
-                yield base
-        if not isinstance(expression, Operation):
-            yield expression
-        yield None
+    def _get_heads(expression: Expression) -> Tuple[HeadType, ...]:
+        expression_type = type(expression)
+        try:
+            heads, complete = _type_heads[expression_type]
+        except KeyError:
+            heads = tuple(base for base in expression_type.__mro__ if base is not object)
+            # Only for atoms the expression itself is a head, for operations the heads only depend on the type
+            complete = issubclass(expression_type, Operation)
+            if complete:
+                heads += (None, )
+            _type_heads[expression_type] = heads, complete
+        if complete:
+            return heads
+        return heads + (expression, None)
 
     def _match_sequence_variable(self, wildcard: Wildcard, transition: _Transition) -> Iterator[_State]:
-        min_count = wildcard.min_count
-        if len(self.subjects) < min_count:
+        # Only try the numbers of operands for the wildcard that leave enough operands for the rest of the patterns
+        target = transition.target
+        rest_min, rest_max = self.matcher._level_bounds(target, self.associative[-1] is not None)
+        min_length = max(wildcard.min_count, len(self.subjects) - rest_max)
+        max_length = len(self.subjects) - rest_min
+        if min_length > max_length:
             return
+        # If the next operand must be matched by a transition with a specific head, it serves as an anchor
+        anchored = (
+            None not in target.transitions and OPERATION_END not in target.transitions and
+            target.number not in self.matcher.finals
+        )
         matched_subject = []
-        for _ in range(min_count):
+        for _ in range(min_length):
             matched_subject.append(self.subjects.popleft())
         while True:
+            if (
+                anchored and self.subjects and
+                not any(head in target.transitions for head in self._get_heads(self.subjects[0]))
+            ):
+                if len(matched_subject) >= max_length:
+                    break
+                matched_subject.append(self.subjects.popleft())
+                continue
             if self.associative[-1] and wildcard.fixed_size:
-                assert min_count == 1, "Fixed wildcards with length != 1 are not supported."
+                assert wildcard.min_count == 1, "Fixed wildcards with length != 1 are not supported."
                 if len(matched_subject) > 1:
                     wrapped = self.associative[-1](*matched_subject)
                 else:
@@ -267,7 +443,7 @@ class _MatchIter:
                 else:
                     wrapped = tuple(matched_subject)
             yield from self._check_transition(transition, wrapped, False)
-            if not self.subjects:
+            if len(matched_subject) >= max_length:
                 break
             matched_subject.append(self.subjects.popleft())
         self.subjects.extendleft(reversed(matched_subject))
@@ -320,15 +496,22 @@ class _MatchIter:
 
 
 class ManyToOneMatcher:
-    __slots__ = ('patterns', 'states', 'root', 'pattern_vars', 'constraints', 'constraint_vars', 'finals', 'rename')
-
-    _state_id = 0
+    __slots__ = (
+        'patterns', 'states', 'root', 'pattern_vars', 'constraints', 'constraint_vars', 'finals', 'rename',
+        'subject_cache_size', 'priorities', '_level_info', '_rank_info'
+    )
 
-    def __init__(self, *patterns: Expression, rename=True) -> None:
+    def __init__(self, *patterns: Expression, rename=True, subject_cache_size: Optional[int]=None) -> None:
         """
         Args:
             *patterns: The patterns which the matcher should match.
+            rename: Whether to rename the pattern variables by position, so that similar patterns can share states.
+            subject_cache_size:
+                The maximum number of operands of commutative subjects that are cached per commutative operation in
+                the patterns. By default, the cache is unbounded. A cache size of zero only keeps the operands while
+                they are being matched. See :meth:`cache_info`.
         """
+        self.subject_cache_size = subject_cache_size
         self.patterns = []
         self.states = []
         self.root = self._create_state()
@@ -337,11 +520,14 @@ class ManyToOneMatcher:
         self.constraint_vars = {}
         self.finals = set()
         self.rename = rename
+        self.priorities = []  # type: List[int]
+        self._level_info = {}
+        self._rank_info = None
 
         for pattern in patterns:
             self.add(pattern)
 
-    def add(self, pattern: Pattern, label=None) -> None:
+    def add(self, pattern: Pattern, label=None, priority: int=0) -> None:
         """Add a new pattern to the matcher.
 
         The optional label defaults to the pattern itself and is yielded during matching. The same pattern can be
@@ -356,6 +542,8 @@ class ManyToOneMatcher:
                 The pattern to add.
             label:
                 An optional label for the pattern. Defaults to the pattern itself.
+            priority:
+                The priority of the pattern for :meth:`match_first`. Patterns with a higher priority are preferred.
         """
         if label is None:
             label = pattern
@@ -364,9 +552,129 @@ class ManyToOneMatcher:
                 return i
         # TODO: Avoid renaming in the pattern, use variable indices instead
         renaming = self._collect_variable_renaming(pattern.expression) if self.rename else {}
-        self._internal_add(pattern, label, renaming)
+        self._internal_add(pattern, label, renaming, priority)
+
+    def remove(self, pattern_or_label) -> None:
+        """Remove patterns from the matcher.
+
+        All patterns that are equal to the given pattern or that have it as their label are removed:
+
+        >>> matcher = ManyToOneMatcher(Pattern(f(a, x_)))
+        >>> matcher.add(Pattern(f(x_, b)), 'label')
+        >>> matcher.remove('label')
+        >>> [str(pattern) for pattern, _ in matcher.match(f(a, b))]
+        ['f(a, x_)']
+
+        The transitions that were only used by the removed patterns are removed from the automaton together with the
+        states that cannot be reached anymore. This is much faster than building a new matcher for the remaining
+        patterns. The matcher must not be modified while it is used for matching.
+
+        Args:
+            pattern_or_label:
+                The pattern or label to remove.
+
+        Raises:
+            ValueError:
+                If the matcher does not contain the pattern or label.
+        """
+        if not self.remove_where(lambda pattern, label: pattern == pattern_or_label or label == pattern_or_label):
+            raise ValueError("The matcher does not contain {!r}.".format(pattern_or_label))
+
+    def remove_where(self, predicate: Callable[[Pattern, Any], bool]) -> int:
+        """Remove all patterns for which the predicate is true, see :meth:`remove`.
+
+        Args:
+            predicate:
+                A function that is called with each pattern and its label.
+
+        Returns:
+            The number of removed patterns.
+        """
+        removed = set(i for i, (pattern, label, _) in enumerate(self.patterns) if predicate(pattern, label))
+        if removed:
+            self.remove_indices(removed)
+        return len(removed)
+
+    def remove_indices(self, removed: Iterable[int]) -> Dict[int, int]:
+        """Remove the patterns with the given indices into :attr:`patterns`, see :meth:`remove`.
+
+        The remaining patterns and constraints are renumbered densely while keeping their order.
+
+        Args:
+            removed:
+                The indices of the patterns to remove.
+
+        Returns:
+            A mapping from the old to the new indices of the remaining patterns.
+        """
+        removed = set(removed)
+        self._level_info = {}
+        self._rank_info = None
+        pattern_map = {}  # type: Dict[int, int]
+        for i in range(len(self.patterns)):
+            if i not in removed:
+                pattern_map[i] = len(pattern_map)
+        constraint_map = {}  # type: Dict[int, int]
+        constraints = []
+        for i, (constraint, patterns) in enumerate(self.constraints):
+            patterns = set(pattern_map[p] for p in patterns if p in pattern_map)
+            if patterns:
+                constraint_map[i] = len(constraints)
+                constraints.append((constraint, patterns))
+        self.constraints = constraints
+        self.constraint_vars = {}
+        for i, (constraint, _) in enumerate(constraints):
+            for var in constraint.variables:
+                self.constraint_vars.setdefault(var, set()).add(i)
+        self.patterns = [
+            (pattern, label, [constraint_map[c] for c in constraint_indices])
+            for i, (pattern, label, constraint_indices) in enumerate(self.patterns) if i in pattern_map
+        ]
+        self.priorities = [p for i, p in enumerate(self.priorities) if i in pattern_map]
+        self.pattern_vars = [v for i, v in enumerate(self.pattern_vars) if i in pattern_map]
+
+        for state in self.states:
+            for head, transitions in list(state.transitions.items()):
+                remaining = []
+                for transition in transitions:
+                    patterns = set(pattern_map[p] for p in transition.patterns if p in pattern_map)
+                    if not patterns:
+                        continue
+                    transition.patterns.clear()
+                    transition.patterns.update(patterns)
+                    check_constraints = transition.check_constraints
+                    if check_constraints:
+                        remaining_constraints = [constraint_map[c] for c in check_constraints if c in constraint_map]
+                        check_constraints.clear()
+                        check_constraints.update(remaining_constraints)
+                    remaining.append(transition)
+                if remaining:
+                    transitions[:] = remaining
+                else:
+                    del state.transitions[head]
+
+        reachable = {self.root.number}
+        stack = [self.root]
+        while stack:
+            for transitions in stack.pop().transitions.values():
+                for transition in transitions:
+                    if transition.target.number not in reachable:
+                        reachable.add(transition.target.number)
+                        stack.append(transition.target)
+        self.states = [state for state in self.states if state.number in reachable]
+        self.finals &= reachable
+
+        # The transitions after a commutative state are labeled with the ids of the subpatterns of its matcher
+        used_subpatterns = {}  # type: Dict[int, Tuple[CommutativeMatcher, Set[int]]]
+        for state in self.states:
+            if state.matcher is not None:
+                used_subpatterns.setdefault(id(state.matcher), (state.matcher, set()))[1].update(state.transitions)
+        for matcher, subpattern_ids in used_subpatterns.values():
+            matcher._remove_unused_patterns(subpattern_ids)
 
-    def _internal_add(self, pattern: Pattern, label, renaming) -> int:
+        return pattern_map
+
+    def _internal_add(self, pattern: Pattern, label, renaming, priority: int=0) -> int:
         """Add a new pattern to the matcher.
 
         Equivalent patterns are not added again. However, patterns that are structurally equivalent,
@@ -378,10 +686,13 @@ class ManyToOneMatcher:
         Returns:
             The internal id for the pattern. This is mainly used by the :class:`CommutativeMatcher`.
         """
+        self._level_info = {}
+        self._rank_info = None
         pattern_index = len(self.patterns)
         renamed_constraints = [c.with_renamed_vars(renaming) for c in pattern.local_constraints]
         constraint_indices = [self._add_constraint(c, pattern_index) for c in renamed_constraints]
         self.patterns.append((pattern, label, constraint_indices))
+        self.priorities.append(priority)
         self.pattern_vars.append(renaming)
         pattern = rename_variables(pattern.expression, renaming)
         state = self.root
@@ -431,16 +742,247 @@ class ManyToOneMatcher:
             self.constraint_vars.setdefault(var, set()).add(index)
         return index
 
-    def match(self, subject: Expression) -> Iterator[Tuple[Expression, Substitution]]:
+    def match(self, subject: Expression, max_steps: int=None, max_results: int=None,
+              deadline: float=None) -> Iterator[Tuple[Expression, Substitution]]:
         """Match the subject against all the matcher's patterns.
 
         Args:
             subject: The subject to match.
+            max_steps: If given, the matching is aborted after this many steps. See :class:`.MatchBudget`.
+            max_results: If given, at most this many matches are yielded.
+            deadline:
+                If given, the matching is aborted after this point in time as returned by :func:`time.monotonic`.
+
+        Yields:
+            For every match, a tuple of the matching pattern and the match substitution.
+
+        Raises:
+            MatchBudgetExceeded:
+                If the maximum number of steps or the deadline is exceeded.
+        """
+        return _MatchIter(self, subject, budget=MatchBudget.create(max_steps, max_results, deadline))
+
+    def match_first(self, subject: Expression) -> Optional[Tuple[Expression, Substitution]]:
+        """Return the match of the pattern with the highest priority.
+
+        Patterns with the same priority are preferred in the order in which they were added. Hence, the result is
+        deterministic, unlike taking the first match from :meth:`match`:
+
+        >>> matcher = ManyToOneMatcher()
+        >>> matcher.add(Pattern(f(x_, b)), 'low')
+        >>> matcher.add(Pattern(f(a, y_)), 'high', priority=1)
+        >>> matcher.match_first(f(a, b))
+        ('high', {'y': Symbol('b')})
+
+        The automaton is traversed such that the transitions leading to the patterns with the highest priority are
+        tried first. Once a match is found, all transitions that can only lead to patterns with a lower priority are
+        skipped.
+
+        Args:
+            subject: The subject to match.
+
+        Returns:
+            A tuple of the label of the matching pattern and the match substitution or `None` if there is no match.
+        """
+        return _MatchIter(self, subject).first()
+
+    def profile(self, subjects: Iterable[Expression], profile: Optional[TransitionProfile]=None) -> TransitionProfile:
+        """Record how often the transitions of the matcher lead to a match for a sample of subjects.
+
+        Every subject is matched completely. This also includes the transitions of the automata for the commutative
+        subpatterns. The statistics can be used to :meth:`reorder` the transitions.
+
+        Args:
+            subjects:
+                The sample subjects.
+            profile:
+                An existing profile to add the statistics to. By default, a new one is created.
+
+        Returns:
+            The profile with the recorded statistics.
+        """
+        if profile is None:
+            profile = TransitionProfile()
+        keys = dict((id(transition), key) for key, transition in self._transitions_with_keys())
+        previous = getattr(_profiling, 'active', None)
+        _profiling.active = (profile.counts, keys)
+        try:
+            for subject in subjects:
+                for _ in _MatchIter(self, subject):
+                    pass
+        finally:
+            _profiling.active = previous
+        return profile
+
+    def reorder(self, profile: TransitionProfile) -> None:
+        """Reorder the transitions of the matcher so that the ones most likely to lead to a match are tried first.
+
+        Among the transitions for the same head, the ones with a higher success rate in the profile are tried first.
+        The heads of each state are also ordered by their best transition. The interpreted matching always tries the
+        heads in the order of the subject's type hierarchy, but the code generated by the :class:`.CodeGenerator`
+        follows this order as well. The matches found are the same, only their order changes.
+
+        Args:
+            profile:
+                The profile recorded with :meth:`profile`.
+        """
+        rates = dict((id(transition), profile.success_rate(key)) for key, transition in self._transitions_with_keys())
+        self._reorder_transitions(rates)
+
+    def _reorder_transitions(self, rates: Dict[int, float]) -> None:
+        for state in self.states:
+            for transitions in state.transitions.values():
+                transitions.sort(key=lambda t: -rates[id(t)])
+            heads = sorted(state.transitions.items(), key=lambda item: -rates[id(item[1][0])])
+            state.transitions.clear()
+            state.transitions.update(heads)
+            if state.matcher is not None:
+                state.matcher.automaton._reorder_transitions(rates)
+
+    def minimize(self) -> MinimizationInfo:
+        """Merge the equivalent states of the automaton.
+
+        When patterns are added, only common prefixes of the patterns share states. The minimization also merges the
+        states for common suffixes, i.e. states that are final in the same way and have the same transitions to the
+        same states. Identical automata for commutative subpatterns within the same automaton are merged as well. This
+        is best done once after all patterns have been added, but it is still possible to add or remove patterns
+        afterwards:
+
+        >>> matcher = ManyToOneMatcher(Pattern(f(a, x_)), Pattern(f(b, x_)))
+        >>> matcher.minimize()
+        MinimizationInfo(states_before=8, states_after=5, transitions_before=7, transitions_after=5)
+
+        The transitions of the merged states are tagged with the patterns of all the merged states. This does not
+        change the matches, because a pattern can only reach a merged state along its own prefix.
+
+        Returns:
+            The number of states and transitions before and after the minimization, including the automata for the
+            commutative subpatterns.
+        """
+        states_before, transitions_before = self._size(set())
+        self._merge_states()
+        states_after, transitions_after = self._size(set())
+        return MinimizationInfo(states_before, states_after, transitions_before, transitions_after)
+
+    def _size(self, seen_matchers: Set[int]) -> Tuple[int, int]:
+        """Return the number of states and transitions of the automaton and the nested automata."""
+        state_count = len(self.states)
+        transition_count = 0
+        for state in self.states:
+            transition_count += sum(len(transitions) for transitions in state.transitions.values())
+            if state.matcher is not None and id(state.matcher) not in seen_matchers:
+                seen_matchers.add(id(state.matcher))
+                nested_states, nested_transitions = state.matcher.automaton._size(seen_matchers)
+                state_count += nested_states
+                transition_count += nested_transitions
+        return state_count, transition_count
+
+    def _merge_states(self) -> None:
+        # The states are created after their predecessors, so going backwards merges the successors of a state first
+        representatives = {}  # type: Dict[tuple, _State]
+        replacements = {}  # type: Dict[int, _State]
+        # Commutative matchers are only shared within the same automaton, so that removing patterns stays local
+        matchers = {}  # type: Dict[tuple, List[CommutativeMatcher]]
+        for state in reversed(self.states):
+            for transitions in state.transitions.values():
+                for i, transition in enumerate(transitions):
+                    target = replacements.get(transition.target.number)
+                    if target is not None:
+                        transitions[i] = transition._replace(target=target)
+            if state.matcher is not None:
+                state.matcher.automaton._merge_states()
+                equivalent_matchers = matchers.setdefault(state.matcher._merge_key(), [])
+                for matcher in equivalent_matchers:
+                    if matcher._is_equivalent(state.matcher):
+                        replacements[state.number] = state = state._replace(matcher=matcher)
+                        break
+                else:
+                    equivalent_matchers.append(state.matcher)
+            signature = (
+                state.number in self.finals, id(state.matcher),
+                tuple((head, tuple((t.label, t.variable_name, _freeze_substitution(t.subst), t.target.number)
+                                   for t in transitions)) for head, transitions in state.transitions.items())
+            )
+            representative = representatives.setdefault(signature, state)
+            if representative is not state:
+                for head, transitions in state.transitions.items():
+                    for transition, merged_transition in zip(transitions, representative.transitions[head]):
+                        merged_transition.patterns.update(transition.patterns)
+                        if transition.check_constraints:
+                            merged_transition.check_constraints.update(transition.check_constraints)
+                replacements[state.number] = representative
+        self.root = replacements.get(self.root.number, self.root)
+        merged_states = []
+        for state in self.states:
+            replacement = replacements.get(state.number, state)
+            if replacement.number == state.number:
+                merged_states.append(replacement)
+            else:
+                self.finals.discard(state.number)
+        self.states = merged_states
+        self._level_info = {}
+        self._rank_info = None
+
+    def _transitions_with_keys(self, path: Tuple[int, ...]=()) -> Iterator[Tuple[TransitionKey, _Transition]]:
+        """Yield all transitions of the matcher and the nested automata together with their keys."""
+        indices = dict((state.number, i) for i, state in enumerate(self.states))
+        for i, state in enumerate(self.states):
+            for transitions in state.transitions.values():
+                for transition in transitions:
+                    yield (path, i, indices[transition.target.number]), transition
+            if state.matcher is not None:
+                yield from state.matcher.automaton._transitions_with_keys(path + (i, ))
+
+    def _pattern_ranks(self) -> List[int]:
+        """Return the rank of every pattern, i.e. its position when ordered by decreasing priority."""
+        if self._rank_info is None:
+            order = sorted(range(len(self.patterns)), key=lambda i: -self.priorities[i])
+            ranks = [0] * len(order)
+            for rank, pattern_index in enumerate(order):
+                ranks[pattern_index] = rank
+            self._rank_info = (ranks, {})
+        return self._rank_info[0]
+
+    def _transition_rank(self, transition: _Transition) -> int:
+        """Return the best rank of the patterns that the transition can lead to."""
+        ranks, transition_ranks = self._rank_info
+        # The transitions are only replaced when adding a pattern, which resets the ranks, so their ids are stable
+        key = id(transition)
+        rank = transition_ranks.get(key)
+        if rank is None:
+            rank = transition_ranks[key] = min(map(ranks.__getitem__, transition.patterns))
+        return rank
+
+    def amatch(self, subject: Expression, max_steps: int=None, max_results: int=None, deadline: float=None,
+               executor=None) -> AsyncIterator[Tuple[Expression, Substitution]]:
+        """Asynchronously match the subject against all the matcher's patterns.
+
+        The matching is done in a thread of the *executor*, so that it does not block the event loop:
+
+        >>> async def print_matches():
+        ...     async for pattern, substitution in matcher.amatch(f(a, b)):
+        ...         print(pattern, substitution)
+
+        The matching is stopped once the iteration is stopped or its task is cancelled.
+        See :meth:`.MatchBudget.alimit` for details.
+
+        Args:
+            subject: The subject to match.
+            max_steps: If given, the matching is aborted after this many steps. See :class:`.MatchBudget`.
+            max_results: If given, at most this many matches are yielded.
+            deadline:
+                If given, the matching is aborted after this point in time as returned by :func:`time.monotonic`.
+            executor: The executor for the matching. Defaults to the default executor of the event loop.
 
         Yields:
             For every match, a tuple of the matching pattern and the match substitution.
+
+        Raises:
+            MatchBudgetExceeded:
+                If the maximum number of steps or the deadline is exceeded.
         """
-        return _MatchIter(self, subject)
+        budget = MatchBudget(max_steps, max_results, deadline)
+        return budget.alimit(lambda: _MatchIter(self, subject), executor)
 
     def is_match(self, subject: Expression) -> bool:
         """Check if the subject matches any of the matcher's patterns.
@@ -454,6 +996,16 @@ class ManyToOneMatcher:
         """
         return _MatchIter(self, subject).any()
 
+    def cache_info(self) -> SubjectCacheInfo:
+        """Report the statistics of the subject caches of all commutative operations in the patterns.
+
+        Returns:
+            The total number of cache hits, misses and evictions as well as the number of currently cached subjects
+            and the number of their cached matches.
+        """
+        infos = [state.matcher.cache_info() for state in self.states if state.matcher is not None]
+        return SubjectCacheInfo(*(sum(values) for values in zip(SubjectCacheInfo(0, 0, 0, 0, 0), *infos)))
+
     def _create_expression_transition(
             self, state: _State, expression: Expression, variable_name: Optional[str], index: int, subst=None
     ) -> _State:
@@ -477,7 +1029,9 @@ class ManyToOneMatcher:
                 break
         else:
             if commutative:
-                matcher = CommutativeMatcher(type(expression) if isinstance(expression, AssociativeOperation) else None)
+                matcher = CommutativeMatcher(
+                    type(expression) if isinstance(expression, AssociativeOperation) else None, self.subject_cache_size
+                )
             state = self._create_state(matcher)
             if variable_name is not None:
                 constraints = set(self.constraint_vars[variable_name] if variable_name in self.constraint_vars else [])
@@ -522,10 +1076,78 @@ class ManyToOneMatcher:
 
         return label, head
 
+    def _level_bounds(self, state: _State, associative: bool) -> Tuple[float, float]:
+        """Return the bounds for the number of operands that can still be matched from the state.
+
+        The bounds only count the operands of the current operation, i.e. those that are left when the state is
+        reached. They are computed lazily and cached until patterns are added.
+
+        Args:
+            state:
+                The state.
+            associative:
+                Whether the current operation is associative.
+
+        Returns:
+            The minimum and maximum number of operands. The maximum is infinite if a sequence variable can follow.
+            If no pattern can be completed from the state, the minimum is infinite.
+        """
+        key = (state.number, associative, False)
+        bounds = self._level_info.get(key)
+        if bounds is None:
+            if state.number in self.finals or OPERATION_END in state.transitions:
+                min_count, max_count = 0, 0
+            else:
+                min_count, max_count = math.inf, -math.inf
+            for min_step, max_step, next_state in self._level_steps(state, associative):
+                next_min, next_max = self._level_bounds(next_state, associative)
+                min_count = min(min_count, min_step + next_min)
+                max_count = max(max_count, max_step + next_max)
+            bounds = self._level_info[key] = (min_count, max_count)
+        return bounds
+
+    def _level_ends(self, state: _State, associative: bool) -> List[_State]:
+        """Return the states that can be reached after the end of the current operation from the state."""
+        key = (state.number, associative, True)
+        ends = self._level_info.get(key)
+        if ends is None:
+            ends = [t.target for t in state.transitions.get(OPERATION_END, [])]
+            for _, _, next_state in self._level_steps(state, associative):
+                ends.extend(self._level_ends(next_state, associative))
+            self._level_info[key] = ends
+        return ends
+
+    def _level_steps(self, state: _State, associative: bool) -> Iterator[Tuple[int, float, _State]]:
+        """Yield the next states in the current operation with the bounds for the operands matched to get there."""
+        for head, transitions in state.transitions.items():
+            if head is OPERATION_END:
+                continue
+            for transition in transitions:
+                label = transition.label
+                if label is _EPS:
+                    yield 0, 0, transition.target
+                elif is_operation(label):
+                    if transition.target.matcher is not None:
+                        for next_transitions in transition.target.transitions.values():
+                            for next_transition in next_transitions:
+                                yield 1, 1, next_transition.target
+                    else:
+                        inner_associative = issubclass(label, AssociativeOperation)
+                        for end_state in self._level_ends(transition.target, inner_associative):
+                            yield 1, 1, end_state
+                elif isinstance(label, Wildcard) and not isinstance(label, SymbolWildcard):
+                    if label.optional is not None:
+                        yield 0, 0, transition.target
+                    if label.fixed_size and not associative:
+                        yield 1, 1, transition.target
+                    else:
+                        yield label.min_count, math.inf, transition.target
+                else:
+                    yield 1, 1, transition.target
+
     def _create_state(self, matcher: 'CommutativeMatcher'=None) -> _State:
-        state = _State(ManyToOneMatcher._state_id, dict(), matcher)
+        state = _State(next(_state_numbers), dict(), matcher)
         self.states.append(state)
-        ManyToOneMatcher._state_id += 1
         return state
 
     @classmethod
@@ -698,8 +1320,6 @@ class ManyToOneMatcher:
                     graph.edge(name, 'n{}'.format(state.matcher.automaton.root.number))
             else:
                 attrs = {'shape': ('doublecircle' if state.number in self.finals else 'circle')}
-                if state.number in _VISITED:
-                    attrs['color'] = 'red'
                 graph.node(name, str(state.number), attrs)
                 if state.number in self.finals:
                     sp = state_patterns[state.number]
@@ -744,7 +1364,7 @@ class ManyToOneMatcher:
 class ManyToOneReplacer:
     """Class that contains a set of replacement rules and can apply them efficiently to an expression."""
 
-    def __init__(self, *rules):
+    def __init__(self, *rules, subject_cache_size: Optional[int]=None):
         """
         A replacement rule consists of a *pattern*, that is matched against any subexpression
         of the expression. If a match is found, the *replacement* callback of the rule is called with
@@ -758,21 +1378,75 @@ class ManyToOneReplacer:
         Args:
             *rules:
                 The replacement rules.
+            subject_cache_size:
+                The size of the subject caches of the underlying :class:`ManyToOneMatcher`.
         """
-        self.matcher = ManyToOneMatcher()
+        self.matcher = ManyToOneMatcher(subject_cache_size=subject_cache_size)
         for rule in rules:
             self.add(rule)
 
-    def add(self, rule: 'functions.ReplacementRule') -> None:
+    def add(self, rule: 'functions.ReplacementRule', priority: int=0) -> None:
         """Add a new rule to the replacer.
 
+        If multiple rules match the same subexpression, the one with the highest priority is applied. Rules with the
+        same priority are preferred in the order in which they were added, just like for :func:`.replace_all`.
+
         Args:
             rule:
                 The rule to add.
+            priority:
+                The priority of the rule.
+        """
+        self.matcher.add(rule.pattern, rule.replacement, priority)
+
+    def remove(self, rule: 'functions.ReplacementRule') -> None:
+        """Remove a rule from the replacer.
+
+        Args:
+            rule:
+                The rule to remove.
+
+        Raises:
+            ValueError:
+                If the replacer does not contain the rule.
+        """
+        removed = self.matcher.remove_where(lambda p, r: p == rule.pattern and r == rule.replacement)
+        if not removed:
+            raise ValueError("The replacer does not contain {!r}.".format(rule))
+
+    def replace_rules(self, rules: Iterable['functions.ReplacementRule']) -> None:
+        """Replace the rules of the replacer with the given ones.
+
+        Only the difference between the current and the new rules is applied to the matcher, so that changing a few
+        rules of a large rule set is fast. The difference is computed before the matcher is changed. The rules that
+        are kept keep their priority and are preferred over the new rules with the same priority. The new rules get the
+        default priority and are added in the given order.
+
+        Args:
+            rules:
+                The new rules.
         """
-        self.matcher.add(rule.pattern, rule.replacement)
+        # Patterns are not hashable, so the current rules are grouped by the hashable expressions of their patterns
+        current = {}  # type: Dict[Tuple[Expression, Any], List[int]]
+        for i, (pattern, replacement, _) in enumerate(self.matcher.patterns):
+            current.setdefault((pattern.expression, replacement), []).append(i)
+        kept = set()
+        added = []
+        for rule in rules:
+            indices = current.get((rule.pattern.expression, rule.replacement), ())
+            index = next((i for i in indices if self.matcher.patterns[i][0] == rule.pattern), None)
+            if index is not None:
+                kept.add(index)
+            elif rule not in added:
+                added.append(rule)
+        removed = set(range(len(self.matcher.patterns))) - kept
+        if removed:
+            self.matcher.remove_indices(removed)
+        for rule in added:
+            self.add(rule)
 
-    def replace(self, expression: Expression, max_count: int=math.inf) -> Union[Expression, Sequence[Expression]]:
+    def replace(self, expression: Expression, max_count: int=math.inf, max_steps: int=None,
+                deadline: float=None) -> Union[Expression, Sequence[Expression]]:
         """Replace all occurrences of the patterns according to the replacement rules.
 
         Args:
@@ -782,46 +1456,164 @@ class ManyToOneReplacer:
                 If given, at most *max_count* applications of the rules are performed. Otherwise, the rules
                 are applied until there is no more match. If the set of replacement rules is not confluent,
                 the replacement might not terminate without a *max_count* set.
+            max_steps:
+                If given, the replacement is aborted after this many matching steps in total.
+                See :class:`.MatchBudget`.
+            deadline:
+                If given, the replacement is aborted after this point in time as returned by :func:`time.monotonic`.
 
         Returns:
             The resulting expression after the application of the replacement rules. This can also be a sequence of
             expressions, if the root expression is replaced with a sequence of expressions by a rule.
+
+        Raises:
+            MatchBudgetExceeded:
+                If the maximum number of steps or the deadline is exceeded. The expression with the replacements done
+                so far is available as the :attr:`~.MatchBudgetExceeded.result` of the exception.
+        """
+        replacements = self._replacements_iter(expression, max_count)
+        budget = MatchBudget.create(max_steps, None, deadline)
+        if budget is not None:
+            replacements = budget.limit(replacements)
+        try:
+            for expression in replacements:
+                pass
+        except MatchBudgetExceeded as e:
+            e.result = expression
+            raise
+        return expression
+
+    async def areplace(self, expression: Expression, max_count: int=math.inf, max_steps: int=None,
+                       deadline: float=None, executor=None) -> Union[Expression, Sequence[Expression]]:
+        """Asynchronously replace all occurrences of the patterns according to the replacement rules.
+
+        This is the asynchronous version of :meth:`replace`. The replacement is done in a thread of the *executor*, so
+        that it does not block the event loop. It is stopped once the task is cancelled.
+
+        Args:
+            expression:
+                The expression to which the replacement rules are applied.
+            max_count:
+                If given, at most *max_count* applications of the rules are performed.
+            max_steps:
+                If given, the replacement is aborted after this many matching steps in total.
+            deadline:
+                If given, the replacement is aborted after this point in time as returned by :func:`time.monotonic`.
+            executor:
+                The executor for the replacement. Defaults to the default executor of the event loop.
+
+        Returns:
+            The resulting expression after the application of the replacement rules.
+
+        Raises:
+            MatchBudgetExceeded:
+                If the maximum number of steps or the deadline is exceeded. The expression with the replacements done
+                so far is available as the :attr:`~.MatchBudgetExceeded.result` of the exception.
         """
+        budget = MatchBudget(max_steps, None, deadline)
+        replacements = budget.alimit(lambda: self._replacements_iter(expression, max_count), executor)
+        try:
+            async for expression in replacements:
+                pass
+        except MatchBudgetExceeded as e:
+            e.result = expression
+            raise
+        return expression
+
+    def _replacements_iter(self, expression, max_count):
+        """Yield the expression after every replacement."""
         replaced = True
         replace_count = 0
         while replaced and replace_count < max_count:
             replaced = False
             for subexpr, pos in preorder_iter_with_position(expression):
-                try:
-                    replacement, subst = next(iter(self.matcher.match(subexpr)))
+                match = self.matcher.match_first(subexpr)
+                if match is not None:
+                    replacement, subst = match
                     result = replacement(**subst)
                     expression = functions.replace(expression, pos, result)
                     replaced = True
                     break
-                except StopIteration:
-                    pass
             replace_count += 1
-        return expression
-
+            if replaced:
+                yield expression
 
-Subgraph = BipartiteGraph[Tuple[int, int], Tuple[int, int], Substitution]
-Matching = Dict[Tuple[int, int], Tuple[int, int]]
 
+class _SubjectCache(object):
+    """The subjects seen by a :class:`CommutativeMatcher` together with their matches.
 
-class CommutativeMatcher(object):
+    The matches are stored as edges between the subject ids and the subpattern ids in the bipartite graph.
+    """
     __slots__ = (
-        'patterns', 'subjects', 'subjects_by_id', 'automaton', 'bipartite', 'associative', 'max_optional_count', 'anonymous_patterns'
+        'subjects', 'subjects_by_id', 'bipartite', 'recent_subjects', 'pins', 'next_subject_id', 'hits', 'misses',
+        'evictions'
     )
 
-    def __init__(self, associative: Optional[type]) -> None:
-        self.patterns = {}
+    def __init__(self) -> None:
         self.subjects = {}
         self.subjects_by_id = {}
-        self.automaton = ManyToOneMatcher()
         self.bipartite = BipartiteGraph()
+        self.recent_subjects = OrderedDict()
+        self.pins = {}  # type: Dict[int, int]
+        self.next_subject_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class CommutativeMatcher(object):
+    __slots__ = (
+        'patterns', 'automaton', 'associative', 'max_optional_count', 'anonymous_patterns', '_index', 'cache_size',
+        '_local', '_next_id'
+    )
+
+    def __init__(self, associative: Optional[type], cache_size: Optional[int]=None) -> None:
+        self.patterns = {}
+        self.automaton = ManyToOneMatcher(subject_cache_size=cache_size)
         self.associative = associative
         self.max_optional_count = 0
         self.anonymous_patterns = set()
+        self._index = None
+        self._next_id = 0
+        self._init_cache(cache_size)
+
+    def _init_cache(self, cache_size: Optional[int]=None) -> None:
+        """Set up the cache for the subjects and their matches.
+
+        The subjects are cached together with their matches in the bipartite graph. If the cache size is not `None`,
+        the least recently used subjects are evicted once a match is done and the cache is bigger than the size.
+        Subjects are never evicted while a match that uses them is still running, so that their ids stay valid.
+
+        Every thread gets its own cache, so that the matcher can be used from multiple threads without locking.
+        """
+        self.cache_size = cache_size
+        self._local = threading.local()
+
+    @property
+    def _cache(self) -> _SubjectCache:
+        try:
+            return self._local.cache
+        except AttributeError:
+            cache = self._local.cache = _SubjectCache()
+            return cache
+
+    @property
+    def subjects(self) -> Dict[Expression, Tuple[int, Set[int]]]:
+        return self._cache.subjects
+
+    @property
+    def subjects_by_id(self) -> Dict[int, Expression]:
+        return self._cache.subjects_by_id
+
+    @property
+    def bipartite(self) -> BipartiteGraph:
+        return self._cache.bipartite
+
+    def cache_info(self) -> SubjectCacheInfo:
+        cache = self._cache
+        edges = sum(len(substitutions) for substitutions in cache.bipartite.values())
+        info = (cache.hits, cache.misses, cache.evictions, len(cache.recent_subjects), edges)
+        return SubjectCacheInfo(*(a + b for a, b in zip(info, self.automaton.cache_info())))
 
     def add_pattern(self, operands: Iterable[Expression], constraints) -> int:
         pattern_set, pattern_vars = self._extract_sequence_wildcards(operands, constraints)
@@ -829,12 +1621,48 @@ class CommutativeMatcher(object):
         sorted_subpatterns = tuple(sorted(pattern_set))
         pattern_key = sorted_subpatterns + sorted_vars
         if pattern_key not in self.patterns:
-            inserted_id = len(self.patterns)
+            inserted_id = self._next_id
+            self._next_id += 1
             self.patterns[pattern_key] = (inserted_id, pattern_set, sorted_vars)
+            self._index = None
         else:
             inserted_id = self.patterns[pattern_key][0]
         return inserted_id
 
+    def _remove_unused_patterns(self, used_ids: Set[int]) -> None:
+        """Remove the subpatterns that are not in *used_ids* and the operand patterns only they used.
+
+        The ids of the remaining subpatterns stay the same, because they are used as labels in the outer automaton.
+        """
+        self.patterns = dict((key, entry) for key, entry in self.patterns.items() if entry[0] in used_ids)
+        used_operands = set()
+        for _, pattern_set, _ in self.patterns.values():
+            used_operands.update(pattern_set.distinct_elements())
+        unused_operands = set(range(len(self.automaton.patterns))) - used_operands
+        if unused_operands:
+            operand_map = self.automaton.remove_indices(unused_operands)
+            patterns = {}
+            for inserted_id, pattern_set, sorted_vars in self.patterns.values():
+                pattern_set = Multiset(dict((operand_map[i], count) for i, count in pattern_set.items()))
+                patterns[tuple(sorted(pattern_set)) + sorted_vars] = (inserted_id, pattern_set, sorted_vars)
+            self.patterns = patterns
+            self.anonymous_patterns = set(operand_map[i] for i in self.anonymous_patterns if i in operand_map)
+        self._index = None
+        # The cached matches refer to the old operand patterns
+        self._init_cache(self.cache_size)
+
+    def _merge_key(self) -> tuple:
+        """Return a key which is the same for all equivalent matchers, see :meth:`_is_equivalent`."""
+        return (self.associative, self.max_optional_count, tuple(self.patterns), len(self.automaton.patterns))
+
+    def _is_equivalent(self, other: 'CommutativeMatcher') -> bool:
+        """Check whether the other matcher has the same patterns, so that it can be used in place of this one."""
+        return (
+            self.associative is other.associative and self.max_optional_count == other.max_optional_count and
+            self.anonymous_patterns == other.anonymous_patterns and self.patterns == other.patterns and
+            [(p, c) for p, _, c in self.automaton.patterns] == [(p, c) for p, _, c in other.automaton.patterns]
+        )
+
     def get_match_iter(self, subject):
         match_iter = _MatchIter(self.automaton, subject, self.associative)
         for _ in match_iter._match(self.automaton.root):
@@ -844,51 +1672,151 @@ class CommutativeMatcher(object):
 
 
     def add_subject(self, subject: Expression) -> None:
-        if subject not in self.subjects:
-            subject_id, pattern_set = self.subjects[subject] = (len(self.subjects), set())
-            self.subjects_by_id[subject_id] = subject
+        cache = self._cache
+        if subject not in cache.subjects:
+            subject_id, pattern_set = cache.subjects[subject] = (cache.next_subject_id, set())
+            cache.next_subject_id += 1
+            cache.subjects_by_id[subject_id] = subject
             for pattern_index, substitution in self.get_match_iter(subject):
-                self.bipartite.setdefault((subject_id, pattern_index), []).append(Substitution(substitution))
+                cache.bipartite.setdefault((subject_id, pattern_index), []).append(Substitution(substitution))
                 pattern_set.add(pattern_index)
+            if subject is not None:
+                cache.misses += 1
+                cache.recent_subjects[subject] = None
         else:
-            subject_id, _ = self.subjects[subject]
+            subject_id, _ = cache.subjects[subject]
+            if subject is not None:
+                cache.hits += 1
+                cache.recent_subjects.move_to_end(subject)
         return subject_id
 
+    def _evict_subjects(self, cache: _SubjectCache) -> None:
+        if self.cache_size is None:
+            return
+        excess = len(cache.recent_subjects) - self.cache_size
+        for subject in list(cache.recent_subjects):
+            if excess <= 0:
+                break
+            subject_id, _ = cache.subjects[subject]
+            if subject_id in cache.pins:
+                continue
+            del cache.recent_subjects[subject]
+            del cache.subjects[subject]
+            del cache.subjects_by_id[subject_id]
+            cache.bipartite.remove_left_node(subject_id)
+            cache.evictions += 1
+            excess -= 1
+
     def match(self, subjects: Sequence[Expression], substitution: Substitution) -> Iterator[Tuple[int, Substitution]]:
-        subject_ids = Multiset()
+        cache = self._cache
+        # The distinct subjects are numbered densely for this match, so that the remaining subjects can be tracked as
+        # a tuple of counts indexed by these positions
+        subject_ids = []  # type: List[int]
+        subject_counts = []  # type: List[int]
+        positions = {}  # type: Dict[int, int]
         pattern_ids = Multiset()
         if self.max_optional_count > 0:
-            subject_id, subject_pattern_ids = self.subjects[None]
-            subject_ids.add(subject_id)
+            subject_id = self.add_subject(None)
+            subject_pattern_ids = cache.subjects[None][1]
+            positions[subject_id] = 0
+            subject_ids.append(subject_id)
+            subject_counts.append(1)
             for _ in range(self.max_optional_count):
                 pattern_ids.update(subject_pattern_ids)
         for subject in op_iter(subjects):
-            subject_id, subject_pattern_ids = self.subjects[subject]
-            subject_ids.add(subject_id)
+            subject_id, subject_pattern_ids = cache.subjects[subject]
+            position = positions.get(subject_id)
+            if position is None:
+                positions[subject_id] = len(subject_ids)
+                subject_ids.append(subject_id)
+                subject_counts.append(1)
+            else:
+                subject_counts[position] += 1
             pattern_ids.update(subject_pattern_ids)
-        for pattern_index, pattern_set, pattern_vars in self.patterns.values():
+        for subject_id in subject_ids:
+            cache.pins[subject_id] = cache.pins.get(subject_id, 0) + 1
+        try:
+            yield from self._match(subjects, substitution, subject_ids, tuple(subject_counts), pattern_ids)
+        finally:
+            for subject_id in subject_ids:
+                cache.pins[subject_id] -= 1
+                if not cache.pins[subject_id]:
+                    del cache.pins[subject_id]
+            self._evict_subjects(cache)
+
+    def _match(self, subjects, substitution, subject_ids, subject_counts, pattern_ids):
+        subjects_by_id = self.subjects_by_id
+        # The positions of the actual subjects, i.e. without the empty subject used for optional subpatterns
+        value_positions = [i for i, subject_id in enumerate(subject_ids) if subjects_by_id[subject_id] is not None]
+        values = [subjects_by_id[subject_ids[i]] for i in value_positions]
+        for pattern_index, pattern_set, pattern_vars in self._candidate_patterns(pattern_ids, op_len(subjects)):
             if pattern_set:
-                if not pattern_set <= pattern_ids:
-                    continue
-                bipartite_match_iter = self._match_with_bipartite(subject_ids, pattern_set, substitution)
-                for bipartite_substitution, matched_subjects in bipartite_match_iter:
-                    ids = subject_ids - matched_subjects
-                    remaining = Multiset(self.subjects_by_id[id] for id in ids if self.subjects_by_id[id] is not None)
+                bipartite_match_iter = self._match_with_bipartite(
+                    subject_ids, subject_counts, pattern_set, substitution
+                )
+                for bipartite_substitution, remaining in bipartite_match_iter:
+                    remaining_counts = [remaining[i] for i in value_positions]
                     if pattern_vars:
                         sequence_var_iter = self._match_sequence_variables(
-                            remaining, pattern_vars, bipartite_substitution
+                            values, remaining_counts, pattern_vars, bipartite_substitution
                         )
                         for result_substitution in sequence_var_iter:
                             yield pattern_index, result_substitution
-                    elif len(remaining) == 0:
+                    elif not any(remaining_counts):
                         yield pattern_index, bipartite_substitution
             elif pattern_vars:
-                sequence_var_iter = self._match_sequence_variables(Multiset(op_iter(subjects)), pattern_vars, substitution)
+                value_counts = [subject_counts[i] for i in value_positions]
+                sequence_var_iter = self._match_sequence_variables(values, value_counts, pattern_vars, substitution)
                 for variable_substitution in sequence_var_iter:
                     yield pattern_index, variable_substitution
             elif op_len(subjects) == 0:
                 yield pattern_index, substitution
 
+    def _candidate_patterns(self, pattern_ids: MultisetOfInt, subject_count: int):
+        """Return the patterns that can possibly match subjects with the given subpattern matches.
+
+        Instead of testing every pattern, the inverted index is used to count for every pattern how many of its distinct
+        subpatterns are matched often enough. Only the patterns where this holds for all subpatterns and that can cover
+        the number of subjects are returned. The patterns are returned in the order they were added.
+        """
+        index = getattr(self, '_index', None)
+        if index is None:
+            index = self._index = self._build_index()
+        patterns_by_subpattern, free_patterns, pattern_info = index
+        hits = {}  # type: Dict[int, int]
+        for subpattern, count in pattern_ids.items():
+            for pattern_index, required_count in patterns_by_subpattern.get(subpattern, ()):
+                if count >= required_count:
+                    hits[pattern_index] = hits.get(pattern_index, 0) + 1
+        candidates = [i for i, hit_count in hits.items() if hit_count == pattern_info[i][1]]
+        candidates.extend(free_patterns)
+        candidates.sort()
+        result = []
+        for pattern_index in candidates:
+            entry, _, min_length, max_length = pattern_info[pattern_index]
+            if min_length <= subject_count and (max_length is None or subject_count <= max_length):
+                result.append(entry)
+        return result
+
+    def _build_index(self):
+        # Maps each subpattern to the patterns containing it together with the number of times it occurs in them
+        patterns_by_subpattern = {}  # type: Dict[int, List[Tuple[int, int]]]
+        free_patterns = []  # type: List[int]
+        # Maps each pattern to its entry, number of distinct subpatterns and bounds for the number of subjects
+        pattern_info = {}  # type: Dict[int, Tuple[tuple, int, int, Optional[int]]]
+        for entry in self.patterns.values():
+            pattern_index, pattern_set, pattern_vars = entry
+            for subpattern, count in pattern_set.items():
+                patterns_by_subpattern.setdefault(subpattern, []).append((pattern_index, count))
+            if not pattern_set:
+                free_patterns.append(pattern_index)
+            required_var_count = sum(count * min_count for (_, count, min_count, default), _ in pattern_vars
+                                     if default is None)
+            min_length = max(len(pattern_set) + required_var_count - self.max_optional_count, 0)
+            max_length = None if pattern_vars else len(pattern_set)
+            pattern_info[pattern_index] = (entry, len(pattern_set.distinct_elements()), min_length, max_length)
+        return patterns_by_subpattern, free_patterns, pattern_info
+
     def _extract_sequence_wildcards(self, operands: Iterable[Expression],
                                     constraints) -> Tuple[MultisetOfInt, Dict[str, Tuple[VariableWithCount, bool]]]:
         pattern_set = Multiset()
@@ -942,82 +1870,138 @@ class CommutativeMatcher(object):
 
     def _match_with_bipartite(
             self,
-            subject_ids: MultisetOfInt,
+            subject_ids: Sequence[int],
+            subject_counts: Tuple[int, ...],
             pattern_set: MultisetOfInt,
             substitution: Substitution,
-    ) -> Iterator[Tuple[Substitution, MultisetOfInt]]:
-        bipartite = self._build_bipartite(subject_ids, pattern_set)
-        for matching in enum_maximum_matchings_iter(bipartite):
-            if len(matching) < len(pattern_set):
-                break
-            if not self._is_canonical_matching(matching):
+    ) -> Iterator[Tuple[Substitution, Tuple[int, ...]]]:
+        """Enumerate the ways to distribute the subjects among the subpatterns.
+
+        Instead of expanding every subject and subpattern into one node per occurrence, the matching is done on the
+        counts: For every subpattern, the number of its occurrences that each subject is matched to is chosen as an
+        integer vector. Hence, matchings that only differ by permuting equal subjects or equal subpatterns are never
+        generated. Anonymous subpatterns that can match the same subjects are interchangeable, so they are merged into
+        a single subpattern with their combined count.
+
+        Args:
+            subject_ids:
+                The ids of the distinct subjects.
+            subject_counts:
+                The number of occurrences of each subject in the same order as the *subject_ids*.
+            pattern_set:
+                The subpatterns to match.
+            substitution:
+                The substitution to extend.
+
+        Yields:
+            The substitution for each distribution together with the counts of the subjects that remain unmatched.
+        """
+        adjacency = self._build_bipartite(subject_ids, pattern_set)
+        factories = []
+        anonymous_counts = {}  # type: Dict[FrozenSet[int], List[int]]
+        for pattern in sorted(pattern_set.distinct_elements(), key=lambda p: len(adjacency[p])):
+            if pattern in self.anonymous_patterns:
+                anonymous_counts.setdefault(frozenset(adjacency[pattern]), [pattern, 0])[1] += pattern_set[pattern]
+            else:
+                factories.append(
+                    self._pattern_count_factory(pattern, pattern_set[pattern], adjacency[pattern], subject_ids)
+                )
+        anonymous_factories = [
+            self._pattern_count_factory(pattern, count, adjacency[pattern], subject_ids)
+            for pattern, count in anonymous_counts.values()
+        ]
+        for remaining, bipartite_substitution in generator_chain((subject_counts, substitution), *factories):
+            if not anonymous_factories:
+                yield bipartite_substitution, remaining
                 continue
-            for substs in itertools.product(*(bipartite[edge] for edge in matching.items())):
-                try:
-                    bipartite_substitution = substitution.union(*substs)
-                except ValueError:
+            # Anonymous subpatterns do not bind any variables, so only the set of subjects they consume matters
+            seen = set()
+            for anonymous_remaining, _ in generator_chain((remaining, bipartite_substitution), *anonymous_factories):
+                if anonymous_remaining not in seen:
+                    seen.add(anonymous_remaining)
+                    yield bipartite_substitution, anonymous_remaining
+
+    def _pattern_count_factory(self, pattern: int, count: int, positions: Sequence[int], subject_ids: Sequence[int]):
+        anonymous = pattern in self.anonymous_patterns
+        bipartite = self.bipartite
+
+        def factory(data):
+            remaining, substitution = data
+            candidates = [p for p in positions if remaining[p]]
+            capacities = [remaining[p] for p in candidates]
+            for counts in fixed_integer_vector_iter(capacities, count):
+                step()
+                new_remaining = list(remaining)
+                choices = []
+                for position, subject_count in zip(candidates, counts):
+                    if subject_count:
+                        new_remaining[position] -= subject_count
+                        if not anonymous:
+                            edges = bipartite[subject_ids[position], pattern]
+                            choices.append(itertools.combinations_with_replacement(edges, subject_count))
+                new_remaining = tuple(new_remaining)
+                if anonymous:
+                    yield new_remaining, substitution
                     continue
-                matched_subjects = Multiset(subexpression for subexpression, _ in matching)
-                yield bipartite_substitution, matched_subjects
+                for substs in itertools.product(*choices):
+                    try:
+                        new_substitution = substitution.union(*itertools.chain.from_iterable(substs))
+                    except ValueError:
+                        continue
+                    yield new_remaining, new_substitution
+
+        return factory
 
     def _match_sequence_variables(
             self,
-            subjects: MultisetOfExpression,
+            subjects: Sequence[Expression],
+            subject_counts: Sequence[int],
             pattern_vars: Sequence[VariableWithCount],
             substitution: Substitution,
     ) -> Iterator[Substitution]:
         only_counts = [info for info, _ in pattern_vars]
-        wrapped_vars = [name for (name, _, _, _), wrap in pattern_vars if wrap and name]
-        for variable_substitution in commutative_sequence_variable_partition_iter(subjects, only_counts):
-            for var in wrapped_vars:
-                operands = variable_substitution[var]
-                if isinstance(operands, (tuple, list, Multiset)):
-                    if len(operands) > 1:
-                        variable_substitution[var] = self.associative(*operands)
-                    else:
-                        variable_substitution[var] = next(iter(operands))
+        # Variables that are already in the substitution come first, so that conflicts are found before any other
+        # multisets are created for the candidate
+        order = sorted(
+            (i for i, (name, _, _, _) in enumerate(only_counts) if name is not None),
+            key=lambda i: only_counts[i].name not in substitution
+        )
+        # The same count vectors recur in many candidates, so their values are only created once
+        values = {}  # type: Dict[Tuple[int, Tuple[int, ...]], Union[Expression, MultisetOfExpression]]
+        for count_vectors in commutative_sequence_variable_partition_count_iter(subject_counts, only_counts):
+            step()
+            result_substitution = Substitution(substitution)
             try:
-                result_substitution = substitution.union(variable_substitution)
+                for i in order:
+                    name, _, _, default = only_counts[i]
+                    count_vector = count_vectors[i]
+                    if default is not None and not any(count_vector):
+                        value = default
+                    else:
+                        value = values.get((i, count_vector))
+                        if value is None:
+                            value = Multiset(dict(zip(subjects, count_vector)))
+                            if pattern_vars[i][1]:
+                                value = self.associative(*value) if len(value) > 1 else next(iter(value))
+                            values[i, count_vector] = value
+                        if isinstance(value, Multiset):
+                            value = value.copy()
+                    if name in result_substitution:
+                        result_substitution.try_add_variable(name, value)
+                    else:
+                        result_substitution[name] = value
             except ValueError:
                 continue
             yield result_substitution
 
-    def _build_bipartite(self, subjects: MultisetOfInt, patterns: MultisetOfInt) -> Subgraph:
-        bipartite = BipartiteGraph()
-        n = 0
-        m = 0
-        p_states = {}
-        for subject, s_count in subjects.items():
-            if (LEFT, subject) in self.bipartite._graph:
-                any_patterns = False
-                for _, pattern in self.bipartite._graph[LEFT, subject]:
-                    if pattern in patterns:
-                        any_patterns = True
-                        subst = self.bipartite[subject, pattern]
-                        p_count = patterns[pattern]
-                        if pattern in p_states:
-                            p_start = p_states[pattern]
-                        else:
-                            p_start = p_states[pattern] = m
-                            m += p_count
-                        for i in range(n, n + s_count):
-                            for j in range(p_start, p_start + p_count):
-                                bipartite[(subject, i), (pattern, j)] = subst
-                if any_patterns:
-                    n += s_count
-
-        return bipartite
-
-    def _is_canonical_matching(self, matching: Matching) -> bool:
-        anonymous_patterns = self.anonymous_patterns
-        for (s1, n1), (p1, m1) in matching.items():
-            for (s2, n2), (p2, m2) in matching.items():
-                if p1 in anonymous_patterns and p2 in anonymous_patterns:
-                    if n1 < n2 and m1 > m2:
-                        return False
-                elif s1 == s2 and n1 < n2 and m1 > m2:
-                    return False
-        return True
+    def _build_bipartite(self, subject_ids: Sequence[int], patterns: MultisetOfInt) -> Dict[int, List[int]]:
+        """Return the positions of the subjects that can be matched by each of the subpatterns."""
+        adjacency = dict((pattern, []) for pattern in patterns.distinct_elements())
+        for position, subject in enumerate(subject_ids):
+            for pattern in self.bipartite.right_neighbours(subject):
+                if pattern in adjacency:
+                    adjacency[pattern].append(position)
+        return adjacency
 
     def bipartite_as_graph(self) -> Graph:  # pragma: no cover
         """Returns a :class:`graphviz.Graph` representation of this bipartite graph."""
@@ -1048,83 +2032,110 @@ class CommutativeMatcher(object):
         """Returns a :class:`graphviz.Graph` representation of this bipartite graph."""
         if Graph is None:
             raise ImportError('The graphviz package is required to draw the graph.')
-        bipartite = self._build_bipartite(subjects, patterns)
+        subject_ids = list(subjects.distinct_elements())
+        adjacency = self._build_bipartite(subject_ids, patterns)
         graph = Graph()
-        nodes_left = {}  # type: Dict[TLeft, str]
-        nodes_right = {}  # type: Dict[TRight, str]
-        node_id = 0
-        for (left, right), value in bipartite._edges.items():
-            if left not in nodes_left:
-                subject_id, i = left
-                name = 'node{:d}'.format(node_id)
-                nodes_left[left] = name
-                label = '{}, {}'.format(i, self.subjects_by_id[subject_id])
-                graph.node(name, label=label)
-                node_id += 1
-            if right not in nodes_right:
-                pattern, i = right
-                name = 'node{:d}'.format(node_id)
-                nodes_right[right] = name
-                label = '{}, {}'.format(i, self.automaton.patterns[pattern][0])
-                graph.node(name, label=label)
-                node_id += 1
-            edge_label = value is not True and str(value) or ''
-            graph.edge(nodes_left[left], nodes_right[right], edge_label)
+        for subject, count in subjects.items():
+            graph.node('s{:d}'.format(subject), label='{}x {}'.format(count, self.subjects_by_id[subject]))
+        for pattern, pattern_subjects in adjacency.items():
+            name = 'p{:d}'.format(pattern)
+            graph.node(name, label='{}x {}'.format(patterns[pattern], self.automaton.patterns[pattern][0]))
+            for subject in map(subject_ids.__getitem__, pattern_subjects):
+                value = self.bipartite[subject, pattern]
+                graph.edge('s{:d}'.format(subject), name, ', '.join(map(str, value)))
         return graph
 
 
-class SecondaryAutomaton():  # pragma: no cover
-    # TODO: Decide whether to integrate this
-    def __init__(self, k):
+class SecondaryAutomaton:
+    """Precomputed automaton for the bipartite matching problems of small commutative patterns.
+
+    The automaton decides whether a bipartite graph between subject operands and *k* subpatterns has a matching
+    that covers all the subpatterns. Every subject operand is represented by the bitmask of the subpatterns it
+    matches. Each state of the automaton represents the (downward closed) family of subpattern sets that can be
+    covered with the subject operands read so far, so the automaton only depends on *k* and can be shared between
+    all commutative matchers.
+
+    The :class:`CommutativeMatcher` does not use it: Its search over the subject counts of each subpattern rejects
+    the subjects without a matching about as fast, so checking them with the automaton first does not pay off (see
+    ``benchmarks/secondary_automaton.py``).
+    """
+
+    _instances = {}  # type: Dict[int, SecondaryAutomaton]
+
+    def __init__(self, k: int) -> None:
+        """
+        Args:
+            k:
+                The number of subpatterns, i.e. the size of the right part of the bipartite graph.
+        """
         self.k = k
         self.states = self._build(k)
+        full = 2**k - 1
+        self.accepting = frozenset(i for i, (_, masks) in enumerate(self.states) if full in masks)
+
+    @classmethod
+    def get(cls, k: int) -> 'SecondaryAutomaton':
+        """Return the (cached) automaton for *k* subpatterns."""
+        try:
+            return cls._instances[k]
+        except KeyError:
+            automaton = cls._instances[k] = cls(k)
+            return automaton
 
-    def match(self, edges):
-        raise NotImplementedError
+    def match(self, edges: Iterable[int]) -> bool:
+        """Check whether the subjects can be matched to all of the subpatterns.
+
+        Args:
+            edges:
+                For every subject, the bitmask of the subpatterns it can be matched to.
+
+        Returns:
+            True, iff there is a matching that covers all the subpatterns.
+        """
+        states = self.states
+        accepting = self.accepting
+        state = 0
+        for mask in edges:
+            state = states[state][0].get(mask, state)
+            if state in accepting:
+                return True
+        return state in accepting
 
     @staticmethod
-    def _build(k):
-        states = dict()
-        queue = [frozenset([0])]
+    def _build(k: int) -> List[Tuple[Dict[int, int], FrozenSet[int]]]:
+        initial = frozenset([0])
+        states = {initial: {}}
+        queue = deque([initial])
+        order = [initial]
 
         while queue:
-            state_id = queue.pop(0)
-            state = states[state_id] = dict()
-            for i in range(1, 2**k):
-                new_state = set()
-                for t in [2**j for j in range(k) if i & 2**j]:
-                    for v in state_id:
-                        new_state.add(t | v)
-                new_state = frozenset(new_state - state_id)
-                if new_state:
-                    if new_state != state_id:
-                        state[i] = new_state
-                    if new_state not in states and new_state not in queue:
-                        queue.append(new_state)
-
-        keys = sorted(states.keys())
-        new_states = []
-
-        for state in keys:
-            new_states.append(states[state])
-
-        for i, state in enumerate(new_states):
-            new_state = dict()
-            for key, value in state.items():
-                new_state[key] = keys.index(value)
-            new_states[i] = new_state
-
-        return new_states
-
-    def as_graph(self):
+            masks = queue.popleft()
+            transitions = states[masks]
+            for edges in range(1, 2**k):
+                new_masks = set(masks)
+                for bit in (1 << j for j in range(k) if edges & (1 << j)):
+                    new_masks.update(mask | bit for mask in masks if not mask & bit)
+                new_masks = frozenset(new_masks)
+                if new_masks != masks:
+                    transitions[edges] = new_masks
+                    if new_masks not in states:
+                        states[new_masks] = {}
+                        order.append(new_masks)
+                        queue.append(new_masks)
+
+        indices = dict((masks, i) for i, masks in enumerate(order))
+
+        return [(dict((e, indices[t]) for e, t in states[masks].items()), masks) for masks in order]
+
+    def as_graph(self) -> Digraph:  # pragma: no cover
         if Digraph is None:
             raise ImportError('The graphviz package is required to draw the graph.')
         graph = Digraph()
         for i in range(len(self.states)):
-            graph.node(str(i), str(i))
+            graph.node(str(i), str(i), {'shape': ('doublecircle' if i in self.accepting else 'circle')})
 
-        for state, edges in enumerate(self.states):
-            for target, labels in itertools.groupby(sorted(edges.items()), key=itemgetter(1)):
+        for state, (edges, _) in enumerate(self.states):
+            for target, labels in itertools.groupby(sorted(edges.items(), key=itemgetter(1)), key=itemgetter(1)):
                 label = '\n'.join(bin(l)[2:].zfill(self.k) for l, _ in labels)
                 graph.edge(str(state), str(target), label)
 
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from typing import Iterable, Iterator, List, Sequence, Tuple, cast, Set
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple, cast, Set
 
 from multiset import Multiset
 
@@ -12,15 +12,17 @@ from ..expressions.functions import (
     is_constant, preorder_iter_with_position, match_head, create_operation_expression, op_iter, op_len
 )
 from ..utils import (
-    VariableWithCount, commutative_sequence_variable_partition_iter, fixed_integer_vector_iter, weak_composition_iter,
-    generator_chain, optional_iter
+    VariableWithCount, commutative_sequence_variable_partition_iter, fixed_integer_vector_iter, generator_chain,
+    optional_iter
 )
 from ._common import CommutativePatternsParts, check_one_identity
+from .budget import MatchBudget, step
 
 __all__ = ['match', 'match_anywhere']
 
 
-def match(subject: Expression, pattern: Pattern) -> Iterator[Substitution]:
+def match(subject: Expression, pattern: Pattern, max_steps: int=None, max_results: int=None,
+          deadline: float=None) -> Iterator[Substitution]:
     r"""Tries to match the given *pattern* to the given *subject*.
 
     Yields each match in form of a substitution.
@@ -30,6 +32,12 @@ def match(subject: Expression, pattern: Pattern) -> Iterator[Substitution]:
             An subject to match.
         pattern:
             The pattern to match.
+        max_steps:
+            If given, the matching is aborted after this many steps. See :class:`.MatchBudget`.
+        max_results:
+            If given, at most this many matches are yielded.
+        deadline:
+            If given, the matching is aborted after this point in time as returned by :func:`time.monotonic`.
 
     Yields:
         All possible match substitutions.
@@ -37,9 +45,15 @@ def match(subject: Expression, pattern: Pattern) -> Iterator[Substitution]:
     Raises:
         ValueError:
             If the subject is not constant.
+        MatchBudgetExceeded:
+            If the maximum number of steps or the deadline is exceeded.
     """
     if not is_constant(subject):
         raise ValueError("The subject for matching must be constant.")
+    budget = MatchBudget.create(max_steps, max_results, deadline)
+    if budget is not None:
+        yield from budget.limit(match(subject, pattern))
+        return
     global_constraints = [c for c in pattern.constraints if not c.variables]
     local_constraints = set(c for c in pattern.constraints if c.variables)
     for subst in _match([subject], pattern.expression, Substitution(), local_constraints):
@@ -81,6 +95,7 @@ def match_anywhere(subject: Expression, pattern: Pattern) -> Iterator[Tuple[Subs
 
 def _match(subjects: List[Expression], pattern: Expression, subst: Substitution,
            constraints: Set[Constraint]) -> Iterator[Substitution]:
+    step()
     match_iter = None
     expr = subjects[0] if subjects else None
     if isinstance(pattern, Wildcard):
@@ -216,15 +231,106 @@ def _build_full_partition(
     return result
 
 
+_Segment = Tuple[int, int, int, List[Tuple[int, int, Symbol]]]
+
+_SEQUENCE_LAYOUT_CACHE_SIZE = 1024
+_sequence_layouts = {}  # type: Dict[int, Tuple[Operation, List[_Segment]]]
+
+
+def _sequence_layout(operation: Operation) -> List[_Segment]:
+    """Return the segments of the operands of the *operation* between its sequence variables.
+
+    Each segment is a tuple ``(length, first_optional, end_optional, anchors)``. The length is the minimum number of
+    subject operands in the segment, which grows by one for every optional wildcard with an index in
+    ``range(first_optional, end_optional)`` that gets an operand. The anchors are the symbol operands in the segment
+    as tuples ``(offset, end_optional, symbol)``, where the offset grows likewise for the optional wildcards before the
+    symbol.
+
+    The layout only depends on the pattern, so it is computed once per operation and cached.
+    """
+    cached = _sequence_layouts.get(id(operation))
+    if cached is not None and cached[0] is operation:
+        return cached[1]
+    associative = isinstance(operation, AssociativeOperation)
+    segments = []
+    length = 0
+    anchors = []  # type: List[Tuple[int, int, Symbol]]
+    first_optional = opt_index = 0
+    for operand in op_iter(operation):
+        if isinstance(operand, Wildcard):
+            if not operand.fixed_size or associative:
+                if operand.optional is None:
+                    length += operand.min_count
+                segments.append((length, first_optional, opt_index, anchors))
+                length = 0
+                anchors = []
+                first_optional = opt_index
+            elif operand.optional is not None:
+                opt_index += 1
+            else:
+                length += operand.min_count
+        else:
+            if isinstance(operand, Symbol):
+                anchors.append((length, opt_index, operand))
+            length += 1
+    segments.append((length, first_optional, opt_index, anchors))
+    if len(_sequence_layouts) >= _SEQUENCE_LAYOUT_CACHE_SIZE:
+        _sequence_layouts.clear()
+    # The operation is kept in the cache, so that its id cannot be reused while the entry exists
+    _sequence_layouts[id(operation)] = (operation, segments)
+    return segments
+
+
+def _anchored_composition_iter(
+        remaining: int, optional_parts: Sequence[int], subjects: Sequence[Expression], segments: List[_Segment]
+) -> Iterator[Tuple[int, ...]]:
+    """Yield the weak compositions of *remaining* among the sequence variables of an operation.
+
+    The compositions are yielded in the same order as by :func:`.weak_composition_iter`. However, the compositions
+    which would assign a subject operand to a symbol operand of the pattern, that cannot be matched by it, are skipped.
+    The symbols act as anchors: As soon as the extra operands for a sequence variable have been chosen, the position
+    of the symbols up to the next sequence variable is fixed and can be checked. Hence, impossible compositions are
+    pruned early instead of being enumerated and matched one by one.
+
+    The *segments* are the layout of the operation as returned by :func:`_sequence_layout`.
+    """
+    var_count = len(segments) - 1
+
+    def _composition_iter(var_index, start, rest):
+        length, first_optional, end_optional, anchors = segments[var_index]
+        for offset, anchor_optional, symbol in anchors:
+            if anchor_optional > first_optional:
+                offset += sum(optional_parts[first_optional:anchor_optional])
+            subject = subjects[start + offset]
+            if not isinstance(subject, type(symbol)) or subject.name != symbol.name:
+                return
+        if var_index == var_count:
+            if rest == 0:
+                yield ()
+            return
+        if end_optional > first_optional:
+            length += sum(optional_parts[first_optional:end_optional])
+        start += length
+        counts = range(rest + 1) if var_index < var_count - 1 else (rest, )
+        for count in counts:
+            for composition in _composition_iter(var_index + 1, start + count, rest - count):
+                yield (count, ) + composition
+
+    return _composition_iter(0, 0, remaining)
+
+
 def _non_commutative_match(subjects, operation, subst, constraints):
     try:
         remaining, sequence_var_count, optional_count = _count_seq_vars(subjects, operation)
     except ValueError:
         return
+    subject_operands = list(op_iter(subjects))
+    segments = _sequence_layout(operation)
     for new_remaining, optional in optional_iter(remaining, optional_count):
         if new_remaining < 0:
             continue
-        for part in weak_composition_iter(new_remaining, sequence_var_count):
+        for part in _anchored_composition_iter(new_remaining, optional, subject_operands, segments):
+            step()
             partition = _build_full_partition(optional, part, subjects, operation)
             factories = [_match_factory(e, o, constraints) for e, o in zip(partition, op_iter(operation))]
 
@@ -290,25 +396,36 @@ def _match_commutative_operation(
             subjects -= needed_count
             del fixed_vars[name]
 
-    factories = [_fixed_expr_factory(e, constraints) for e in rest_expr]
+    # The distinct subjects are numbered, so that the remaining subjects can be tracked as a tuple of their counts
+    elements = list(subjects.distinct_elements())
+    positions = dict((e, i) for i, e in enumerate(elements))
+    subject_counts = tuple(subjects[e] for e in elements)
+
+    factories = [_fixed_expr_factory(e, constraints, elements) for e in rest_expr]
 
     if not issubclass(pattern.operation, AssociativeOperation):
         for name, count in fixed_vars.items():
             min_count, symbol_type, default = pattern.fixed_variable_infos[name]
-            factory = _fixed_var_iter_factory(name, count, min_count, symbol_type, constraints, default)
+            factory = _fixed_var_iter_factory(
+                name, count, min_count, symbol_type, constraints, default, elements, positions
+            )
             factories.append(factory)
 
         if pattern.wildcard_fixed is True:
-            factory = _fixed_var_iter_factory(None, 1, pattern.wildcard_min_length, None, constraints, None)
+            factory = _fixed_var_iter_factory(
+                None, 1, pattern.wildcard_min_length, None, constraints, None, elements, positions
+            )
             factories.append(factory)
     else:
         for name, count in fixed_vars.items():
             min_count, symbol_type, default = pattern.fixed_variable_infos[name]
             if symbol_type is not None:
-                factory = _fixed_var_iter_factory(name, count, min_count, symbol_type, constraints, default)
+                factory = _fixed_var_iter_factory(
+                    name, count, min_count, symbol_type, constraints, default, elements, positions
+                )
                 factories.append(factory)
 
-    for rem_expr, substitution in generator_chain((subjects, substitution), *factories):
+    for remaining, substitution in generator_chain((subject_counts, substitution), *factories):
         sequence_vars = _variables_with_counts(pattern.sequence_variables, pattern.sequence_variable_infos)
         if issubclass(pattern.operation, AssociativeOperation):
             sequence_vars += _variables_with_counts(fixed_vars, pattern.fixed_variable_infos)
@@ -317,7 +434,9 @@ def _match_commutative_operation(
         if pattern.wildcard_fixed is False:
             sequence_vars += (VariableWithCount(None, 1, pattern.wildcard_min_length, None), )
 
-        for sequence_subst in commutative_sequence_variable_partition_iter(Multiset(rem_expr), sequence_vars):
+        rem_expr = Multiset(dict(zip(elements, remaining)))
+        for sequence_subst in commutative_sequence_variable_partition_iter(rem_expr, sequence_vars):
+            step()
             if issubclass(pattern.operation, AssociativeOperation):
                 for v in fixed_vars.distinct_elements():
                     if v not in sequence_subst:
@@ -348,50 +467,57 @@ def _variables_with_counts(variables, infos):
     )
 
 
-def _fixed_expr_factory(expression, constraints):
+def _subtract_count(counts, position, count):
+    return counts[:position] + (counts[position] - count, ) + counts[position + 1:]
+
+
+def _fixed_expr_factory(expression, constraints, elements):
     def factory(data):
-        subjects, substitution = data
-        for expr in subjects.distinct_elements():
-            if match_head(expr, expression):
+        counts, substitution = data
+        for position, expr in enumerate(elements):
+            if counts[position] and match_head(expr, expression):
                 for subst in _match([expr], expression, substitution, constraints):
-                    yield subjects - Multiset({expr: 1}), subst
+                    yield _subtract_count(counts, position, 1), subst
 
     return factory
 
 
-def _fixed_var_iter_factory(variable_name, count, length, symbol_type, constraints, optional):
+def _fixed_var_iter_factory(variable_name, count, length, symbol_type, constraints, optional, elements, positions):
     def factory(data):
-        subjects, substitution = data
+        counts, substitution = data
         if variable_name in substitution:
             value = ([substitution[variable_name]]
                      if not isinstance(substitution[variable_name], (tuple, list, Multiset)) else substitution[variable_name])
             if optional is not None and value == [optional]:
-                yield subjects, substitution
-            existing = Multiset(value) * count
-            if not existing <= subjects:
-                return
-            yield subjects - existing, substitution
+                yield counts, substitution
+            new_counts = list(counts)
+            for expr in value:
+                position = positions.get(expr)
+                if position is None:
+                    return
+                new_counts[position] -= count
+                if new_counts[position] < 0:
+                    return
+            yield tuple(new_counts), substitution
         else:
             if optional is not None:
                 new_substitution = Substitution(substitution)
                 new_substitution[variable_name] = optional
-                yield subjects, new_substitution
+                yield counts, new_substitution
             if length == 1:
-                for expr, expr_count in subjects.items():
-                    if expr_count >= count and (symbol_type is None or isinstance(expr, symbol_type)):
+                for position, expr in enumerate(elements):
+                    if counts[position] >= count and (symbol_type is None or isinstance(expr, symbol_type)):
                         if variable_name is not None:
                             new_substitution = Substitution(substitution)
                             new_substitution[variable_name] = expr
                             for new_substitution in _check_constraints(new_substitution, constraints):
-                                yield subjects - Multiset({expr: count}), new_substitution
+                                yield _subtract_count(counts, position, count), new_substitution
                         else:
-                            yield subjects - Multiset({expr: count}), substitution
+                            yield _subtract_count(counts, position, count), substitution
             else:
                 assert variable_name is None, "Fixed variables with length != 1 are not supported."
-                exprs_with_counts = list(subjects.items())
-                counts = tuple(c // count for _, c in exprs_with_counts)
-                for subset in fixed_integer_vector_iter(counts, length):
-                    sub_counter = Multiset(dict((exprs_with_counts[i][0], c * count) for i, c in enumerate(subset)))
-                    yield subjects - sub_counter, substitution
+                for subset in fixed_integer_vector_iter(tuple(c // count for c in counts), length):
+                    step()
+                    yield tuple(c - s * count for c, s in zip(counts, subset)), substitution
 
     return factory
@@ -94,9 +94,15 @@ class FlatTerm(Sequence[TermAtom]):
 
     >>> FlatTerm(f(_, _s))
     [f, _, <class '__main__.SpecialSymbol'>, )]
+
+    To skip a whole subterm in constant time, :attr:`subterm_ends` contains the index after the end of the subterm
+    starting at every index:
+
+    >>> FlatTerm(f(f(a), b)).subterm_ends
+    (6, 4, 3, 4, 5, 6)
     """
 
-    __slots__ = '_terms', '_is_syntactic'
+    __slots__ = '_terms', '_is_syntactic', '_subterm_ends'
 
     def __init__(self, expression: Union[Expression, Sequence[TermAtom]]) -> None:
         if isinstance(expression, Expression):
@@ -137,6 +143,20 @@ class FlatTerm(Sequence[TermAtom]):
                 return False
         return True
 
+    @slot_cached_property('_subterm_ends')
+    def subterm_ends(self):
+        """For every term, the index after the end of the subterm starting with it."""
+        ends = list(range(1, len(self._terms) + 1))
+        starts = []
+        for index, term in enumerate(self._terms):
+            if isinstance(term, type):
+                if issubclass(term, Operation):
+                    starts.append(index)
+            # The only string term is OPERATION_END, this avoids comparing every symbol with it
+            elif isinstance(term, str):
+                ends[starts.pop()] = index + 1
+        return tuple(ends)
+
     @classmethod
     def empty(cls) -> 'FlatTerm':
         """An empty flatterm."""
@@ -629,7 +649,7 @@ class DiscriminationNet(Generic[T]):
                             depth = 1
                             state = state[Wildcard]
                         elif term == OPERATION_END:
-                            return []
+                            return result if collect else []
                         elif isinstance(term, Symbol):
                             symbol_wildcard_key = _get_symbol_wildcard_label(state, term)
                             state = state[symbol_wildcard_key or Wildcard]
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""Contains a parser for the textual form of expressions as produced by ``str()``.
+
+The operations that can occur in the text have to be given to the parser:
+
+>>> parser = Parser([f])
+>>> parser.parse('f(a, f(b, x_), y___)')
+f(Symbol('a'), f(Symbol('b'), Wildcard(1, True, variable_name=x)), Wildcard(0, False, variable_name=y))
+
+For a single expression, :func:`parse_expression` can be used instead:
+
+>>> parse_expression('f(a, b)', [f])
+f(Symbol('a'), Symbol('b'))
+
+Infix operations, variable names, symbol wildcards and optional wildcards are supported as well, so that the result of
+``str()`` can be parsed back into the same expression:
+
+>>> Plus = Operation.new('+', Arity.variadic, 'Plus', associative=True, commutative=True, infix=True)
+>>> expression = f(Plus(a, b, c, variable_name='x'), Wildcard.optional('z', a), Wildcard.symbol('s'))
+>>> print(expression)
+f(x: (a + b + c), z_: a, s_[Symbol])
+>>> Parser([f, Plus]).parse(str(expression)) == expression
+True
+
+The operands of associative and commutative operations are flattened and sorted while parsing. Hence, the parsed
+expression is always in the canonical form, even if the text was not.
+
+The textual form is ambiguous for symbols that look like wildcards (e.g. ``x_``) or that contain whitespace or any of
+``(),:``. Such symbols cannot be parsed.
+"""
+import re
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Mapping, Optional, TextIO, Type
+
+from .expressions.expressions import Expression, Operation, Symbol, SymbolWildcard, Wildcard
+
+__all__ = ['Parser', 'parse_expression']
+
+_TOKEN = re.compile(r'[(),:]|[^\s(),:]+')
+_WILDCARD = re.compile(r'(.*?)(?:(___|__|_)|_\[(?:(\d+)(\+?)|([A-Za-z_]\w*))\])$')
+_PUNCTUATION = frozenset('(),:')
+
+_ATOM_CACHE_SIZE = 1 << 16
+
+_PREFIX = 0
+_INFIX = 1
+_OPTIONAL = 2
+
+
+class Parser(object):
+    """A parser for the textual form of expressions with a fixed set of operations and symbol types.
+
+    The parser keeps the atoms it created and reuses them, so the symbols are shared between all the parsed
+    expressions.
+    """
+
+    def __init__(
+            self,
+            operations: Iterable[Type[Operation]],
+            symbol_type: Type[Symbol]=Symbol,
+            symbols: Optional[Mapping[str, Type[Symbol]]]=None
+    ) -> None:
+        """
+        Args:
+            operations:
+                The operations that can occur in the text. They are identified by their :attr:`~.Operation.name`.
+            symbol_type:
+                The type for the symbols that are not listed in *symbols*.
+            symbols:
+                The types for specific symbol names.
+
+        Raises:
+            ValueError:
+                If two of the *operations* have the same name.
+        """
+        self._operations = {}  # type: Dict[str, Type[Operation]]
+        for operation in operations:
+            if self._operations.setdefault(operation.name, operation) is not operation:
+                raise ValueError('There are multiple operations named {!r}.'.format(operation.name))
+        operations = list(self._operations.values())
+        self._flattened = {
+            o: frozenset(t for t in operations if issubclass(t, o))
+            for o in operations if o.associative
+        }  # type: Dict[Type[Operation], FrozenSet[Type[Operation]]]
+        self._commutative = frozenset(o for o in operations if o.commutative)
+        self._one_identity = frozenset(o for o in operations if o.one_identity)
+        # The operations that accept any number of operands, so their operands do not need to be checked
+        self._unchecked = frozenset(
+            o for o in operations
+            if o.arity.min_count == 0 and not o.arity.fixed_size and o.__init__ is Operation.__init__
+        )
+        self._symbol_type = symbol_type
+        self._symbols = dict(symbols or {})
+        self._symbol_types = {t.__name__: t for t in [Symbol, symbol_type] + list(self._symbols.values())}
+        self._atoms = {}  # type: Dict[str, Expression]
+
+    def parse(self, text: str) -> Expression:
+        """Parse a single expression.
+
+        Args:
+            text:
+                The textual form of the expression.
+
+        Returns:
+            The parsed expression.
+
+        Raises:
+            ValueError:
+                If the text is not a valid expression or contains an unknown operation.
+        """
+        tokens = _TOKEN.findall(text)
+        count = len(tokens)
+        tokens.extend((None, None, None))
+        try:
+            expression, index = self._parse(tokens)
+        except ValueError as e:
+            raise ValueError('{} In the expression {!r}.'.format(e, text)) from None
+        if index != count:
+            raise ValueError('Unexpected {!r} after the expression {!r}.'.format(tokens[index], text))
+        return expression
+
+    def parse_lines(self, lines: Iterable[str]) -> Iterator[Expression]:
+        """Parse one expression per line, skipping empty lines.
+
+        Args:
+            lines:
+                The lines to parse, e.g. a text file.
+
+        Yields:
+            The parsed expressions.
+
+        Raises:
+            ValueError:
+                If a line is not a valid expression. The message contains the line number.
+        """
+        for number, line in enumerate(lines, 1):
+            if not line or line.isspace():
+                continue
+            try:
+                yield self.parse(line)
+            except ValueError as e:
+                raise ValueError('Line {}: {}'.format(number, e)) from None
+
+    def parse_file(self, file: TextIO) -> Iterator[Expression]:
+        """Parse a text file with one expression per line, see :meth:`parse_lines`."""
+        return self.parse_lines(file)
+
+    def _atom(self, token):
+        atom = self._atoms.get(token)
+        if atom is None:
+            match = _WILDCARD.match(token)
+            if match is None:
+                atom = self._symbols.get(token, self._symbol_type)(token)
+            else:
+                atom = self._wildcard(*match.groups())
+            if len(self._atoms) >= _ATOM_CACHE_SIZE:
+                self._atoms.clear()
+            self._atoms[token] = atom
+        return atom
+
+    def _wildcard(self, variable_name, underscores, min_count, variable_size, symbol_type_name):
+        variable_name = variable_name or None
+        if symbol_type_name is not None:
+            try:
+                symbol_type = self._symbol_types[symbol_type_name]
+            except KeyError:
+                raise ValueError('Unknown symbol type {!r}.'.format(symbol_type_name)) from None
+            return SymbolWildcard(symbol_type, variable_name=variable_name)
+        if underscores is not None:
+            min_count = 0 if underscores == '___' else 1
+            fixed_size = underscores == '_'
+        else:
+            min_count = int(min_count)
+            fixed_size = not variable_size
+        return Wildcard(min_count, fixed_size, variable_name=variable_name)
+
+    def _operation(self, name):
+        try:
+            return self._operations[name]
+        except KeyError:
+            raise ValueError('Unknown operation {!r}.'.format(name)) from None
+
+    def _create(self, operation, operands, variable_name):
+        # This does the same simplification as creating the operation, but it avoids the slow isinstance checks for
+        # the abstract operation types, because all the operand types are known
+        flattened = self._flattened.get(operation)
+        if flattened is not None:
+            new_operands = []
+            for operand in operands:
+                if type(operand) in flattened:
+                    new_operands.extend(operand.operands)
+                else:
+                    new_operands.append(operand)
+            operands = new_operands
+        if operation in self._one_identity and len(operands) == 1:
+            operand = operands[0]
+            if not isinstance(operand, Wildcard) or (operand.min_count == 1 and operand.fixed_size):
+                return operand
+        if operation in self._commutative:
+            operands.sort()
+        expression = Expression.__new__(operation)
+        if operation in self._unchecked:
+            expression.variable_name = variable_name
+            expression.operands = operands
+        else:
+            expression.__init__(operands, variable_name=variable_name)
+        return expression
+
+    def _parse(self, tokens):
+        """Parse the expression at the start of the tokens and return it together with the index after it.
+
+        The tokens must be followed by three `None` tokens, so that looking ahead does not need any bounds checks.
+        """
+        index = 0
+        # The unfinished expressions: kind, operation or wildcard, variable name, operands
+        stack = []  # type: List[tuple]
+        atoms = self._atoms
+
+        while True:
+            # Read an operand, which is either complete or starts a new operation
+            token = tokens[index]
+            following = tokens[index + 1]
+            index += 1
+            variable_name = None
+            expression = None
+            if following == ':' and token not in _PUNCTUATION:
+                atom = self._atom(token)
+                if isinstance(atom, Wildcard):
+                    if atom.optional is not None or isinstance(atom, SymbolWildcard):
+                        raise ValueError('Unexpected ":" after {!r}.'.format(token))
+                    stack.append((_OPTIONAL, atom, None, None))
+                    index += 1
+                    continue
+                following = tokens[index + 1]
+                if following == '(' or tokens[index + 2] == '(':
+                    variable_name = token
+                    token = following
+                    index += 2
+                    following = tokens[index]
+                elif following is None or following in _PUNCTUATION:
+                    raise ValueError('Unexpected {}.'.format(_describe(following)))
+                else:
+                    expression = self._symbols.get(token, self._symbol_type)(token, variable_name=following)
+                    index += 2
+            if expression is None:
+                if token == '(':
+                    stack.append((_INFIX, None, variable_name, []))
+                    continue
+                if token is None or token in _PUNCTUATION:
+                    raise ValueError('Unexpected {}.'.format(_describe(token)))
+                if following == '(':
+                    operation = self._operation(token)
+                    index += 1
+                    if tokens[index] != ')':
+                        stack.append((_PREFIX, operation, variable_name, []))
+                        continue
+                    index += 1
+                    expression = self._create(operation, [], variable_name)
+                elif variable_name is not None:
+                    raise ValueError('Expected an operation after "{}:".'.format(variable_name))
+                else:
+                    expression = atoms.get(token)
+                    if expression is None:
+                        expression = self._atom(token)
+
+            # Add the complete expression to the unfinished ones and finish those that end here
+            while stack:
+                kind, operation, variable_name, operands = stack[-1]
+                if kind == _OPTIONAL:
+                    stack.pop()
+                    expression = Wildcard(
+                        operation.min_count, operation.fixed_size, variable_name=operation.variable_name,
+                        optional=expression
+                    )
+                    continue
+                operands.append(expression)
+                token = tokens[index]
+                index += 1
+                if token == ')':
+                    stack.pop()
+                    if kind == _INFIX:
+                        if operation is None:
+                            raise ValueError('Cannot determine the infix operation of a single operand.')
+                        operation = self._operation(operation)
+                    expression = self._create(operation, operands, variable_name)
+                elif kind == _PREFIX and token == ',':
+                    break
+                elif kind == _INFIX and token is not None and token not in _PUNCTUATION:
+                    if operation is None:
+                        stack[-1] = (_INFIX, token, variable_name, operands)
+                    elif token != operation:
+                        raise ValueError('Mixed infix operations {!r} and {!r}.'.format(operation, token))
+                    break
+                else:
+                    raise ValueError('Unexpected {}.'.format(_describe(token)))
+            else:
+                return expression, index
+
+
+def _describe(token):
+    return 'end of the expression' if token is None else repr(token)
+
+
+def parse_expression(
+        text: str,
+        operations: Iterable[Type[Operation]]=(),
+        symbol_type: Type[Symbol]=Symbol,
+        symbols: Optional[Mapping[str, Type[Symbol]]]=None
+) -> Expression:
+    """Parse a single expression, see :class:`Parser` for the arguments."""
+    return Parser(operations, symbol_type, symbols).parse(text)
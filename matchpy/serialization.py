@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+"""Contains a compact binary format to store expressions and to send them between processes.
+
+A single expression can be converted with :func:`dumps` and :func:`loads`:
+
+>>> data = dumps(f(a, f(a, b), f(a, b)))
+>>> loads(data, types=[f])
+f(Symbol('a'), f(Symbol('a'), Symbol('b')), f(Symbol('a'), Symbol('b')))
+
+For files with many expressions, use an :class:`ExpressionWriter` and an :class:`ExpressionReader`:
+
+>>> import io
+>>> file = io.BytesIO()
+>>> writer = ExpressionWriter(file)
+>>> writer.write(f(a, b))
+>>> writer.write(f(b, x_))
+>>> _ = file.seek(0)
+>>> for expression in ExpressionReader(file, types=[f]):
+...     print(expression)
+f(a, b)
+f(b, x_)
+
+The expressions are stored in prefix order like in a :class:`.FlatTerm`. Every type and every symbol is stored only once
+per file and afterwards referred to by its index. Within an expression, an operation that is equal to a previous one
+is replaced by a reference to it. Equal subexpressions are also shared between the loaded expressions.
+
+The types are stored by their module and qualified name, and the reader imports them from there. Types that cannot be
+imported this way, e.g. the ones created with :meth:`.Operation.new`, have to be passed to the reader. Symbols and
+wildcards are restored like unpickled objects: Their additional attributes are pickled, and the reader sets them without
+calling the ``__init__`` of the type. Operations are created with :meth:`.Operation.from_canonical` instead. As the
+reader imports the modules named in the data and unpickles the attributes, only read data from trusted sources.
+"""
+import importlib
+import io
+import pickle
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Type
+
+from .expressions.expressions import Expression, Operation, Symbol, SymbolWildcard, Wildcard
+from .utils import cached_property
+
+__all__ = ['ExpressionWriter', 'ExpressionReader', 'dumps', 'loads']
+
+_HEADER = b'MATCHPY\x01'
+
+# Every node starts with a tag. The first tags are special, the remaining ones refer to a symbol (even) or an operation
+# type (odd) by their index, so that the common nodes usually only need a single byte.
+_TYPE = 0
+_SYMBOL = 1
+_WILDCARD = 2
+_REFERENCE = 3
+_FIRST_INDEX_TAG = 4
+
+_OPERATION_KIND = 1
+_SYMBOL_KIND = 2
+_WILDCARD_KIND = 3
+_SYMBOL_WILDCARD_KIND = 4
+
+_SMALL_VARINTS = [bytes((i, )) for i in range(0x80)]
+
+# The attributes that are part of the records, all other attributes of a symbol or wildcard are pickled
+_RECORD_ATTRIBUTES = {
+    _SYMBOL_KIND: frozenset(['name', 'variable_name', 'head']),
+    _WILDCARD_KIND: frozenset(['min_count', 'fixed_size', 'variable_name', 'optional']),
+    _SYMBOL_WILDCARD_KIND: frozenset(['min_count', 'fixed_size', 'variable_name', 'optional', 'symbol_type']),
+}
+
+_PICKLE_PROTOCOL = 4
+
+
+def _varint(value: int) -> bytes:
+    if value < 0x80:
+        return _SMALL_VARINTS[value]
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _bytes(value: Optional[bytes]) -> bytes:
+    """Encode optional bytes with their length plus one, so that zero can stand for `None`."""
+    if value is None:
+        return _SMALL_VARINTS[0]
+    return _varint(len(value) + 1) + value
+
+
+def _string(value: Optional[str]) -> bytes:
+    return _bytes(value.encode('utf-8') if value is not None else None)
+
+
+def _type_name(expression_type: type) -> str:
+    return '{}:{}'.format(expression_type.__module__, expression_type.__qualname__)
+
+
+def _kind(expression_type: type) -> int:
+    if issubclass(expression_type, Expression):
+        if issubclass(expression_type, Operation):
+            return _OPERATION_KIND
+        if issubclass(expression_type, Symbol):
+            return _SYMBOL_KIND
+        if issubclass(expression_type, SymbolWildcard):
+            return _SYMBOL_WILDCARD_KIND
+        if issubclass(expression_type, Wildcard):
+            return _WILDCARD_KIND
+    return 0
+
+
+class ExpressionWriter(object):
+    """Writes expressions to a binary file.
+
+    The types and symbols are shared between all the expressions written by the same writer, so writing many
+    expressions with one writer is a lot more compact than writing them separately.
+
+    Attributes:
+        file:
+            The binary file the expressions are written to.
+    """
+
+    def __init__(self, file: BinaryIO) -> None:
+        """
+        Args:
+            file:
+                The binary file to write to. The header of the format is written to it immediately.
+        """
+        self.file = file
+        self._types = {}  # type: Dict[type, int]
+        self._kinds = {}  # type: Dict[type, int]
+        self._ignored_attributes = {}  # type: Dict[type, frozenset]
+        self._symbols = {}  # type: Dict[tuple, bytes]
+        self._operation_tags = {}  # type: Dict[type, bytes]
+        self._buffer = bytearray()
+        self._references = {}  # type: Dict[tuple, int]
+        self._keys = []  # type: List[Optional[tuple]]
+        file.write(_HEADER)
+
+    def write(self, expression: Expression) -> None:
+        """Write a single expression.
+
+        Raises:
+            TypeError:
+                If the expression contains an object that is not a symbol, wildcard or operation, or a symbol or
+                wildcard with attributes that cannot be pickled.
+        """
+        type_count = len(self._types)
+        symbol_count = len(self._symbols)
+        try:
+            self._write(expression)
+        except BaseException:
+            self._forget_definitions(type_count, symbol_count)
+            raise
+        else:
+            self.file.write(_varint(len(self._buffer)) + self._buffer)
+        finally:
+            self._buffer.clear()
+            self._references.clear()
+            self._keys.clear()
+
+    def write_all(self, expressions: Iterable[Expression]) -> None:
+        """Write all the given expressions."""
+        for expression in expressions:
+            self.write(expression)
+
+    def _forget_definitions(self, type_count, symbol_count):
+        # The definitions of a failed expression were never written, so they must be repeated when used again
+        for table, count in ((self._types, type_count), (self._symbols, symbol_count)):
+            for key in list(table)[count:]:
+                del table[key]
+        self._operation_tags = {t: tag for t, tag in self._operation_tags.items() if t in self._types}
+
+    def _type_index(self, expression_type):
+        index = self._types.get(expression_type)
+        if index is None:
+            index = len(self._types)
+            self._buffer += _SMALL_VARINTS[_TYPE] + _string(_type_name(expression_type))
+            self._types[expression_type] = index
+        return index
+
+    def _state(self, expression, kind):
+        """Return the pickled attributes of a symbol or wildcard that are not part of its record, if there are any."""
+        expression_type = type(expression)
+        ignored = self._ignored_attributes.get(expression_type)
+        if ignored is None:
+            # The cached properties are stored as attributes as well, but they are recomputed when needed
+            ignored = _RECORD_ATTRIBUTES[kind].union(
+                name for cls in expression_type.__mro__ for name, value in vars(cls).items()
+                if isinstance(value, cached_property)
+            )
+            self._ignored_attributes[expression_type] = ignored
+        attributes = expression.__dict__
+        if attributes.keys() <= ignored:
+            return None
+        state = {name: value for name, value in attributes.items() if name not in ignored}
+        try:
+            return pickle.dumps(state, _PICKLE_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as error:
+            raise TypeError('Cannot serialize the attributes of {!r}: {}'.format(expression, error)) from None
+
+    def _write(self, expression):
+        """Write the expression to the buffer and return a key that identifies it within the current expression."""
+        expression_type = type(expression)
+        try:
+            kind = self._kinds[expression_type]
+        except KeyError:
+            kind = self._kinds[expression_type] = _kind(expression_type)
+        buffer = self._buffer
+
+        if kind == _SYMBOL_KIND:
+            state = self._state(expression, kind)
+            key = (expression_type, expression.name, expression.variable_name, state)
+            tag = self._symbols.get(key)
+            if tag is None:
+                type_index = self._type_index(expression_type)
+                buffer += _SMALL_VARINTS[_SYMBOL] + _varint(type_index) + _string(expression.name)
+                buffer += _string(expression.variable_name) + _bytes(state)
+                tag = self._symbols[key] = _varint(_FIRST_INDEX_TAG + 2 * len(self._symbols))
+            else:
+                buffer += tag
+            return tag
+
+        if kind == _OPERATION_KIND:
+            tag = self._operation_tags.get(expression_type)
+            if tag is None:
+                tag = _varint(_FIRST_INDEX_TAG + 2 * self._type_index(expression_type) + 1)
+                self._operation_tags[expression_type] = tag
+            start = len(buffer)
+            definition_count = len(self._types) + len(self._symbols)
+            index = len(self._keys)
+            self._keys.append(None)
+            operands = expression.operands
+            variable_name = expression.variable_name
+            buffer += tag
+            if variable_name is None:
+                buffer += _varint(len(operands) << 1)
+            else:
+                buffer += _varint((len(operands) << 1) | 1) + _string(variable_name)
+            key = (expression_type, variable_name) + tuple(self._write(o) for o in operands)
+            previous = self._references.get(key)
+            if previous is None:
+                self._references[key] = index
+                self._keys[index] = key
+                return index
+            # Replace the repeated operation by a reference, unless new types or symbols were defined within it
+            if len(self._types) + len(self._symbols) == definition_count:
+                for operand_key in self._keys[index + 1:]:
+                    if operand_key is not None:
+                        del self._references[operand_key]
+                del self._keys[index:]
+                del buffer[start:]
+                buffer += _SMALL_VARINTS[_REFERENCE] + _varint(previous)
+            return previous
+
+        if kind == _WILDCARD_KIND or kind == _SYMBOL_WILDCARD_KIND:
+            type_index = self._type_index(expression_type)
+            symbol_type = None
+            if kind == _SYMBOL_WILDCARD_KIND:
+                symbol_type = expression.symbol_type
+                symbol_type_index = self._type_index(symbol_type)
+            state = self._state(expression, kind)
+            optional = expression.optional
+            header = (expression.min_count << 2) | (expression.fixed_size << 1) | (optional is not None)
+            buffer += _SMALL_VARINTS[_WILDCARD] + _varint(type_index) + _varint(header)
+            buffer += _string(expression.variable_name)
+            if symbol_type is not None:
+                buffer += _varint(symbol_type_index)
+            buffer += _bytes(state)
+            optional_key = self._write(optional) if optional is not None else None
+            return (
+                expression_type, expression.min_count, expression.fixed_size, expression.variable_name, symbol_type,
+                state, optional_key
+            )
+
+        raise TypeError('Cannot serialize {!r} of type {!r}.'.format(expression, expression_type))
+
+
+class ExpressionReader(object):
+    """Reads the expressions written by an :class:`ExpressionWriter` from a binary file.
+
+    The reader can be iterated to get all the remaining expressions.
+
+    Attributes:
+        file:
+            The binary file the expressions are read from.
+    """
+
+    def __init__(self, file: BinaryIO, types: Iterable[Type[Expression]]=()) -> None:
+        """
+        Args:
+            file:
+                The binary file to read from. The header of the format is read from it immediately.
+            types:
+                The expression types that cannot be imported by their module and qualified name, e.g. operations
+                created with :meth:`.Operation.new`.
+
+        Raises:
+            ValueError:
+                If the file does not start with the header of the format or two of the *types* have the same name.
+        """
+        self.file = file
+        self._known_types = {}  # type: Dict[str, type]
+        for expression_type in types:
+            name = _type_name(expression_type)
+            if self._known_types.setdefault(name, expression_type) is not expression_type:
+                raise ValueError('There are multiple types named {!r}.'.format(name))
+        self._types = []  # type: List[type]
+        self._kinds = []  # type: List[int]
+        self._symbols = []  # type: List[Symbol]
+        header = file.read(len(_HEADER))
+        if header != _HEADER:
+            raise ValueError('The file does not contain serialized expressions.')
+
+    def __iter__(self) -> Iterator[Expression]:
+        while True:
+            try:
+                yield self.read()
+            except EOFError:
+                return
+
+    def read(self) -> Expression:
+        """Read the next expression.
+
+        Raises:
+            EOFError:
+                If there are no more expressions.
+            ValueError:
+                If the data is invalid or refers to an unknown type.
+        """
+        length = 0
+        shift = 0
+        while True:
+            byte = self.file.read(1)
+            if not byte:
+                if shift:
+                    raise ValueError('The serialized expression is truncated.')
+                raise EOFError('There are no more serialized expressions.')
+            length |= (byte[0] & 0x7f) << shift
+            if byte[0] < 0x80:
+                break
+            shift += 7
+        data = self.file.read(length)
+        if len(data) != length:
+            raise ValueError('The serialized expression is truncated.')
+        try:
+            expression, position = self._read(data)
+        except IndexError:
+            raise ValueError('The serialized expression is invalid or truncated.') from None
+        if position != length:
+            raise ValueError('The serialized expression has trailing data.')
+        return expression
+
+    def _resolve_type(self, name):
+        expression_type = self._known_types.get(name)
+        if expression_type is None:
+            module_name, _, qualified_name = name.partition(':')
+            try:
+                expression_type = importlib.import_module(module_name)
+                for part in qualified_name.split('.'):
+                    expression_type = getattr(expression_type, part)
+            except (ImportError, AttributeError, TypeError, ValueError):
+                raise ValueError('Unknown type {!r}, it has to be passed to the reader.'.format(name)) from None
+        kind = _kind(expression_type) if isinstance(expression_type, type) else 0
+        if not kind:
+            raise ValueError('The type {!r} is not a symbol, wildcard or operation type.'.format(name))
+        self._types.append(expression_type)
+        self._kinds.append(kind)
+
+    def _read(self, data):
+        """Read the expression from the data of a single record."""
+        position = 0
+        types = self._types
+        kinds = self._kinds
+        symbols = self._symbols
+        references = []
+        # The operations whose operands are being read: type, variable name, operand count, operands, reference index
+        stack = []
+        new = Expression.__new__
+
+        while True:
+            tag = data[position]
+            position += 1
+            if tag >= 0x80:
+                tag, position = _read_varint(data, position - 1)
+
+            if tag >= _FIRST_INDEX_TAG:
+                index = (tag - _FIRST_INDEX_TAG) >> 1
+                if not tag & 1:
+                    expression = symbols[index]
+                else:
+                    if kinds[index] != _OPERATION_KIND:
+                        raise ValueError('{!r} is not an operation type.'.format(types[index]))
+                    header = data[position]
+                    position += 1
+                    if header >= 0x80:
+                        header, position = _read_varint(data, position - 1)
+                    variable_name = None
+                    if header & 1:
+                        variable_name, position = _read_string(data, position)
+                    references.append(None)
+                    if header >> 1:
+                        stack.append((types[index], variable_name, header >> 1, [], len(references) - 1))
+                        continue
+                    expression = references[-1] = types[index].from_canonical([], variable_name)
+            elif tag == _REFERENCE:
+                index, position = _read_varint(data, position)
+                expression = references[index]
+            elif tag == _TYPE:
+                name, position = _read_string(data, position)
+                if name is None:
+                    raise ValueError('The type name is missing.')
+                self._resolve_type(name)
+                continue
+            elif tag == _SYMBOL:
+                index, position = _read_varint(data, position)
+                name, position = _read_string(data, position)
+                variable_name, position = _read_string(data, position)
+                state, position = _read_bytes(data, position)
+                if kinds[index] != _SYMBOL_KIND:
+                    raise ValueError('{!r} is not a symbol type.'.format(types[index]))
+                expression = new(types[index])
+                Symbol.__init__(expression, name, variable_name)
+                _restore_state(expression, state)
+                symbols.append(expression)
+            else:
+                index, position = _read_varint(data, position)
+                header, position = _read_varint(data, position)
+                variable_name, position = _read_string(data, position)
+                symbol_type = None
+                if kinds[index] == _SYMBOL_WILDCARD_KIND:
+                    symbol_type_index, position = _read_varint(data, position)
+                    symbol_type = types[symbol_type_index]
+                    if kinds[symbol_type_index] != _SYMBOL_KIND:
+                        raise ValueError('{!r} is not a symbol type.'.format(symbol_type))
+                elif kinds[index] != _WILDCARD_KIND:
+                    raise ValueError('{!r} is not a wildcard type.'.format(types[index]))
+                state, position = _read_bytes(data, position)
+                wildcard = (types[index], header, variable_name, symbol_type, state)
+                if header & 1:
+                    # The default value follows, so the wildcard is created once it has been read
+                    stack.append((None, wildcard, 1, [], None))
+                    continue
+                expression = _read_wildcard(wildcard, None)
+
+            while stack:
+                expression_type, variable_name, count, operands, index = stack[-1]
+                operands.append(expression)
+                if len(operands) < count:
+                    break
+                stack.pop()
+                if expression_type is None:
+                    expression = _read_wildcard(variable_name, expression)
+                else:
+                    # This skips the simplification and checks of the operation, because the operation was valid
+                    # when it was written
+                    expression = references[index] = expression_type.from_canonical(operands, variable_name)
+            else:
+                return expression, position
+
+
+def _read_varint(data, position):
+    byte = data[position]
+    position += 1
+    if byte < 0x80:
+        return byte, position
+    result = byte & 0x7f
+    shift = 7
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _read_bytes(data, position):
+    length, position = _read_varint(data, position)
+    if length == 0:
+        return None, position
+    end = position + length - 1
+    if end > len(data):
+        raise IndexError()
+    return data[position:end], end
+
+
+def _read_string(data, position):
+    value, position = _read_bytes(data, position)
+    if value is None:
+        return None, position
+    return value.decode('utf-8'), position
+
+
+def _read_wildcard(wildcard, optional):
+    wildcard_type, header, variable_name, symbol_type, state = wildcard
+    expression = Expression.__new__(wildcard_type)
+    Wildcard.__init__(expression, header >> 2, bool(header & 2), variable_name, optional)
+    if symbol_type is not None:
+        expression.symbol_type = symbol_type
+    _restore_state(expression, state)
+    return expression
+
+
+def _restore_state(expression, state):
+    if state is not None:
+        try:
+            attributes = pickle.loads(state)
+        except Exception:
+            raise ValueError('The attributes of {!r} are invalid.'.format(expression)) from None
+        if not isinstance(attributes, dict):
+            raise ValueError('The attributes of {!r} are invalid.'.format(expression))
+        expression.__dict__.update(attributes)
+
+
+def dumps(expression: Expression) -> bytes:
+    """Serialize a single expression to bytes.
+
+    Args:
+        expression:
+            The expression to serialize.
+
+    Returns:
+        The serialized expression that can be read with :func:`loads` or an :class:`ExpressionReader`.
+    """
+    file = io.BytesIO()
+    ExpressionWriter(file).write(expression)
+    return file.getvalue()
+
+
+def loads(data: bytes, types: Iterable[Type[Expression]]=()) -> Expression:
+    """Load the first expression serialized in the given bytes.
+
+    Args:
+        data:
+            The serialized expressions as returned by :func:`dumps`.
+        types:
+            The expression types that cannot be imported by their name, see :class:`ExpressionReader`.
+
+    Returns:
+        The loaded expression.
+
+    Raises:
+        ValueError:
+            If the data is invalid or refers to an unknown type.
+    """
+    try:
+        return ExpressionReader(io.BytesIO(data), types).read()
+    except EOFError:
+        raise ValueError('The data does not contain an expression.') from None
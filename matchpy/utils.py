@@ -6,7 +6,7 @@ import math
 import ast
 import os
 import tokenize
-import copy
+import functools
 from types import LambdaType
 # pylint: disable=unused-import
 from typing import (Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, TypeVar, cast, Union, Any)
@@ -16,8 +16,8 @@ from multiset import Multiset
 
 __all__ = [
     'fixed_integer_vector_iter', 'weak_composition_iter', 'commutative_sequence_variable_partition_iter',
-    'get_short_lambda_source', 'solve_linear_diop', 'generator_chain', 'cached_property', 'slot_cached_property',
-    'extended_euclid', 'base_solution_linear'
+    'commutative_sequence_variable_partition_count_iter', 'get_short_lambda_source', 'solve_linear_diop',
+    'generator_chain', 'cached_property', 'slot_cached_property', 'extended_euclid', 'base_solution_linear'
 ]
 
 T = TypeVar('T')
@@ -128,26 +128,18 @@ def optional_iter(remaining, count):
         yield remaining - sum(p), p
 
 
-_linear_diop_solution_cache = {}  # type: Dict[Tuple[int, ...], List[Tuple[int, ...]]]
+LINEAR_DIOP_CACHE_SIZE = 4096
+"""The maximum number of linear Diophantine equations whose solutions are cached for the partitioning."""
 
 
-def _make_variable_generator_factory(value, total, variables: List[VariableWithCount]):
-    var_counts = [v.count for v in variables]
-    cache_key = (total, *var_counts)
+@functools.lru_cache(maxsize=LINEAR_DIOP_CACHE_SIZE)
+def _linear_diop_solutions(total: int, coeffs: Tuple[int, ...]) -> Tuple[Tuple[int, ...], ...]:
+    """Return all solutions of :func:`solve_linear_diop` for the equation.
 
-    def _factory(subst):
-        if cache_key in _linear_diop_solution_cache:
-            solutions = _linear_diop_solution_cache[cache_key]
-        else:
-            solutions = list(solve_linear_diop(total, *var_counts))
-            _linear_diop_solution_cache[cache_key] = solutions
-        for solution in solutions:
-            new_subst = copy.copy(subst)
-            for var, count in zip(variables, solution):
-                new_subst[var.name][value] = count
-            yield new_subst
-
-    return _factory
+    The same equations come up again and again when matching different subjects, so the least recently used solutions
+    are cached.
+    """
+    return tuple(solve_linear_diop(total, *coeffs))
 
 
 def _commutative_single_variable_partiton_iter(values: 'Multiset[T]',
@@ -212,23 +204,85 @@ def commutative_sequence_variable_partition_iter(values: 'Multiset[T]', variable
         yield from _commutative_single_variable_partiton_iter(values, variables[0])
         return
 
-    generators = []
-    for value, count in values.items():
-        generators.append(_make_variable_generator_factory(value, count, variables))
-
-    initial = dict((var.name, Multiset()) for var in variables)  # type: Dict[str, 'Multiset[T]']
-    for subst in generator_chain(initial, *generators):
-        valid = True
-        for var in variables:
-            if var.default is not None and len(subst[var.name]) == 0:
+    elements, counts = zip(*values.items()) if values else ((), ())
+    for count_vectors in commutative_sequence_variable_partition_count_iter(counts, variables):
+        subst = {}
+        for var, count_vector in zip(variables, count_vectors):
+            if var.name is None:
+                continue
+            if var.default is not None and not any(count_vector):
                 subst[var.name] = var.default
-            elif len(subst[var.name]) < var.minimum:
-                valid = False
-                break
-        if valid:
-            if None in subst:
-                del subst[None]
-            yield subst
+            else:
+                subst[var.name] = Multiset(dict(zip(elements, count_vector)))
+        yield subst
+
+
+def commutative_sequence_variable_partition_count_iter(counts: Sequence[int], variables: List[VariableWithCount]
+                                                      ) -> Iterator[Tuple[Tuple[int, ...], ...]]:
+    """Yield all possible distributions of the value counts among the variables as count vectors.
+
+    This is the same as :func:`commutative_sequence_variable_partition_iter`, but instead of the values, only their
+    counts are given. Each distribution is yielded as one count vector per variable, which tells how many times the
+    variable gets each of the values. This avoids creating multisets for every distribution, so that they only have to
+    be created for the distributions that are actually used.
+
+    Example:
+
+        For the same input as for :func:`commutative_sequence_variable_partition_iter`, the values ``a``, ``b`` and
+        ``c`` have the counts 3, 2 and 1:
+
+        >>> x = VariableWithCount(name='x', count=1, minimum=1, default=None)
+        >>> y = VariableWithCount(name='y', count=2, minimum=0, default=None)
+        >>> for count_vectors in commutative_sequence_variable_partition_count_iter([3, 2, 1], [x, y]):
+        ...     print(count_vectors)
+        ((3, 2, 1), (0, 0, 0))
+        ((3, 0, 1), (0, 1, 0))
+        ((1, 2, 1), (1, 0, 0))
+        ((1, 0, 1), (1, 1, 0))
+
+    Args:
+        counts:
+            The number of occurrences of each distinct value.
+        variables:
+            A list of the variables to distribute the values among.
+
+    Yields:
+        For each valid distribution, a tuple with a count vector for every variable. Each count vector contains the
+        number of occurrences of each value in the variable's substitution in the same order as the *counts*.
+    """
+    var_counts = tuple(var.count for var in variables)
+    solutions = [_linear_diop_solutions(count, var_counts) for count in counts]
+    if not all(solutions):
+        return
+    if not solutions:
+        if all(var.minimum == 0 or var.default is not None for var in variables):
+            yield ((), ) * len(variables)
+        return
+    var_range = range(len(variables))
+    minimums = [var.minimum if var.default is None else 0 for var in variables]
+    # The minimum number of values each variable still needs after the next value, if it gets all the remaining
+    # values it can; used to prune the distributions early
+    still_needed = [minimums]
+    for value_solutions in reversed(solutions[1:]):
+        previous = still_needed[-1]
+        still_needed.append([previous[i] - max(s[i] for s in value_solutions) for i in var_range])
+    still_needed.reverse()
+    last = len(solutions) - 1
+    chosen = [None] * len(solutions)  # type: List[Tuple[int, ...]]
+
+    def _distribute(index, lengths):
+        needed = still_needed[index]
+        for solution in solutions[index]:
+            new_lengths = [l + c for l, c in zip(lengths, solution)]
+            if any(l < n for l, n in zip(new_lengths, needed)):
+                continue
+            chosen[index] = solution
+            if index < last:
+                yield from _distribute(index + 1, new_lengths)
+            elif all(l >= v.minimum or l == 0 for l, v in zip(new_lengths, variables)):
+                yield tuple(zip(*chosen))
+
+    yield from _distribute(0, [0] * len(variables))
 
 
 def get_short_lambda_source(lambda_func: LambdaType) -> Optional[str]:
@@ -5,6 +5,7 @@ import math
 import hypothesis.strategies as st
 from hypothesis import given
 import pytest
+from multiset import Multiset
 
 from matchpy.matching.bipartite import BipartiteGraph, _DirectedMatchGraph, enum_maximum_matchings_iter
 
@@ -47,6 +48,70 @@ def test_completeness(n, m):
     assert count == expected_count
 
 
+@pytest.mark.parametrize('n, m', filter(lambda x: x[0] < x[1], itertools.product(range(1, 4), range(1, 6))))
+def test_completeness_unmatched_right_nodes(n, m):
+    graph = BipartiteGraph(map(lambda x: (x, True), itertools.product(range(n), range(m))))
+    count = sum(1 for _ in enum_maximum_matchings_iter(graph))
+    expected_count = math.factorial(m) / math.factorial(m - n)
+    assert count == expected_count
+
+
+@st.composite
+def bipartite_graph_with_classes(draw):
+    left_sizes = draw(st.lists(st.integers(min_value=1, max_value=2), min_size=1, max_size=3))
+    right_sizes = draw(st.lists(st.integers(min_value=1, max_value=2), min_size=1, max_size=3))
+    left_classes = dict(((i, k), i) for i, size in enumerate(left_sizes) for k in range(size))
+    right_classes = dict(((j, k), j) for j, size in enumerate(right_sizes) for k in range(size))
+
+    graph = BipartiteGraph()
+    for i in range(len(left_sizes)):
+        for j in range(len(right_sizes)):
+            if draw(st.booleans()):
+                for left in range(left_sizes[i]):
+                    for right in range(right_sizes[j]):
+                        graph[(i, left), (j, right)] = True
+
+    return graph, left_classes, right_classes
+
+
+@given(bipartite_graph_with_classes())
+def test_enum_canonical_matchings_iter_correctness(graph_with_classes):
+    graph, left_classes, right_classes = graph_with_classes
+
+    def class_key(matching):
+        return frozenset(Multiset((left_classes[l], right_classes[r]) for l, r in matching.items()).items())
+
+    expected = set(class_key(matching) for matching in enum_maximum_matchings_iter(graph))
+    size = len(graph.find_matching())
+    result = set()
+    for matching in enum_maximum_matchings_iter(graph, left_classes, right_classes):
+        assert len(matching) == size, "Matching is not maximal"
+        for edge in matching.items():
+            assert edge in graph, "Matching contains an edge that was not in the graph"
+        key = class_key(matching)
+        assert key not in result, "Matching was equivalent to a previous one"
+        result.add(key)
+
+    assert result == expected
+
+
+@pytest.mark.parametrize('n, m', filter(lambda x: x[0] >= x[1], itertools.product(range(1, 6), range(1, 4))))
+def test_canonical_completeness(n, m):
+    graph = BipartiteGraph(map(lambda x: (x, True), itertools.product(range(n), range(m))))
+    left_classes = dict.fromkeys(range(n), 0)
+    right_classes = dict.fromkeys(range(m), 0)
+    expected_count = math.factorial(n) / math.factorial(m) / math.factorial(n - m)
+    assert len(list(enum_maximum_matchings_iter(graph, left_classes, right_classes))) == 1
+    assert len(list(enum_maximum_matchings_iter(graph, left_classes=left_classes))) == 1
+    assert len(list(enum_maximum_matchings_iter(graph, right_classes=right_classes))) == expected_count
+
+
+def test_canonical_matchings_non_equivalent_nodes():
+    graph = BipartiteGraph([((0, 'a'), True), ((1, 'b'), True)])
+    with pytest.raises(ValueError):
+        list(enum_maximum_matchings_iter(graph, left_classes={0: 0, 1: 0}))
+
+
 @pytest.mark.parametrize(
     '   graph,                      expected_cycle',
     [
@@ -128,6 +193,28 @@ class TestBipartiteGraphTest:
         with pytest.raises(KeyError):
             del graph[0, 1]
 
+    def test_right_neighbours(self):
+        graph = BipartiteGraph({(0, 0): True, (0, 1): True, (1, 1): True})
+
+        assert sorted(graph.right_neighbours(0)) == [0, 1]
+        assert graph.right_neighbours(1) == [1]
+        assert graph.right_neighbours(2) == []
+
+    def test_remove_left_node(self):
+        graph = BipartiteGraph({(0, 0): True, (0, 1): True, (1, 1): True})
+
+        graph.remove_left_node(0)
+
+        assert graph == {(1, 1): True}
+        assert graph.right_neighbours(0) == []
+        assert graph.find_matching() == {1: 1}
+
+        graph.remove_left_node(0)
+        graph.remove_left_node(1)
+
+        assert graph == {}
+        assert graph.find_matching() == {}
+
     def test_limited_to(self):
         graph = BipartiteGraph({(0, 0): True, (1, 0): True, (1, 1): True, (0, 1): True})
 
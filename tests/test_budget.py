@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+import pytest
+
+from matchpy.expressions.expressions import Pattern, Symbol
+from matchpy.functions import ReplacementRule
+from matchpy.matching.budget import MatchBudget, MatchBudgetExceeded
+from matchpy.matching.many_to_one import ManyToOneMatcher, ManyToOneReplacer
+from matchpy.matching.one_to_one import match
+from .common import *
+
+PATTERN = Pattern(f_c(x___, y___, z___))
+SUBJECT = f_c(*(Symbol('s{}'.format(i)) for i in range(12)))
+
+
+def test_budget_step():
+    budget = MatchBudget(max_steps=2)
+    budget.step()
+    budget.step()
+    with pytest.raises(MatchBudgetExceeded) as excinfo:
+        budget.step()
+    assert excinfo.value.budget is budget
+    assert budget.steps == 3
+
+
+def test_budget_limit_results():
+    budget = MatchBudget(max_results=2)
+
+    assert list(budget.limit(range(5))) == [0, 1]
+    assert budget.results == 2
+
+
+@pytest.mark.parametrize('match_func', [
+    lambda **kwargs: match(SUBJECT, PATTERN, **kwargs),
+    lambda **kwargs: ManyToOneMatcher(PATTERN).match(SUBJECT, **kwargs),
+])
+def test_match_budget(match_func):
+    assert len(list(match_func(max_results=5))) == 5
+
+    with pytest.raises(MatchBudgetExceeded):
+        list(match_func(max_steps=100))
+
+    start = time.monotonic()
+    with pytest.raises(MatchBudgetExceeded):
+        list(match_func(deadline=start + 0.05))
+    assert time.monotonic() - start < 1
+
+
+def test_match_budget_keeps_results_before_exceeding():
+    results = []
+    with pytest.raises(MatchBudgetExceeded):
+        for substitution in match(SUBJECT, PATTERN, max_steps=1000):
+            results.append(substitution)
+
+    assert 0 < len(results) < 3 ** 12
+
+
+def test_replace_budget():
+    replacer = ManyToOneReplacer(ReplacementRule(Pattern(f(a)), lambda: f(b)))
+    subject = f(f(a), f(a), f(a))
+
+    assert replacer.replace(subject, max_steps=1000) == f(f(b), f(b), f(b))
+
+    with pytest.raises(MatchBudgetExceeded) as excinfo:
+        replacer.replace(subject, max_steps=10)
+    assert excinfo.value.result not in (None, subject)
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def test_amatch():
+    matcher = ManyToOneMatcher(PATTERN)
+    subject = f_c(a, b, c)
+
+    async def collect(**kwargs):
+        return [substitution async for _, substitution in matcher.amatch(subject, **kwargs)]
+
+    expected = sorted(str(s) for _, s in matcher.match(subject))
+    assert sorted(str(s) for s in run(collect())) == expected
+    assert len(run(collect(max_results=4))) == 4
+    with pytest.raises(MatchBudgetExceeded):
+        run(collect(max_steps=10))
+
+
+def test_alimit_cancel():
+    budget = MatchBudget()
+
+    async def consume():
+        async for _ in budget.alimit(lambda: match(SUBJECT, PATTERN)):
+            await asyncio.sleep(0)
+
+    async def cancel_soon():
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.05)
+
+    run(cancel_soon())
+    assert budget.cancelled
+    steps = budget.steps
+    time.sleep(0.05)
+    assert budget.steps == steps
+
+
+def test_alimit_aclose():
+    budget = MatchBudget()
+    closed = []
+
+    def results():
+        try:
+            yield from match(SUBJECT, PATTERN)
+        finally:
+            closed.append(True)
+
+    async def consume_first():
+        iterator = budget.alimit(results, buffer_size=1)
+        async for _ in iterator:
+            break
+        await iterator.aclose()
+        await asyncio.sleep(0.05)
+
+    run(consume_first())
+    assert budget.cancelled
+    assert closed == [True]
+    steps = budget.steps
+    time.sleep(0.05)
+    assert budget.steps == steps
+
+
+def test_areplace():
+    replacer = ManyToOneReplacer(ReplacementRule(Pattern(f(a)), lambda: f(b)))
+    subject = f(f(a), f(a), f(a))
+
+    assert run(replacer.areplace(subject)) == f(f(b), f(b), f(b))
+
+    with pytest.raises(MatchBudgetExceeded) as excinfo:
+        run(replacer.areplace(subject, max_steps=10))
+    assert excinfo.value.result not in (None, subject)
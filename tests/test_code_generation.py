@@ -2,10 +2,16 @@
 import pytest
 from types import ModuleType
 
-from matchpy.expressions.expressions import Pattern
-from matchpy.matching.many_to_one import ManyToOneMatcher
-from matchpy.matching.code_generation import CodeGenerator
+from matchpy.expressions.expressions import Pattern, Symbol, Wildcard
+from matchpy.expressions.constraints import CustomConstraint, EqualVariablesConstraint, register_importable
+from matchpy.functions import ReplacementRule
+from matchpy.matching.many_to_one import ManyToOneMatcher, ManyToOneReplacer
+from matchpy.matching.syntactic import DiscriminationNet, SequenceMatcher
+from matchpy.matching.code_generation import (
+    CodeGenerator, ReplacerCodeGenerator, DiscriminationNetCodeGenerator, SequenceMatcherCodeGenerator
+)
 
+from .common import *
 from .test_matching import PARAM_MATCHES, PARAM_PATTERNS
 
 GENERATED_TEMPLATE = '''
@@ -20,12 +26,19 @@ from tests.utils import *
 '''.strip()
 
 
+@pytest.mark.parametrize('max_depth', [16, 1])
+@pytest.mark.parametrize('minimize', [False, True])
+@pytest.mark.parametrize('reorder', [False, True])
 @pytest.mark.parametrize('subject, patterns', PARAM_PATTERNS.items())
-def test_code_generation_many_to_one(subject, patterns):
+def test_code_generation_many_to_one(subject, patterns, reorder, minimize, max_depth):
     patterns = [Pattern(p) for p in patterns]
     matcher = ManyToOneMatcher(*patterns)
+    if minimize:
+        matcher.minimize()
+    if reorder:
+        matcher.reorder(matcher.profile([subject]))
 
-    generator = CodeGenerator(matcher)
+    generator = CodeGenerator(matcher, max_depth=max_depth)
     gc, code = generator.generate_code()
     code = GENERATED_TEMPLATE.format(gc, code)
     compiled = compile(code, '', 'exec')
@@ -51,4 +64,149 @@ def test_code_generation_many_to_one(subject, patterns):
 
     assert matches == [], "Subject {!s} and pattern {!s} yielded unexpected matches".format(
         subject, pattern
-    )
\ No newline at end of file
+    )
+
+
+def _compile_generated(generator):
+    gc, code = generator.generate_code()
+    module = ModuleType('generated_code')
+    exec(compile(GENERATED_TEMPLATE.format(gc, code), '', 'exec'), module.__dict__)
+    return module
+
+
+def test_code_generation_deeply_nested_patterns():
+    def nested(leaf):
+        for i in range(25):
+            leaf = f(Wildcard.star('x{}'.format(i)), leaf)
+        return leaf
+
+    subject = a
+    for _ in range(25):
+        subject = f(c, subject)
+    matcher = ManyToOneMatcher(Pattern(nested(a)), Pattern(nested(b)))
+    generator = CodeGenerator(matcher)
+
+    module = _compile_generated(generator)
+
+    assert len(list(module.match_root(subject))) == 1
+    assert generator.info.functions > 1
+
+
+CONSTRAINTS = [
+    CustomConstraint(lambda x: x != a),
+    CustomConstraint(lambda x: x != b),
+    CustomConstraint(lambda x: x != c),
+    CustomConstraint(lambda x: x != a),
+    CustomConstraint(lambda x: x != b),
+    CustomConstraint(lambda x: x != c),
+    CustomConstraint(lambda x: x != a),
+    CustomConstraint(lambda x: x != b),
+]
+
+
+def test_code_generation_constraints_are_not_duplicated():
+    def generated_lines(count):
+        patterns = [Pattern(f(x_, f(y_, Symbol('s{}'.format(i)))), CONSTRAINTS[i]) for i in range(count)]
+        generator = CodeGenerator(ManyToOneMatcher(*patterns))
+        module = _compile_generated(generator)
+        assert [i for i, _ in module.match_root(f(b, f(a, Symbol('s0'))))] == [0]
+        assert list(module.match_root(f(a, f(a, Symbol('s0'))))) == []
+        return generator.info.lines
+
+    assert generated_lines(8) < 2.5 * generated_lines(4)
+
+
+def _duplicate(x, y):
+    return [x, x, y]
+
+
+def test_replacer_code_generation():
+    replacer = ManyToOneReplacer(
+        ReplacementRule(Pattern(f(a, x_)), lambda x: f(x)),
+        ReplacementRule(Pattern(f(b, x_, y_)), _duplicate),
+        ReplacementRule(Pattern(f(b, b)), lambda: c),
+        ReplacementRule(Pattern(f_c(c, y___)), lambda y: f_c(*y)),
+    )
+    replacer.add(ReplacementRule(Pattern(f(x_, c)), lambda x: x), priority=1)
+    generator = ReplacerCodeGenerator(replacer)
+
+    module = _compile_generated(generator)
+
+    for subject in [a, f(a, b), f(a, c), f_c(c, f(a, b), f(b, b)), f(f(b, a, c)), f(f(b, b), c)]:
+        assert module.rewrite(subject) == replacer.replace(subject)
+    assert module.rewrite(f(f(a, f(b, b))), max_count=1) == f(f(a, c))
+    assert generator.info.functions > 1
+
+
+@register_importable
+def is_not_b(x):
+    return x != b
+
+
+def test_code_generation_inlines_constraints():
+    patterns = [
+        Pattern(f(x_, y_), EqualVariablesConstraint('x', 'y')),
+        Pattern(f(x_, y_), CustomConstraint(is_not_b)),
+        Pattern(f(x_, f(y_)), CustomConstraint(lambda x, y: x != y)),
+    ]
+    matcher = ManyToOneMatcher(*patterns)
+    gc, code = CodeGenerator(matcher).generate_code()
+
+    assert 'CustomConstraint(' not in code
+    assert 'is_not_b(x=' in code
+    module = ModuleType('generated_code')
+    exec(compile(GENERATED_TEMPLATE.format(gc, code), '', 'exec'), module.__dict__)
+    for subject in [f(a, a), f(a, b), f(b, a), f(b, f(b)), f(b, f(a))]:
+        expected = sorted(patterns.index(pattern) for pattern, _ in matcher.match(subject))
+        assert sorted(i for i, _ in module.match_root(subject)) == expected
+
+
+SYNTACTIC_PATTERNS = [f(x_, a), f(_, _), f(a, f2(y_)), f(f2(_), x_), f(_s, f2(_, b)), _s, f2(x_, x_), a]
+SYNTACTIC_SUBJECTS = [
+    a, b, f(a, a), f(b, a), f(a, b), f(a, f2(b)), f(a, f2(b, c)), f(f2(a), f2(b)), f(f2(a, b), a), f(s, f2(a, b)),
+    f(f2(c), f2(a, b)), f2(a, a), f2(a, b), f2(f(a, b), f(a, b)), f(f(a, b), f2(a))
+]
+
+
+@pytest.mark.parametrize('max_depth', [16, 1])
+@pytest.mark.parametrize('count', range(1, len(SYNTACTIC_PATTERNS) + 1))
+def test_discrimination_net_code_generation(count, max_depth):
+    patterns = [Pattern(p) for p in SYNTACTIC_PATTERNS[-count:]]
+    net = DiscriminationNet(*patterns)
+    module = _compile_generated(DiscriminationNetCodeGenerator(net, max_depth=max_depth))
+
+    for subject in SYNTACTIC_SUBJECTS:
+        expected = [(patterns.index(pattern), subst) for pattern, subst in net.match(subject)]
+        assert list(module.match_root(subject)) == expected
+
+
+def test_discrimination_net_code_generation_constraints():
+    patterns = [Pattern(f(x_, y_), EqualVariablesConstraint('x', 'y')), Pattern(f(x_, _), CustomConstraint(is_not_b))]
+    net = DiscriminationNet(*patterns)
+    generator = DiscriminationNetCodeGenerator(net)
+    module = _compile_generated(generator)
+
+    assert list(module.match_root(f(a, a))) == [(0, {'x': a, 'y': a}), (1, {'x': a})]
+    assert list(module.match_root(f(b, a))) == []
+    assert list(module.match_root(f(a, b))) == [(1, {'x': a})]
+    assert generator.info.functions == 1
+
+
+@pytest.mark.parametrize('max_depth', [16, 1])
+def test_sequence_matcher_code_generation(max_depth):
+    patterns = [
+        Pattern(f(___, x_, x_, ___)),
+        Pattern(f(z___, a, b, ___)),
+        Pattern(f(___, a, c, z___)),
+        Pattern(f(z___, a, c, z___)),
+        Pattern(f(___, a, f2(b, c), ___)),
+        Pattern(f(___, f2(_, c), z___), CustomConstraint(lambda z: len(z) > 0)),
+    ]
+    matcher = SequenceMatcher(*patterns)
+    module = _compile_generated(SequenceMatcherCodeGenerator(matcher, max_depth=max_depth))
+
+    for subject in [
+        f(a, b, c, a, a, b, a, c, b), f(a, f2(b)), f(b, a, f2(b, c), a), f(f2(a, c), f2(b, c), a), f(), a, f2(a, b)
+    ]:
+        expected = [(patterns.index(pattern), subst) for pattern, subst in matcher.match(subject)]
+        assert list(module.match_root(subject)) == expected
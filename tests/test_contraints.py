@@ -2,8 +2,11 @@
 from unittest.mock import Mock
 
 import pytest
+from multiset import Multiset
 
-from matchpy.expressions.constraints import Constraint, CustomConstraint, EqualVariablesConstraint
+from matchpy.expressions.constraints import (
+    Constraint, CustomConstraint, EqualVariablesConstraint, register_importable
+)
 
 
 class DummyConstraint(Constraint):
@@ -143,3 +146,54 @@ def test_custom_constraint_with_renamed_vars():
     assert c2({'x': 1, 'z': 3, 'y': 3}) is True
     assert actual_x == 3
     assert actual_y == 3
+
+
+def _is_positive(x):
+    return x > 0
+
+
+def _unregistered(x):
+    return x > 0
+
+
+register_importable(_is_positive, 'tests.test_contraints._is_positive')
+
+
+@pytest.mark.parametrize(
+    '   constraint,                                         substitution',
+    [
+        (EqualVariablesConstraint('x'),                     {'x': 0}),
+        (EqualVariablesConstraint('x', 'y'),                {'x': 0, 'y': 0}),
+        (EqualVariablesConstraint('x', 'y'),                {'x': 0, 'y': 1}),
+        (EqualVariablesConstraint('x', 'y', 'z'),           {'x': 0, 'y': 0, 'z': 1}),
+        (EqualVariablesConstraint('x', 'y'),                {'x': (0, 1), 'y': Multiset([1, 0])}),
+        (EqualVariablesConstraint('x', 'y'),                {'x': (0, 1), 'y': Multiset([1])}),
+        (C_custom3,                                         {'x': 1, 'y': 1}),
+        (C_custom3.with_renamed_vars({'x': 'z'}),           {'z': 1, 'y': 0}),
+        (CustomConstraint(lambda real: real.real == 1),     {'real': 1}),
+        (CustomConstraint(lambda x: dict(x=x)['x'] == 1),   {'x': 1}),
+        (CustomConstraint(_is_positive),                    {'x': 1}),
+        (CustomConstraint(_is_positive),                    {'x': -1}),
+    ]
+)  # yapf: disable
+def test_constraint_generate_code(constraint, substitution):
+    expression, imports = constraint.generate_code('subst')
+    namespace = {'subst': substitution}
+    exec('\n'.join(imports), namespace)
+
+    assert eval(expression, namespace) == constraint(substitution)
+
+
+def test_constraint_generate_code_not_supported():
+    assert C_dummy1.generate_code('subst') is None
+    assert CustomConstraint(_unregistered).generate_code('subst') is None
+
+
+def test_register_importable_errors():
+    def local_function(x):
+        return True
+
+    with pytest.raises(ValueError):
+        register_importable(local_function)
+    with pytest.raises(ValueError):
+        register_importable(local_function, 'local_function')
@@ -6,6 +6,11 @@ import pytest
 from multiset import Multiset
 
 from matchpy.expressions.expressions import (Arity, Operation, Symbol, SymbolWildcard, Wildcard, Expression)
+from matchpy.expressions import functions as expression_functions
+from matchpy.expressions.functions import (
+    create_operation_expression, op_iter, op_len, register_operation_iterator, replace_operand
+)
+from matchpy.functions import replace, substitute
 from .common import *
 
 SIMPLE_EXPRESSIONS = [
@@ -349,3 +354,70 @@ class TestOperation:
     def test_infix_error(self):
         with pytest.raises(TypeError):
             Operation.new('Invalid', Arity.unary, infix=True)
+
+    def test_register_operation_iterator_after_use(self):
+        class ReversedF(f):
+            pass
+
+        operation = ReversedF(a, b)
+        assert list(op_iter(operation)) == [a, b]
+        assert op_len(operation) == 2
+        register_operation_iterator(ReversedF, lambda o: reversed(o.operands), lambda o: 1)
+        try:
+            assert list(op_iter(operation)) == [b, a]
+            assert op_len(operation) == 1
+        finally:
+            del expression_functions._operation_iterators[ReversedF]
+            expression_functions._resolved_iterators.clear()
+
+    def test_replace_with_registered_operation_iterator(self):
+        class ReversedF(f):
+            pass
+
+        register_operation_iterator(ReversedF, lambda o: reversed(o.operands), len)
+        try:
+            assert replace_operand(ReversedF(a, b, c), 0, d) == ReversedF(d, b, a)
+            assert replace(ReversedF(a, b, c), (0, ), d) == ReversedF(d, b, a)
+            assert substitute(ReversedF(x_, b, c), {'x': a}) == ReversedF(c, b, a)
+        finally:
+            del expression_functions._operation_iterators[ReversedF]
+            expression_functions._resolved_iterators.clear()
+
+    @pytest.mark.parametrize(
+        '   operation,  operands', [
+            (f,         [b, a]),
+            (f_c,       [a, b, c]),
+            (f_ac,      [a, a, b]),
+            (f_u,       [a]),
+        ]
+    )  # yapf: disable
+    def test_from_canonical(self, operation, operands):
+        expression = operation.from_canonical(list(operands), variable_name='x')
+        assert expression == operation(*operands, variable_name='x')
+        assert expression.operands == operands
+
+    @pytest.mark.parametrize('operation', [f, f_c, f_a, f_ac, f_i, f_ci, f2, f_u])
+    def test_replace_operand(self, operation):
+        operands_lists = [[a], [a, b], [c, a, b], [a, a, b, c], [s, Symbol('s'), b], [x_, a], [x___, a, b]]
+        new_operands = [a, b, c, d, s, Symbol('s'), f(a), f_c(b), operation(a), x_, x___, f_ac(a, f_ac(b))]
+        if not operation.arity.fixed_size:
+            new_operands.append(operation(a, b))
+        for operands in operands_lists:
+            if operation.arity.fixed_size and len(operands) != operation.arity.min_count:
+                continue
+            expression = operation(*operands, variable_name='v')
+            if not isinstance(expression, operation):
+                continue
+            for index, new_operand in itertools.product(range(len(expression.operands)), new_operands):
+                modified = list(expression.operands)
+                modified[index] = new_operand
+                expected = create_operation_expression(expression, modified)
+                result = replace_operand(expression, index, new_operand)
+                assert result == expected
+                assert type(result) is type(expected)
+                assert [type(o) for o in op_iter(result)] == [type(o) for o in op_iter(expected)]
+                assert list(expression.operands) == list(operation(*operands).operands)
+
+    def test_replace_operand_arity(self):
+        with pytest.raises(ValueError):
+            replace_operand(f_u(a), 0, Wildcard(2, True))
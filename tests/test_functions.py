@@ -2,9 +2,12 @@
 from hypothesis import assume, given
 import hypothesis.strategies as st
 import pytest
+from multiset import Multiset
 
 from matchpy.expressions.expressions import Arity, Operation, Symbol, Wildcard, Pattern
-from matchpy.functions import ReplacementRule, replace, replace_all, substitute, replace_many, is_match
+from matchpy.functions import (
+    ReplacementRule, replace, replace_all, substitute, replace_many, is_match, compile_template
+)
 from matchpy.matching.one_to_one import match_anywhere
 from matchpy.matching.one_to_one import match as match_one_to_one
 from matchpy.matching.many_to_one import ManyToOneReplacer
@@ -23,7 +26,12 @@ def test_is_match(expr, pattern, do_match):
     assert is_match(expr, Pattern(pattern)) == do_match
 
 
+def template_substitute(expression, substitution):
+    return compile_template(expression).substitute(substitution)
+
+
 class TestSubstitute:
+    @pytest.mark.parametrize('substitute', [substitute, template_substitute])
     @pytest.mark.parametrize(
         '   expression,                         substitution,           expected_result,    replaced',
         [
@@ -42,10 +50,18 @@ class TestSubstitute:
             (f(x_, y_),                         {'x': a, 'y': b},       f(a, b),            True),
             (f(x_, y_),                         {'x': [a, c], 'y': b},  f(a, c, b),         True),
             (f(x_, y_),                         {'x': a, 'y': [b, c]},  f(a, b, c),         True),
+            (f(x_, c),                          {'x': Multiset([b, a])}, f(a, b, c),       True),
+            (f_c(x_, c),                        {'x': a},               f_c(a, c),          True),
+            (f_c(c, f_c(x_)),                   {'x': [b, a]},          f_c(c, f_c(a, b)),  True),
+            (f_a(x_, f_a(a, y_)),               {'x': b, 'y': f_a(c)},  f_a(b, a, c),       True),
+            (f_i(x_),                           {'x': a},               a,                  True),
+            (f(a, f(b, x_), f(c)),              {'x': a},               f(a, f(b, a), f(c)), True),
+            (f(a, variable_name='x'),           {'x': b},               b,                  True),
+            (f(x_, variable_name='y'),          {'x': b},               f(b, variable_name='y'), True),
             (Pattern(f(x_)),                    {'x': a},               f(a),               True)
         ]
     )  # yapf: disable
-    def test_substitute(self, expression, substitution, expected_result, replaced):
+    def test_substitute(self, expression, substitution, expected_result, replaced, substitute):
         result = substitute(expression, substitution)
         assert result == expected_result, "Substitution did not yield expected result"
         if replaced:
@@ -53,6 +69,21 @@ class TestSubstitute:
         else:
             assert result is expression, "When nothing is substituted, the original expression has to be returned"
 
+    def test_compile_template_shares_constant_subexpressions(self):
+        template = compile_template(f(f(a, b), x_, f(f(c), y_)))
+        result = template.substitute({'x': a, 'y': b})
+
+        assert result == f(f(a, b), a, f(f(c), b))
+        assert result[0] is template.expression[0]
+        assert result[2][0] is template.expression[2][0]
+        assert template.variables == {'x', 'y'}
+
+    def test_compile_template_as_replacement(self):
+        template = compile_template(f2(y_, x_))
+        rule = ReplacementRule(Pattern(f(x_, y_)), template)
+
+        assert replace_all(f(a, f(b, c)), [rule]) == f2(f2(c, b), a)
+
 
 def many_replace_wrapper(expression, position, replacement):
     return replace_many(expression, [(position, replacement)])
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import importlib
+import subprocess
+import sys
+
+import pytest
+
+import matchpy
+import matchpy.matching
+
+LAZY_MODULES = [
+    'matchpy.functions',
+    'matchpy.parse',
+    'matchpy.serialization',
+    'matchpy.matching.many_to_one',
+    'matchpy.matching.bipartite',
+    'matchpy.matching.one_to_one',
+    'matchpy.matching.syntactic',
+    'matchpy.matching.code_generation',
+    'hopcroftkarp',
+    'graphviz',
+]
+
+
+def _loaded_modules(statement):
+    code = 'import sys\n{}\nprint("\\n".join(sys.modules))'.format(statement)
+    output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True)
+    return set(output.split())
+
+
+@pytest.mark.parametrize('statement', ['import matchpy', 'from matchpy import Symbol, Operation, Wildcard, Pattern'])
+def test_import_does_not_load_matching(statement):
+    loaded = _loaded_modules(statement)
+    assert not loaded.intersection(LAZY_MODULES)
+
+
+def test_import_loads_only_needed_submodules():
+    loaded = _loaded_modules('from matchpy import match')
+    assert 'matchpy.matching.one_to_one' in loaded
+    assert 'matchpy.matching.many_to_one' not in loaded
+    assert 'hopcroftkarp' not in loaded
+
+
+@pytest.mark.parametrize('package, submodules', [
+    (matchpy, ['expressions', 'utils', 'functions', 'matching', 'parse', 'serialization']),
+    (matchpy.matching, ['many_to_one', 'bipartite', 'budget', 'one_to_one', 'syntactic']),
+])
+def test_lazy_names_match_submodules(package, submodules):
+    expected = []
+    for name in submodules:
+        submodule = importlib.import_module('{}.{}'.format(package.__name__, name))
+        expected.extend(submodule.__all__)
+        for attribute in submodule.__all__:
+            assert getattr(package, attribute) is getattr(submodule, attribute)
+    assert sorted(package.__all__) == sorted(expected)
+    assert set(package.__all__) <= set(dir(package))
+
+
+def test_missing_attribute():
+    with pytest.raises(AttributeError):
+        matchpy.matching.does_not_exist
+    with pytest.raises(ImportError):
+        from matchpy import does_not_exist
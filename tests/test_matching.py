@@ -440,6 +440,30 @@ class TestMatch:
                 expression, pattern, result_match
             )
 
+    @pytest.mark.parametrize(
+        '   expression,                                 pattern,                            match_count',
+        [
+            (f(a, b),                                   f(___, a, ___, b, ___),             1),
+            (f(b, a),                                   f(___, a, ___, b, ___),             0),
+            (f(a, c, b, a, c, b),                       f(___, a, ___, b, ___),             3),
+            (f(*[a, b] * 10),                           f(___, a, ___, b, ___),             55),
+            (f(*[a, b] * 10),                           f(x__, a, y___, b),                 9),
+            (f(*[a, b] * 10),                           f(___, a, x_, ___),                 10),
+            (f(*[c] * 20),                              f(___, a, ___),                     0),
+            (f(*[c] * 20 + [a]),                        f(x___, a, y___),                   1),
+            (f(*[c] * 20 + [a]),                        f(x___, a, y__),                    0),
+            (f(*[c] * 20 + [a]),                        f(x___, a, f(y___)),                0),
+            (f(*[a] * 20),                              f(x___, y_, z_),                    1),
+            (f(c, a, b),                                f(___, oa_, b, ___),                2),
+            (f(a, b, c, a, b),                          f(o2b_, ___, a, oa_, b, ___),       3),
+            (f(b, a, c, b),                             f(o2b_, a, ___, b),                 1),
+            (f(a, c, b, a, b),                          f(oa_, ___, a, o2b_, ___),          6),
+        ]
+    )  # yapf: disable
+    def test_anchored_sequence_variables_match(self, match, expression, pattern, match_count):
+        result = list(match(expression, Pattern(pattern)))
+        assert len(result) == match_count
+
     @pytest.mark.parametrize(
         '   expression,                 pattern,            expected_matches',
         [
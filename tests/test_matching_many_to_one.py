@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+import io
+
+import hypothesis.strategies as st
+from hypothesis import given
 import pytest
 
 from matchpy.expressions.constraints import CustomConstraint
 from matchpy.expressions.expressions import Symbol, Pattern, Operation, Arity, Wildcard
-from matchpy.matching.many_to_one import ManyToOneMatcher
+from matchpy.matching.bipartite import BipartiteGraph
+from matchpy.functions import ReplacementRule
+from matchpy.matching.budget import MatchBudget
+from matchpy.matching.many_to_one import ManyToOneMatcher, ManyToOneReplacer, SecondaryAutomaton, TransitionProfile
 from .common import *
 from .utils import MockConstraint
 
@@ -259,4 +267,345 @@ def test_many_to_one(subject, patterns):
 
     assert matches == [], "Subject {!s} and pattern {!s} yielded unexpected matches".format(
         subject, pattern
-    )
\ No newline at end of file
+    )
+
+
+@st.composite
+def small_bipartite_graph(draw):
+    k = draw(st.integers(min_value=1, max_value=4))
+    n = draw(st.integers(min_value=0, max_value=6))
+
+    graph = BipartiteGraph()
+    for i in range(n):
+        for j in range(k):
+            if draw(st.booleans()):
+                graph[(i, 0), (j, 0)] = True
+
+    return k, graph
+
+
+@given(small_bipartite_graph())
+def test_secondary_automaton(args):
+    k, graph = args
+    automaton = SecondaryAutomaton.get(k)
+    masks = {}
+    for (subject, _), (pattern, _) in graph.edges():
+        masks[subject] = masks.get(subject, 0) | (1 << pattern)
+
+    assert automaton.match(masks.values()) == (len(graph.find_matching()) == k)
+
+
+@pytest.mark.parametrize('n', [1, 2, 5, 50])
+def test_commutative_high_multiplicity(n):
+    pattern = Pattern(f_c(f(x_), f(x_), f(y_), z___))
+    subject = f_c(*([f(a)] * n + [f(b)] * n))
+    matcher = ManyToOneMatcher(pattern)
+
+    results = sorted((str(s['x']), str(s['y'])) for _, s in matcher.match(subject))
+
+    expected = [('a', 'a'), ('a', 'b'), ('b', 'a'), ('b', 'b')]
+    if n == 1:
+        expected = []
+    elif n == 2:
+        expected = [('a', 'b'), ('b', 'a')]
+    assert results == expected
+
+
+@pytest.mark.parametrize(
+    '   subject,                expected_patterns',
+    [
+        (f_c(),                 [4]),
+        (f_c(a),                [3, 4]),
+        (f_c(a, b),             [0, 1, 3, 4]),
+        (f_c(a, a),             [0, 1, 2, 3, 4]),
+        (f_c(a, b, c),          [1, 3, 4, 5]),
+        (f_c(b, c),             [0, 1, 4]),
+    ]
+)  # yapf: disable
+def test_commutative_candidate_patterns(subject, expected_patterns):
+    patterns = [
+        Pattern(f_c(x_, y_)),
+        Pattern(f_c(x_, y_, z___)),
+        Pattern(f_c(a, a, x___)),
+        Pattern(f_c(a, x___)),
+        Pattern(f_c(x___)),
+        Pattern(f_c(a, b, c)),
+    ]
+    matcher = ManyToOneMatcher(*patterns)
+
+    results = set(patterns.index(pattern) for pattern, _ in matcher.match(subject))
+
+    assert results == set(expected_patterns)
+
+
+@pytest.mark.parametrize('cache_size', [None, 0, 1, 3])
+def test_subject_cache_size(cache_size):
+    pattern = Pattern(f_c(f(x_), y___))
+    subjects = [f_c(f(a), b), f_c(f(b), a, c), f_c(f(a), f(b)), f_c(a, b, c, f(c))]
+    unbounded_matcher = ManyToOneMatcher(pattern)
+    matcher = ManyToOneMatcher(pattern, subject_cache_size=cache_size)
+
+    for subject in subjects * 2:
+        expected = sorted(str(s) for _, s in unbounded_matcher.match(subject))
+        assert sorted(str(s) for _, s in matcher.match(subject)) == expected
+
+    info = matcher.cache_info()
+    assert info.hits + info.misses == unbounded_matcher.cache_info().hits + unbounded_matcher.cache_info().misses
+    if cache_size is None:
+        assert info.evictions == 0
+    else:
+        assert info.evictions > 0
+        assert info.subjects <= cache_size
+        assert info.subjects + info.evictions == info.misses
+
+
+def test_subject_cache_keeps_subjects_of_running_match():
+    matcher = ManyToOneMatcher(Pattern(f_c(x_, y___)), subject_cache_size=0)
+
+    outer_iter = iter(matcher.match(f_c(a, b)))
+    first = next(outer_iter)
+    assert len(list(matcher.match(f_c(c, a)))) == 2
+    rest = list(outer_iter)
+
+    assert sorted(str(s['x']) for _, s in [first] + rest) == ['a', 'b']
+    assert matcher.cache_info().subjects == 0
+
+
+def test_match_from_multiple_threads():
+    patterns = [Pattern(f_c(f(x_), y___)), Pattern(f_c(x_, x_, y___)), Pattern(f(f_c(a, x__)))]
+    subjects = [f_c(f(a), b), f_c(f(b), a, a), f_c(f(a), f(b), c), f(f_c(a, b, c)), f(f_c(a, a))]
+    expected = [sorted(str(s) for _, s in ManyToOneMatcher(*patterns).match(subject)) for subject in subjects]
+    matcher = ManyToOneMatcher(*patterns, subject_cache_size=2)
+
+    def match_all(_):
+        return [sorted(str(s) for _, s in matcher.match(subject)) for subject in subjects * 10]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(match_all, range(8)))
+
+    for result in results:
+        assert result == expected * 10
+
+
+@pytest.mark.parametrize(
+    '   subject,        patterns,                                                   expected_label',
+    [
+        (f(a, b),       [(f(x_, y_), 'x', 0), (f(a, y_), 'a', 0), (f(a, b), 'ab', 0)],  'x'),
+        (f(a, b),       [(f(x_, y_), 'x', 0), (f(a, y_), 'a', 1), (f(a, b), 'ab', 0)],  'a'),
+        (f(a, b),       [(f(x_, y_), 'x', 0), (f(a, y_), 'a', 1), (f(a, b), 'ab', 2)],  'ab'),
+        (f(a, b),       [(f(x_, y_), 'x', 1), (f(a, y_), 'a', 1), (f(a, b), 'ab', 0)],  'x'),
+        (f(a, b),       [(f(b, y_), 'b', 2), (f(x_, b), 'x', 1), (f(a, c), 'ac', 3)],   'x'),
+        (f_c(a, b),     [(f_c(x_, y_), 'x', 0), (f_c(a, y___), 'a', 1)],               'a'),
+        (f(a, b),       [(f(x_, y_), 'x', 0), (f(b, y_), 'b', 1)],                      'x'),
+        (f(c),          [(f(a), 'a', 0), (f(b), 'b', 0)],                               None),
+    ]
+)  # yapf: disable
+def test_match_first(subject, patterns, expected_label):
+    matcher = ManyToOneMatcher()
+    for pattern, label, priority in patterns:
+        matcher.add(Pattern(pattern), label, priority)
+
+    result = matcher.match_first(subject)
+
+    if expected_label is None:
+        assert result is None
+    else:
+        label, substitution = result
+        assert label == expected_label
+        assert (label, substitution) in list(matcher.match(subject))
+
+
+def test_match_first_skips_lower_priority_patterns():
+    matcher = ManyToOneMatcher()
+    for i in range(20):
+        matcher.add(Pattern(f(x___, Symbol('s{}'.format(i)), y___)), i)
+    matcher.add(Pattern(f(x___, a, y___)), 'best', priority=1)
+    subject = f(*[Symbol('s{}'.format(i)) for i in range(20)], a)
+
+    first_budget = MatchBudget()
+    with first_budget.activate():
+        assert matcher.match_first(subject)[0] == 'best'
+    all_budget = MatchBudget()
+    assert len(list(all_budget.limit(matcher.match(subject)))) == 21
+    assert first_budget.steps < all_budget.steps
+
+
+def test_replacer_priority():
+    rules = [ReplacementRule(Pattern(f(x_)), lambda x: a), ReplacementRule(Pattern(f(b)), lambda: c)]
+
+    assert ManyToOneReplacer(*rules).replace(f(b)) == a
+    assert ManyToOneReplacer(*reversed(rules)).replace(f(b)) == c
+
+    replacer = ManyToOneReplacer()
+    replacer.add(rules[0])
+    replacer.add(rules[1], priority=1)
+    assert replacer.replace(f(b)) == c
+
+
+def _profile_patterns():
+    return [
+        Pattern(f(x__, a)),
+        Pattern(f(x_, b)),
+        Pattern(f(x_, f_c(a, y___))),
+        Pattern(f(y___, f_c(x_, b))),
+        Pattern(f(x_)),
+    ]
+
+
+def test_profile_save_and_load():
+    subjects = [f(c, b), f(a, f_c(a, b)), f(c, a), f(c, f_c(b, c))]
+    profile = ManyToOneMatcher(*_profile_patterns()).profile(subjects)
+    assert profile.counts
+    assert any(path for path, _, _ in profile.counts)
+
+    file = io.StringIO()
+    profile.save(file)
+    file.seek(0)
+    loaded = TransitionProfile.load(file)
+
+    assert loaded.counts == profile.counts
+    other_profile = ManyToOneMatcher(*_profile_patterns()).profile(subjects)
+    assert other_profile.counts == profile.counts
+
+
+def test_reorder_keeps_matches_and_finds_first_match_earlier():
+    subjects = [f(c, c, c, c, b), f(b, c, b, c, b), f(a, f_c(c, b)), f(b, f_c(b, c))]
+    matcher = ManyToOneMatcher(Pattern(f(x__, y__, z__, a)), Pattern(f(x___, b)), *_profile_patterns())
+    expected = [sorted(str(s) for _, s in matcher.match(subject)) for subject in subjects]
+
+    def first_match_steps():
+        budget = MatchBudget()
+        with budget.activate():
+            for subject in subjects:
+                next(iter(matcher.match(subject)))
+        return budget.steps
+
+    steps_before = first_match_steps()
+    matcher.reorder(matcher.profile(subjects))
+
+    assert [sorted(str(s) for _, s in matcher.match(subject)) for subject in subjects] == expected
+    assert first_match_steps() < steps_before
+
+
+def _matches(matcher, subject):
+    return sorted((str(pattern), str(substitution)) for pattern, substitution in matcher.match(subject))
+
+
+@pytest.mark.parametrize('subject, patterns', PARAM_PATTERNS.items())
+def test_minimize_keeps_matches(subject, patterns):
+    matcher = ManyToOneMatcher(*map(Pattern, patterns))
+    expected = _matches(matcher, subject)
+
+    info = matcher.minimize()
+
+    assert info.states_after <= info.states_before
+    assert info.transitions_after <= info.transitions_before
+    assert _matches(matcher, subject) == expected
+
+
+def test_minimize_merges_common_suffixes():
+    constraint = CustomConstraint(lambda x: x != c)
+    patterns = [
+        Pattern(f(a, x_)), Pattern(f(b, x_)), Pattern(f(c, x_), constraint), Pattern(f(a, f_c(x_, y___))),
+        Pattern(f(b, f_c(x_, y___))), Pattern(f(f_c(a, x_), b)), Pattern(f(f_c(a, x_), c))
+    ]
+    subjects = [f(a, b), f(b, c), f(c, c), f(c, a), f(a, f_c(a, b)), f(b, f_c(c)), f(f_c(a, b), b), f(f_c(a, a), c)]
+    matcher = ManyToOneMatcher(*patterns)
+    expected = [_matches(matcher, subject) for subject in subjects]
+
+    info = matcher.minimize()
+
+    assert info.states_after < info.states_before
+    assert info.transitions_after < info.transitions_before
+    assert [_matches(matcher, subject) for subject in subjects] == expected
+    assert matcher.minimize() == (info.states_after, info.states_after, info.transitions_after, info.transitions_after)
+
+    matcher.add(Pattern(f(a, b)))
+    assert _matches(matcher, f(a, b)) == sorted(expected[0] + [(str(f(a, b)), '{}')])
+    assert _matches(matcher, f(b, c)) == expected[1]
+
+
+@pytest.mark.parametrize('minimize', [False, True])
+@pytest.mark.parametrize('subject, patterns', PARAM_PATTERNS.items())
+def test_remove_keeps_matches_of_remaining_patterns(subject, patterns, minimize):
+    patterns = [Pattern(p) for p in patterns]
+    remaining = patterns[::2]
+    matcher = ManyToOneMatcher(*patterns)
+    if minimize:
+        matcher.minimize()
+
+    for pattern in patterns[1::2]:
+        matcher.remove(pattern)
+
+    fresh_matcher = ManyToOneMatcher(*remaining)
+    assert _matches(matcher, subject) == _matches(fresh_matcher, subject)
+    assert len(matcher.patterns) == len(remaining)
+    if not minimize:
+        assert len(matcher.states) == len(fresh_matcher.states)
+
+    for pattern in remaining:
+        matcher.remove(pattern)
+
+    assert list(matcher.match(subject)) == []
+    assert matcher.states == [matcher.root]
+
+
+def test_remove_with_constraints_and_labels():
+    constraint = CustomConstraint(lambda x: x != a)
+    matcher = ManyToOneMatcher()
+    matcher.add(Pattern(f(x_, y_), constraint), 'constrained')
+    matcher.add(Pattern(f(x_, b)), 'first')
+    matcher.add(Pattern(f(x_, b)), 'second')
+    matcher.add(Pattern(f_c(x_, y___)), 'commutative')
+
+    matcher.remove('constrained')
+    assert matcher.constraints == []
+    assert sorted(label for label, _ in matcher.match(f(c, b))) == ['first', 'second']
+
+    matcher.remove(Pattern(f(x_, b)))
+    assert list(matcher.match(f(c, b))) == []
+    assert [label for label, _ in matcher.match(f_c(a, b))] == ['commutative', 'commutative']
+
+    with pytest.raises(ValueError):
+        matcher.remove('first')
+
+    matcher.add(Pattern(f(x_, y_), constraint), 'constrained')
+    assert [label for label, _ in matcher.match(f(c, b))] == ['constrained']
+    assert list(matcher.match(f(a, b))) == []
+
+
+def test_remove_where_and_remove_indices():
+    matcher = ManyToOneMatcher()
+    matcher.add(Pattern(f(x_, a)), 1)
+    matcher.add(Pattern(f(x_, b)), 2)
+    matcher.add(Pattern(f(x_, c)), 3)
+    matcher.add(Pattern(f(a, x_)), 4)
+
+    assert matcher.remove_where(lambda pattern, label: label % 2 == 0) == 2
+    assert matcher.remove_where(lambda pattern, label: label == 2) == 0
+    assert [label for _, label, _ in matcher.patterns] == [1, 3]
+
+    assert matcher.remove_indices([0]) == {1: 0}
+    assert [label for label, _ in matcher.match(f(a, c))] == [3]
+    assert list(matcher.match(f(b, a))) == []
+
+
+def test_replacer_replace_rules():
+    rules = [
+        ReplacementRule(Pattern(f(a)), lambda: b),
+        ReplacementRule(Pattern(f(x_)), lambda x: c),
+        ReplacementRule(Pattern(f_c(a, x_)), lambda x: x),
+    ]
+    replacer = ManyToOneReplacer(*rules)
+    assert replacer.replace(f(a)) == b
+
+    replacer.remove(rules[0])
+    assert replacer.replace(f(a)) == c
+    with pytest.raises(ValueError):
+        replacer.remove(rules[0])
+
+    new_rule = ReplacementRule(Pattern(f_c(b, x_)), lambda x: a)
+    replacer.replace_rules([rules[2], new_rule])
+    assert [label for _, label, _ in replacer.matcher.patterns] == [rules[2].replacement, new_rule.replacement]
+    assert replacer.replace(f(f_c(a, b))) == f(b)
+    assert replacer.replace(f_c(b, c)) == a
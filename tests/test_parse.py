@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import io
+
+import pytest
+
+from matchpy.expressions.expressions import Arity, Operation, Symbol, Wildcard
+from matchpy.parse import Parser, parse_expression
+from .common import *
+
+Plus = Operation.new('+', Arity.variadic, 'Plus', associative=True, commutative=True, infix=True)
+Minus = Operation.new('-', Arity.binary, 'Minus', infix=True)
+
+PARSER = Parser([f, f2, f_u, f_i, f_c, f_ci, f2_c, f_a, f_ac, Plus, Minus], symbols={'s': SpecialSymbol})
+
+
+@pytest.mark.parametrize(
+    'expression', [
+        a,
+        s,
+        x_,
+        Symbol('a', variable_name='x'),
+        Symbol('ä€'),
+        f(),
+        f(a, b),
+        f(a, f(b, a), f(b, a)),
+        f(a, variable_name='x'),
+        f(f(a), f(a, variable_name='x'), f_u(a, variable_name='y')),
+        f_c(c, b, a),
+        f_ac(a, f_ac(b, c)),
+        f_u(f_u(a)),
+        f(x_, y__, z___, _, __, ___),
+        f(oa_, Wildcard.optional('p', f(a, b)), f(a, b)),
+        f(_s, _ss, s_, ss_),
+        f(Wildcard(3, True, 'x'), Wildcard(2, False)),
+        Plus(a, b, c),
+        Plus(a, Minus(b, c), variable_name='x'),
+        Minus(Minus(a, b), f(Plus(a, b), Symbol('c', variable_name='y'))),
+        Minus(Symbol('a', variable_name='x'), Plus(b, c)),
+        f(Minus(a, b), variable_name='z'),
+    ]
+)  # yapf: disable
+def test_round_trip(expression):
+    result = PARSER.parse(str(expression))
+    assert result == expression
+    assert str(result) == str(expression)
+    for (subexpression, _), (expected, _) in zip(result.preorder_iter(), expression.preorder_iter()):
+        assert type(subexpression) is type(expected)
+
+
+@pytest.mark.parametrize(
+    '   text,                   expected', [
+        ('f_c(c, b, a)',        f_c(a, b, c)),
+        ('f_a(a, f_a(b, c))',   f_a(a, b, c)),
+        ('(c + (b + a))',       Plus(a, b, c)),
+        ('f_i(a)',              a),
+        ('  f( a ,b )  ',       f(a, b)),
+        ('f(f(f()))',           f(f(f()))),
+    ]
+)  # yapf: disable
+def test_canonical_form(text, expected):
+    assert PARSER.parse(text) == expected
+
+
+@pytest.mark.parametrize(
+    'text', [
+        '',
+        'f(a',
+        'f(a,)',
+        'f(a) b',
+        'g(a)',
+        '(a)',
+        '(a + b - c)',
+        '(a + b',
+        'x: ,',
+        'a: (',
+        'a: b: c',
+        'x_:',
+        '_[Unknown]',
+        ')',
+        'f(a, b) )',
+        'f_u(a, b)',
+    ]
+)
+def test_invalid(text):
+    with pytest.raises(ValueError):
+        PARSER.parse(text)
+
+
+def test_parse_file():
+    file = io.StringIO('f(a, b)\n\n   \n(a + b)\nx_\n')
+    assert list(PARSER.parse_file(file)) == [f(a, b), Plus(a, b), x_]
+    with pytest.raises(ValueError) as e:
+        list(PARSER.parse_lines(['a', 'f(', 'b']))
+    assert 'Line 2' in str(e.value)
+
+
+def test_atoms_are_shared():
+    first, second = PARSER.parse_lines(['f(a, x_)', 'f(x_, a)'])
+    assert first.operands[0] is second.operands[1]
+    assert first.operands[1] is second.operands[0]
+
+
+def test_duplicate_operation_names():
+    with pytest.raises(ValueError):
+        Parser([f, Operation.new('f', Arity.binary)])
+
+
+def test_parse_expression():
+    assert parse_expression('f(a, s)', [f], SpecialSymbol) == f(SpecialSymbol('a'), SpecialSymbol('s'))
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import io
+
+import pytest
+
+from matchpy.expressions.expressions import Arity, Operation, Symbol, Wildcard
+from matchpy.serialization import ExpressionReader, ExpressionWriter, dumps, loads
+from .common import *
+
+TYPES = [f, f2, f_u, f_i, f_c, f_ci, f2_c, f_a, f_ac]
+
+EXPRESSIONS = [
+    a,
+    s,
+    x_,
+    Symbol('a', variable_name='x'),
+    Symbol('ä€\U0001f600'),
+    f(),
+    f(a, b),
+    f(a, f(b, a), f(b, a)),
+    f(f(a, b), f(f(a, b), f(a, b))),
+    f(f(a), f(a, variable_name='x'), f(a, variable_name='x')),
+    f_c(c, b, a),
+    f_ac(a, f_ac(b, c)),
+    f_i(a, b),
+    f_u(f_u(a)),
+    f2(f(a, a), f(a, a)),
+    f(x_, y__, z___, _, __, ___),
+    f(oa_, Wildcard.optional('p', f(a, b)), f(a, b)),
+    f(_s, _ss, s_, ss_),
+    f(Wildcard(3, True, 'x'), Wildcard(2, False)),
+    f(s, SpecialSymbol('a'), a, Symbol('s')),
+    f(*(Symbol('s{}'.format(i)) for i in range(200))),
+]
+
+
+def _assert_same_types(result, expected):
+    assert type(result) is type(expected)
+    assert result.variable_name == expected.variable_name
+    if isinstance(expected, Wildcard):
+        if expected.optional is not None:
+            _assert_same_types(result.optional, expected.optional)
+    elif isinstance(expected, Operation):
+        assert len(result.operands) == len(expected.operands)
+        for result_operand, expected_operand in zip(result.operands, expected.operands):
+            _assert_same_types(result_operand, expected_operand)
+
+
+@pytest.mark.parametrize('expression', EXPRESSIONS)
+def test_round_trip(expression):
+    result = loads(dumps(expression), types=TYPES)
+    assert result == expression
+    _assert_same_types(result, expression)
+
+
+class Matrix(Symbol):
+    def __init__(self, name, properties=[]):
+        super().__init__(name)
+        self.properties = frozenset(properties)
+
+
+class Tagged(Operation):
+    name = 'tagged'
+    arity = Arity.variadic
+
+    def __init__(self, operands, variable_name=None):
+        super().__init__(operands, variable_name)
+        self.tag = len(self.operands)
+
+
+def test_symbol_attributes():
+    expression = f(Matrix('M1', ['diagonal', 'square']), Matrix('M1'), Matrix('M2', ['triangular']))
+    result = loads(dumps(expression), types=TYPES)
+    assert result == expression
+    _assert_same_types(result, expression)
+    assert [o.properties for o in result.operands] == [o.properties for o in expression.operands]
+
+
+def test_wildcard_attributes():
+    wildcard = Wildcard.optional('x', a)
+    wildcard.note = 'note'
+    result = loads(dumps(f(wildcard, Wildcard.symbol('y', Matrix))), types=TYPES)
+    assert result == f(wildcard, Wildcard.symbol('y', Matrix))
+    assert result.operands[0].note == 'note'
+    assert result.operands[1].symbol_type is Matrix
+
+
+def test_operation_with_custom_init():
+    expression = f(Tagged(a, b, c), Tagged(variable_name='x'))
+    result = loads(dumps(expression), types=TYPES)
+    assert result == expression
+    _assert_same_types(result, expression)
+    assert [o.tag for o in result.operands] == [3, 0]
+
+
+def test_attributes_that_cannot_be_pickled():
+    matrix = Matrix('M')
+    matrix.properties = lambda: None
+    with pytest.raises(TypeError):
+        dumps(matrix)
+
+
+def test_stream():
+    file = io.BytesIO()
+    writer = ExpressionWriter(file)
+    writer.write_all(EXPRESSIONS)
+    writer.write(a)
+    file.seek(0)
+    reader = ExpressionReader(file, types=TYPES)
+    assert list(reader) == EXPRESSIONS + [a]
+    with pytest.raises(EOFError):
+        reader.read()
+
+
+def test_tables_are_shared_between_expressions():
+    file = io.BytesIO()
+    writer = ExpressionWriter(file)
+    writer.write(f(a, b))
+    size = file.tell()
+    writer.write(f(a, b))
+    # The length, the operation tag, the operand count and the two symbols
+    assert file.tell() - size == 5
+    file.seek(0)
+    first, second = ExpressionReader(file, types=TYPES)
+    assert first == second == f(a, b)
+    assert first.operands[0] is second.operands[0]
+
+
+def test_shared_subexpressions():
+    shared = f(*(Symbol('s{}'.format(i)) for i in range(20)))
+    expression = f(shared, f(shared, shared), shared)
+    assert len(dumps(expression)) < 2 * len(dumps(shared))
+    result = loads(dumps(expression), types=TYPES)
+    assert result == expression
+    assert result.operands[0] is result.operands[1].operands[0] is result.operands[2]
+
+
+def test_type_must_be_known():
+    data = dumps(f(a))
+    with pytest.raises(ValueError):
+        loads(data)
+    with pytest.raises(ValueError):
+        loads(data, types=[f, Operation.new('f', Arity.binary)])
+    assert loads(data, types=[f]) == f(a)
+
+
+@pytest.mark.parametrize('data', [b'', b'MATCHPY\x02', b'not matchpy'])
+def test_invalid_header(data):
+    with pytest.raises(ValueError):
+        loads(data)
+
+
+def test_invalid_data():
+    data = dumps(f(a, b))
+    for length in range(len(b'MATCHPY\x01'), len(data)):
+        with pytest.raises(ValueError):
+            loads(data[:length], types=TYPES)
+    with pytest.raises(ValueError):
+        loads(data[:-1] + b'\x7f', types=TYPES)
+
+
+def test_corrupted_data():
+    data = dumps(f(a, f_c(b, x_), s_, Wildcard.optional('o', a), variable_name='v'))
+    for index in range(len(b'MATCHPY\x01'), len(data)):
+        # All the single bit flips, the small values, which are the special tags and lengths, and a relative import
+        values = set(range(8)) | set(data[index] ^ (1 << bit) for bit in range(8)) | {ord('.')}
+        for value in values:
+            try:
+                loads(data[:index] + bytes((value, )) + data[index + 1:], types=TYPES)
+            except ValueError:
+                pass
+
+
+def test_writer_error_keeps_stream_valid():
+    file = io.BytesIO()
+    writer = ExpressionWriter(file)
+    with pytest.raises(TypeError):
+        writer.write(f(a, f_c(b), [c]))
+    writer.write(f(a, f_c(b), c))
+    file.seek(0)
+    assert list(ExpressionReader(file, types=TYPES)) == [f(a, f_c(b), c)]
@@ -345,6 +345,13 @@ def test_sequence_matcher_match():
     assert list(matcher.match(a)) == []
 
 
+def test_sequence_matcher_match_prefix_of_longer_pattern():
+    patterns = [Pattern(f(___, a, ___)), Pattern(f(___, a, f2(b, c), ___))]
+    matcher = SequenceMatcher(*patterns)
+
+    assert list(matcher.match(f(a, f2(b)))) == [(patterns[0], {})]
+
+
 @pytest.mark.parametrize(
     '   patterns,                   expected_error',
     [
@@ -8,9 +8,9 @@ import pytest
 from multiset import Multiset
 
 from matchpy.utils import (
-    VariableWithCount, base_solution_linear, cached_property, commutative_sequence_variable_partition_iter,
-    extended_euclid, fixed_integer_vector_iter, get_short_lambda_source, weak_composition_iter, slot_cached_property,
-    solve_linear_diop
+    VariableWithCount, base_solution_linear, cached_property, commutative_sequence_variable_partition_count_iter,
+    commutative_sequence_variable_partition_iter, extended_euclid, fixed_integer_vector_iter, get_short_lambda_source,
+    weak_composition_iter, slot_cached_property, solve_linear_diop
 )
 
 
@@ -255,6 +255,50 @@ class TestCommutativeSequenceVariablePartitionIter:
             count += 1
         assert count == expected_iter_count, "Invalid number of substitution in the iterable"
 
+    @given(sequence_vars(), st.lists(st.integers(1, 4), min_size=1, max_size=10))
+    def test_count_vectors_randomized(self, variables, values):
+        values = Multiset(values)
+        elements, counts = zip(*values.items())
+        substitutions = list(commutative_sequence_variable_partition_iter(values, variables))
+        count_vectors = list(commutative_sequence_variable_partition_count_iter(counts, variables))
+        assert is_unique_list(count_vectors)
+        assert len(count_vectors) == len(substitutions)
+        for vectors in count_vectors:
+            assert len(vectors) == len(variables)
+            for var, vector in zip(variables, vectors):
+                assert sum(vector) >= var.minimum
+            for i, count in enumerate(counts):
+                assert sum(var.count * vector[i] for var, vector in zip(variables, vectors)) == count
+            substitution = dict(
+                (var.name, Multiset(dict((e, c) for e, c in zip(elements, vector) if c)))
+                for var, vector in zip(variables, vectors)
+            )
+            assert substitution in substitutions
+
+    def test_count_vectors_default(self):
+        x = VariableWithCount('x', 1, 2, 'default')
+        y = VariableWithCount('y', 1, 0, None)
+        result = list(commutative_sequence_variable_partition_count_iter([1, 1], [x, y]))
+        assert sorted(result) == [((0, 0), (1, 1)), ((1, 1), (0, 0))]
+        result = list(commutative_sequence_variable_partition_iter(Multiset('ab'), [x, y]))
+        assert {'x': 'default', 'y': Multiset('ab')} in result
+        assert len(result) == 2
+
+    def test_results_are_independent(self):
+        x = VariableWithCount('x', 1, 0, None)
+        y = VariableWithCount('y', 1, 0, None)
+        values = Multiset('aab')
+        expected = [
+            dict((k, Multiset(v)) for k, v in s.items())
+            for s in commutative_sequence_variable_partition_iter(values, [x, y])
+        ]
+        result = []
+        for substitution in commutative_sequence_variable_partition_iter(values, [x, y]):
+            result.append(dict((k, Multiset(v)) for k, v in substitution.items()))
+            for value in substitution.values():
+                value.clear()
+        assert result == expected
+
 
 # yapf: disable
 # =========================================================================